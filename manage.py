@@ -3,7 +3,12 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from src.app import create_app, db
+from src.batch_files import guess_file_format, FILE_FORMATS
+from src.clearing import process_clearing_file, CLEARING_CHUNK_SIZE
+from src.funding import process_funding_file, FUNDING_CHUNK_SIZE
+from src.hold_expiry import release_expired_holds
 from src.models import CardModel, MerchantModel, TransactionModel
+from src.seed import seed as seed_database, SEED_CHUNK_SIZE
 
 env_name = os.getenv('FLASK_ENV')
 app = create_app(env_name)
@@ -14,5 +19,102 @@ manager = Manager(app=app)
 
 manager.add_command('db', MigrateCommand)
 
+@manager.option('-f', '--file', dest='path', required=True, help='csv or ndjson funding file')
+@manager.option('--format', dest='file_format', choices=FILE_FORMATS,
+                help='file format, guessed from the extension by default')
+@manager.option('--chunk-size', dest='chunk_size', type=int, default=FUNDING_CHUNK_SIZE,
+                help='lines applied per db transaction')
+def topup_file(path, file_format=None, chunk_size=FUNDING_CHUNK_SIZE):
+  """
+  Top up cards from a funding file of card_nbr and amount lines
+  """
+  file_format = file_format or guess_file_format(path)
+
+  def report(line_num, error):
+    print('line %d: %s' % (line_num, error))
+
+  with open(path) as stream:
+    stats = process_funding_file(stream, file_format, chunk_size, on_failure=report)
+  print('%(lines)d lines, %(applied)d applied, %(failed)d failed in %(seconds).2fs '
+        '(%(rows_per_second).0f rows/s)' % stats)
+
+@manager.option('-m', '--merchant', dest='merchant_id', type=int, required=True, help='merchant id')
+@manager.option('-f', '--file', dest='path', required=True, help='csv or ndjson clearing file')
+@manager.option('--format', dest='file_format', choices=FILE_FORMATS,
+                help='file format, guessed from the extension by default')
+@manager.option('--chunk-size', dest='chunk_size', type=int, default=CLEARING_CHUNK_SIZE,
+                help='lines applied per db transaction')
+def clearing_file(merchant_id, path, file_format=None, chunk_size=CLEARING_CHUNK_SIZE):
+  """
+  Apply a merchant's clearing file of capture, reverse and refund lines
+  """
+  merchant = MerchantModel.MerchantModel.get_one_merchant(merchant_id)
+  if not merchant:
+    print('merchant %d not found' % merchant_id)
+    return
+  file_format = file_format or guess_file_format(path)
+
+  def report(line_num, res, status_code):
+    if status_code >= 300:
+      print('line %d: %s (%d)' % (line_num, res['error'], status_code))
+
+  with open(path) as stream:
+    stats = process_clearing_file(merchant, stream, file_format, chunk_size, on_result=report)
+  print('%(lines)d lines, %(applied)d applied, %(failed)d failed in %(seconds).2fs '
+        '(%(rows_per_second).0f rows/s)' % stats)
+
+@manager.option('--cards', dest='cards', type=int, default=10000)
+@manager.option('--merchants', dest='merchants', type=int, default=500)
+@manager.option('--transactions', dest='transactions', type=int, default=1000000)
+@manager.option('--alpha', dest='alpha', type=float, default=1.1,
+                help='power law exponent of the transactions per card and per merchant')
+@manager.option('--hold-share', dest='hold_share', type=float, default=0.05,
+                help='share of merchant transactions left as outstanding holds')
+@manager.option('--days', dest='days', type=int, default=365, help='days of history')
+@manager.option('--chunk-size', dest='chunk_size', type=int, default=SEED_CHUNK_SIZE,
+                help='rows written per db transaction')
+@manager.option('--random-seed', dest='random_seed', type=int, help='make the data reproducible')
+def seed(cards, merchants, transactions, alpha, hold_share, days, chunk_size, random_seed=None):
+  """
+  Generate cards, merchants and a large transaction history
+  """
+  def report(written, total, seconds):
+    print('%d/%d transactions (%.0f rows/s)' % (written, total, written / seconds if seconds else 0))
+
+  try:
+    stats = seed_database(cards, merchants, transactions, alpha=alpha, hold_share=hold_share, days=days,
+                          chunk_size=chunk_size, random_seed=random_seed, progress=report)
+  except ValueError as error:
+    print(error)
+    return
+  print('%(cards)d cards, %(merchants)d merchants and %(transactions)d transactions in %(seconds).2fs '
+        '(%(rows_per_second).0f rows/s)' % stats)
+
+@manager.option('--ttl', dest='ttl', type=float, help='hold lifetime in seconds, HOLD_TTL by default')
+@manager.option('--chunk-size', dest='chunk_size', type=int,
+                help='holds released per db transaction, HOLD_EXPIRY_CHUNK_SIZE by default')
+def expire_holds(ttl=None, chunk_size=None):
+  """
+  Release the holds that were neither captured nor reversed in time
+  """
+  def report(released, seconds):
+    print('%d holds released (%.0f rows/s)' % (released, released / seconds if seconds else 0))
+
+  stats = release_expired_holds(ttl if ttl is not None else app.config['HOLD_TTL'],
+                                chunk_size or app.config['HOLD_EXPIRY_CHUNK_SIZE'], progress=report)
+  print('%(released)d holds released in %(batches)d batches in %(seconds).2fs '
+        '(%(rows_per_second).0f rows/s)' % stats)
+
+@manager.command
+def purge_idempotency_keys():
+  """
+  Delete the stored responses older than IDEMPOTENCY_TTL
+  """
+  store = app.extensions.get('idempotency_store')
+  if store is None:
+    print('idempotency keys are disabled')
+    return
+  print('%d idempotency keys purged' % store.purge_expired())
+
 if __name__ == '__main__':
   manager.run()
\ No newline at end of file
@@ -0,0 +1,36 @@
+"""materialized card balances
+
+Revision ID: 3c1d9a6b2f4e
+Revises: 8ee8005ae261
+Create Date: 2026-10-18 15:02:11.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1d9a6b2f4e'
+down_revision = '8ee8005ae261'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('cards', sa.Column('available', sa.Float(), nullable=False, server_default='0'))
+    op.add_column('cards', sa.Column('blocked', sa.Float(), nullable=False, server_default='0'))
+
+    # backfill from the existing ledger: available is the sum of every
+    # transaction, blocked is the (positive) sum of the outstanding holds
+    op.execute("""
+        UPDATE cards SET
+          available = COALESCE((SELECT SUM(t.amount) FROM transactions t
+                                WHERE t.card_id = cards.id), 0),
+          blocked = COALESCE((SELECT -SUM(t.amount) FROM transactions t
+                              WHERE t.card_id = cards.id AND t.blocked), 0)
+    """)
+
+
+def downgrade():
+    op.drop_column('cards', 'blocked')
+    op.drop_column('cards', 'available')
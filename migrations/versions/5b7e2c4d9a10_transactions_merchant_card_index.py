@@ -0,0 +1,24 @@
+"""transactions merchant card index
+
+Revision ID: 5b7e2c4d9a10
+Revises: 3c1d9a6b2f4e
+Create Date: 2026-10-18 17:41:36.219804
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2c4d9a10'
+down_revision = '3c1d9a6b2f4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_transactions_merchant_id_card_id', 'transactions', ['merchant_id', 'card_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_transactions_merchant_id_card_id', table_name='transactions')
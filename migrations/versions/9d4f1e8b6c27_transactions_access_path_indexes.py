@@ -0,0 +1,31 @@
+"""transactions access path indexes
+
+Revision ID: 9d4f1e8b6c27
+Revises: 5b7e2c4d9a10
+Create Date: 2026-10-18 19:12:05.871342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4f1e8b6c27'
+down_revision = '5b7e2c4d9a10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_transactions_card_id_id', 'transactions', ['card_id', 'id'], unique=False)
+    op.create_index('ix_transactions_card_id_created_at', 'transactions', ['card_id', 'created_at'], unique=False)
+    op.create_index('ix_transactions_merchant_id_id', 'transactions', ['merchant_id', 'id'], unique=False)
+    op.create_index('ix_transactions_holds_created_at', 'transactions', ['created_at'], unique=False,
+                    postgresql_where=sa.text('blocked = true'), sqlite_where=sa.text('blocked = 1'))
+
+
+def downgrade():
+    op.drop_index('ix_transactions_holds_created_at', table_name='transactions')
+    op.drop_index('ix_transactions_merchant_id_id', table_name='transactions')
+    op.drop_index('ix_transactions_card_id_created_at', table_name='transactions')
+    op.drop_index('ix_transactions_card_id_id', table_name='transactions')
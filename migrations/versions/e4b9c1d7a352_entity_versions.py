@@ -0,0 +1,26 @@
+"""entity versions
+
+Revision ID: e4b9c1d7a352
+Revises: c2a7f3e91b58
+Create Date: 2026-10-18 22:11:37.520418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b9c1d7a352'
+down_revision = 'c2a7f3e91b58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('cards', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('merchants', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('merchants', 'version')
+    op.drop_column('cards', 'version')
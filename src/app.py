@@ -1,7 +1,8 @@
 from flask import Flask
 
+from . import cache, hold_expiry, idempotency, metrics, replica, response_cache
 from .config import app_config
-from .models import db
+from .models import db, warm_pool
 from .views.CardView import card_api as card_blueprint
 from .views.MerchantView import merchant_api as merchant_blueprint
 
@@ -15,8 +16,17 @@ def create_app(env_name):
   app.config.from_object(app_config[env_name])
   app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
   db.init_app(app)
+  cache.init_app(app)
+  response_cache.init_app(app)
+  idempotency.init_app(app)
+  replica.init_app(app)
+  if app.config.get('METRICS_ENABLED'):
+    metrics.init_app(app)
 
   app.register_blueprint(card_blueprint, url_prefix='/api/v1/cards')
   app.register_blueprint(merchant_blueprint, url_prefix='/api/v1/merchants')
+  hold_expiry.init_app(app)
+  if app.config.get('DB_POOL_WARM'):
+    warm_pool(app)
 
   return app
@@ -0,0 +1,80 @@
+import csv
+import json
+
+# Readers shared by the funding and clearing files. Files are read one line
+# at a time so memory does not depend on the file size.
+
+CSV_FORMAT = 'csv'
+NDJSON_FORMAT = 'ndjson'
+FILE_FORMATS = (CSV_FORMAT, NDJSON_FORMAT)
+
+def guess_file_format(filename):
+  return CSV_FORMAT if filename and filename.lower().endswith('.csv') else NDJSON_FORMAT
+
+def _decode_lines(lines, bad_lines):
+  """
+  Text of str or utf-8 bytes lines, the numbers of the lines that do not
+  decode are added to bad_lines and their text is replaced
+  """
+  for line_num, line in enumerate(lines, 1):
+    if isinstance(line, bytes):
+      try:
+        line = line.decode('utf-8')
+      except UnicodeDecodeError:
+        bad_lines.add(line_num)
+        line = line.decode('utf-8', 'replace')
+    yield line
+
+def read_records(lines, file_format, parse_csv_row):
+  """
+  Yield (line number, record) from csv lines with a header row or from
+  ndjson lines, str or utf-8 bytes. parse_csv_row turns a csv row dict into
+  a record and raises KeyError, TypeError or ValueError on bad rows.
+  Unparsable lines yield an error message instead of a record
+  """
+  bad_lines = set()
+  lines = _decode_lines(lines, bad_lines)
+  if file_format == CSV_FORMAT:
+    reader = csv.DictReader(lines)
+    fieldnames = reader.fieldnames
+    last = reader.line_num
+    for row in reader:
+      # a row may span several lines
+      first, last = last + 1, reader.line_num
+      if bad_lines.intersection(range(first, last + 1)):
+        yield last, 'line is not valid utf-8'
+        continue
+      try:
+        yield last, parse_csv_row(row)
+      except (KeyError, TypeError, ValueError):
+        yield last, 'line is not a valid %s row' % ','.join(fieldnames)
+    return
+
+  for line_num, line in enumerate(lines, 1):
+    if line_num in bad_lines:
+      yield line_num, 'line is not valid utf-8'
+      continue
+    if not line.strip():
+      continue
+    try:
+      record = json.loads(line)
+    except ValueError:
+      yield line_num, 'line is not valid json'
+      continue
+    if not isinstance(record, dict):
+      yield line_num, 'line is not a json object'
+      continue
+    yield line_num, record
+
+def read_chunks(records, chunk_size):
+  """
+  Group an iterable into lists of at most chunk_size items
+  """
+  chunk = []
+  for record in records:
+    chunk.append(record)
+    if len(chunk) >= chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
@@ -0,0 +1,384 @@
+"""
+Load test of the payment flows.
+
+Starts the app with create_app against a scratch database (the tables are
+dropped and recreated), or drives an already running server with --url, and
+runs a mix of create card, topup, auth_request, capture, reverse and refund
+from concurrent workers. Prints or writes a JSON report with the throughput
+and p50/p95/p99 latency per endpoint, --compare shows the change against a
+previous report.
+
+In the src folder:
+  $ export BENCH_DATABASE_URL=postgresql://127.0.0.1/card_api_db_bench
+  $ python benchmarks/load_test.py --concurrency 16 --duration 30 -o bench.json
+  $ python benchmarks/load_test.py --hot-cards 5 --hot-share 0.8 --compare bench.json
+  $ python benchmarks/load_test.py --concurrency 32 --pool-size 8 --warm 8 --compare bench.json
+"""
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+import argparse
+import datetime
+import json
+import random
+import subprocess
+import threading
+import time
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+
+from src import strings
+from src.funding import MAX_TOPUP_BATCH_SIZE
+
+BENCH_DB = os.getenv('BENCH_DATABASE_URL')
+
+# relative weight of each operation in the mix
+DEFAULT_MIX = {
+  'create_card': 1,
+  'topup': 4,
+  'auth_request': 10,
+  'capture': 5,
+  'reverse': 2,
+  'refund': 1,
+}
+
+class TestClient():
+  """
+  Drive the app in process through the flask test client
+  """
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def post(self, path, data):
+    rv = self.client.post(path, json=data)
+    return rv.status_code, json.loads(rv.get_data().decode() or 'null')
+
+class HttpClient():
+  """
+  Drive a running server over HTTP
+  """
+  def __init__(self, url):
+    self.url = url.rstrip('/') + '/'
+
+  def post(self, path, data):
+    req = urllib_request.Request(self.url + path, data=json.dumps(data).encode(),
+                                 headers={'Content-Type': 'application/json'})
+    try:
+      with urllib_request.urlopen(req) as rv:
+        return rv.status, json.loads(rv.read().decode() or 'null')
+    except HTTPError as e:
+      return e.code, None
+
+class LoadState():
+  """
+  Cards, merchants, outstanding holds and captured sales shared by workers
+  """
+  def __init__(self, card_ids, merchant_ids, hot_cards, hot_share, run_id):
+    self.lock = threading.Lock()
+    self.run_id = run_id
+    self.card_ids = card_ids
+    self.card_nbrs = sorted(card_ids)
+    self.merchant_ids = list(merchant_ids)
+    self.hot_cards = self.card_nbrs[:hot_cards]
+    self.hot_share = hot_share
+    self.holds = []
+    self.sales = []
+    self.next_card = 0
+
+  def pick_card(self):
+    if self.hot_cards and random.random() < self.hot_share:
+      return random.choice(self.hot_cards)
+    return random.choice(self.card_nbrs)
+
+  def new_card_nbr(self):
+    with self.lock:
+      self.next_card += 1
+      return 'B%s%07d' % (self.run_id, self.next_card)
+
+  def add(self, items, item):
+    with self.lock:
+      items.append(item)
+
+  def pop(self, items):
+    with self.lock:
+      if not items:
+        return None
+      return items.pop(random.randrange(len(items)))
+
+class Stats():
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = {}
+    self.statuses = {}
+
+  def record(self, endpoint, status_code, seconds):
+    with self.lock:
+      self.latencies.setdefault(endpoint, []).append(seconds)
+      statuses = self.statuses.setdefault(endpoint, {})
+      statuses[status_code] = statuses.get(status_code, 0) + 1
+
+def percentile(sorted_values, share):
+  if not sorted_values:
+    return 0
+  index = min(len(sorted_values) - 1, int(round(share * (len(sorted_values) - 1))))
+  return sorted_values[index]
+
+def summarize(latencies, statuses, elapsed):
+  latencies = sorted(latencies)
+  errors = sum([count for status, count in statuses.items() if status >= 500])
+  return {
+    'requests': len(latencies),
+    'errors': errors,
+    'statuses': dict([(str(k), v) for k, v in statuses.items()]),
+    'throughput': len(latencies) / elapsed if elapsed else 0,
+    'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else 0,
+    'p50_ms': 1000 * percentile(latencies, 0.50),
+    'p95_ms': 1000 * percentile(latencies, 0.95),
+    'p99_ms': 1000 * percentile(latencies, 0.99),
+  }
+
+def run_operation(client, state, stats, operation):
+  """
+  Run one operation of the mix, operations without a target (no hold to
+  capture yet) fall back to an auth request
+  """
+  if operation in ('capture', 'reverse'):
+    hold = state.pop(state.holds)
+    if not hold:
+      operation = 'auth_request'
+  elif operation == 'refund':
+    sale = state.pop(state.sales)
+    if not sale:
+      operation = 'auth_request'
+
+  start = time.time()
+  if operation == 'create_card':
+    card_nbr = state.new_card_nbr()
+    status_code, res = client.post(strings.CARD_ENDPOINT,
+                                   {strings.NAME_KEY: 'Bench user', strings.CARD_NBR_KEY: card_nbr})
+  elif operation == 'topup':
+    card_id = state.card_ids[state.pick_card()]
+    status_code, res = client.post('%s%d/topup' % (strings.CARD_ENDPOINT, card_id), {strings.AMOUNT_KEY: 100})
+  elif operation == 'auth_request':
+    card_nbr = state.pick_card()
+    merchant_id = random.choice(state.merchant_ids)
+    amount = random.randint(1, 20)
+    status_code, res = client.post('%s%d/auth_request' % (strings.MERCHANT_ENDPOINT, merchant_id),
+                                   {strings.CARD_NBR_KEY: card_nbr, strings.AMOUNT_KEY: amount})
+    if status_code == 201:
+      state.add(state.holds, (merchant_id, res['Transaction']['id'], card_nbr, amount))
+  elif operation == 'capture':
+    merchant_id, transaction_id, card_nbr, amount = hold
+    status_code, res = client.post('%s%d/capture' % (strings.MERCHANT_ENDPOINT, merchant_id),
+                                   {strings.TRANSACTIONS_ID_KEY: transaction_id, strings.AMOUNT_KEY: amount})
+    if status_code == 200:
+      state.add(state.sales, (merchant_id, card_nbr, amount))
+  elif operation == 'reverse':
+    merchant_id, transaction_id, card_nbr, amount = hold
+    status_code, res = client.post('%s%d/reverse' % (strings.MERCHANT_ENDPOINT, merchant_id),
+                                   {strings.TRANSACTIONS_ID_KEY: transaction_id, strings.AMOUNT_KEY: amount})
+  elif operation == 'refund':
+    merchant_id, card_nbr, amount = sale
+    status_code, res = client.post('%s%d/refund' % (strings.MERCHANT_ENDPOINT, merchant_id),
+                                   {strings.CARD_NBR_KEY: card_nbr, strings.AMOUNT_KEY: amount})
+  else:
+    raise ValueError('unknown operation %s' % operation)
+  stats.record(operation, status_code, time.time() - start)
+
+def new_run_id():
+  """
+  Digits of the current time in ms, part of the card numbers of a run so
+  runs against the same server do not collide
+  """
+  return '%08d' % (int(time.time() * 1000) % 10**8)
+
+def setup(client, cards, merchants, balance, run_id):
+  card_ids = {}
+  for i in range(cards):
+    card_nbr = 'C%s%07d' % (run_id, i)
+    status_code, res = client.post(strings.CARD_ENDPOINT, {strings.NAME_KEY: 'Bench user %d' % i,
+                                                            strings.CARD_NBR_KEY: card_nbr})
+    if status_code != 201:
+      raise RuntimeError('could not create card %s: %s' % (card_nbr, res))
+    card_ids[card_nbr] = res['Card']['id']
+  card_nbrs = list(card_ids)
+  for start in range(0, len(card_nbrs), MAX_TOPUP_BATCH_SIZE):
+    status_code, res = client.post(strings.CARD_ENDPOINT + 'topup/batch',
+                                   [{strings.CARD_NBR_KEY: x, strings.AMOUNT_KEY: balance}
+                                    for x in card_nbrs[start:start + MAX_TOPUP_BATCH_SIZE]])
+    if status_code != 200:
+      raise RuntimeError('could not top up the cards: %s' % res)
+    failed = [x for x in res['Results'] if x['status'] != 201]
+    if failed:
+      raise RuntimeError('could not top up %d cards: %s' % (len(failed), failed[0]))
+
+  merchant_ids = []
+  for i in range(merchants):
+    status_code, res = client.post(strings.MERCHANT_ENDPOINT,
+                                   {strings.NAME_KEY: 'Bench merchant %d %f' % (i, time.time())})
+    if status_code != 201:
+      raise RuntimeError('could not create merchant: %s' % res)
+    merchant_ids.append(res['Merchant']['id'])
+  return card_ids, merchant_ids
+
+def database_settings(args):
+  """
+  The DB_* settings overridden from the command line
+  """
+  settings = {
+    'DB_POOL_SIZE': args.pool_size,
+    'DB_MAX_OVERFLOW': args.max_overflow,
+    'DB_POOL_TIMEOUT': args.pool_timeout,
+    'DB_STATEMENT_TIMEOUT': args.statement_timeout,
+    'DB_POOL_WARM': args.warm,
+    'DB_PGBOUNCER': args.pgbouncer or None,
+  }
+  return dict([(key, value) for key, value in settings.items() if value is not None])
+
+def create_bench_app(database_url, settings=None):
+  from src.app import create_app
+  from src.models import db, warm_pool
+  app = create_app(os.getenv('FLASK_ENV') or 'production')
+  app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+  app.config.update(settings or {})
+  app.debug = False
+  with app.app_context():
+    db.drop_all()
+    db.create_all()
+    # start from a cold pool like a restarted worker, then warm it if asked
+    db.get_engine().dispose()
+  warm_pool(app)
+  return app
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def run(args, make_client):
+  mix = dict(DEFAULT_MIX)
+  mix.update(args.mix or [])
+  operations = [name for name, weight in mix.items() for i in range(weight)]
+
+  run_id = new_run_id()
+  card_ids, merchant_ids = setup(make_client(), args.cards, args.merchants, args.balance, run_id)
+  state = LoadState(card_ids, merchant_ids, args.hot_cards, args.hot_share, run_id)
+  stats = Stats()
+  deadline = time.time() + args.duration
+
+  def worker():
+    client = make_client()
+    done = 0
+    while time.time() < deadline and (not args.requests or done < args.requests):
+      run_operation(client, state, stats, random.choice(operations))
+      done += 1
+
+  workers = [threading.Thread(target=worker) for i in range(args.concurrency)]
+  start = time.time()
+  for thread in workers:
+    thread.start()
+  for thread in workers:
+    thread.join()
+  elapsed = time.time() - start
+
+  all_latencies = [x for latencies in stats.latencies.values() for x in latencies]
+  all_statuses = {}
+  for statuses in stats.statuses.values():
+    for status, count in statuses.items():
+      all_statuses[status] = all_statuses.get(status, 0) + count
+  return {
+    'meta': {
+      'commit': git_commit(),
+      'date': datetime.datetime.utcnow().isoformat(),
+      'target': args.url or 'in-process',
+      'concurrency': args.concurrency,
+      'duration': elapsed,
+      'cards': args.cards,
+      'merchants': args.merchants,
+      'hot_cards': args.hot_cards,
+      'hot_share': args.hot_share,
+      'mix': mix,
+      'database': database_settings(args),
+    },
+    'total': summarize(all_latencies, all_statuses, elapsed),
+    'endpoints': dict([(name, summarize(stats.latencies[name], stats.statuses[name], elapsed))
+                       for name in sorted(stats.latencies)]),
+  }
+
+def compare(report, previous):
+  """
+  Lines with the relative change of throughput and latencies per endpoint
+  """
+  lines = []
+  for name, current in sorted(report['endpoints'].items()) + [('total', report['total'])]:
+    before = previous['total'] if name == 'total' else previous['endpoints'].get(name)
+    if not before:
+      continue
+    changes = []
+    for key in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms'):
+      if before[key]:
+        changes.append('%s %+.1f%%' % (key, 100.0 * (current[key] - before[key]) / before[key]))
+    lines.append('%-14s %s' % (name, ', '.join(changes)))
+  return lines
+
+def mix_item(value):
+  """
+  An operation=weight item of --mix
+  """
+  name, sep, weight = value.partition('=')
+  if name not in DEFAULT_MIX:
+    raise argparse.ArgumentTypeError('unknown operation %s, choose from %s' % (name, ', '.join(DEFAULT_MIX)))
+  try:
+    return name, int(weight)
+  except ValueError:
+    raise argparse.ArgumentTypeError('the weight of %s must be an integer' % name)
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description='Load test of the payment flows')
+  parser.add_argument('--url', help='base url of a running server, the app is started in process otherwise')
+  parser.add_argument('--database-url', default=BENCH_DB,
+                      help='scratch database for the in process app, dropped and recreated (BENCH_DATABASE_URL)')
+  parser.add_argument('-c', '--concurrency', type=int, default=8, help='concurrent workers')
+  parser.add_argument('-d', '--duration', type=float, default=10, help='seconds to run')
+  parser.add_argument('-n', '--requests', type=int, default=0, help='max requests per worker')
+  parser.add_argument('--cards', type=int, default=100)
+  parser.add_argument('--merchants', type=int, default=10)
+  parser.add_argument('--balance', type=float, default=10000, help='initial top up of every card')
+  parser.add_argument('--hot-cards', type=int, default=0, help='number of cards receiving --hot-share of the traffic')
+  parser.add_argument('--hot-share', type=float, default=0.5)
+  parser.add_argument('--mix', nargs='*', type=mix_item, help='operation weights, e.g. auth_request=20 refund=0')
+  parser.add_argument('--pool-size', type=int, help='DB_POOL_SIZE of the in process app')
+  parser.add_argument('--max-overflow', type=int, help='DB_MAX_OVERFLOW of the in process app')
+  parser.add_argument('--pool-timeout', type=float, help='DB_POOL_TIMEOUT of the in process app')
+  parser.add_argument('--statement-timeout', type=int, help='DB_STATEMENT_TIMEOUT (ms) of the in process app')
+  parser.add_argument('--warm', type=int, help='connections opened before the run (DB_POOL_WARM)')
+  parser.add_argument('--pgbouncer', action='store_true', help='DB_PGBOUNCER mode, point --database-url at PgBouncer')
+  parser.add_argument('-o', '--output', help='write the JSON report to this file')
+  parser.add_argument('--compare', help='previous JSON report to compare with')
+  return parser.parse_args(argv)
+
+def main(argv=None):
+  args = parse_args(argv)
+  if args.url:
+    make_client = lambda: HttpClient(args.url)
+  else:
+    if not args.database_url:
+      sys.exit('set BENCH_DATABASE_URL or --database-url to a scratch database')
+    app = create_bench_app(args.database_url, database_settings(args))
+    make_client = lambda: TestClient(app)
+
+  report = run(args, make_client)
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(output)
+  else:
+    print(output)
+  if args.compare:
+    with open(args.compare) as f:
+      for line in compare(report, json.load(f)):
+        print(line, file=sys.stderr)
+
+if __name__ == '__main__':
+  main()
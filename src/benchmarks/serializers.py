@@ -0,0 +1,93 @@
+"""
+Micro-benchmark of the response serialization per schema.
+
+Compares schema.dump followed by flask.json.dumps with the compiled dump
+functions and prebuilt encoder of src.serializers on in memory objects,
+checks that both produce the same bytes and prints a JSON report.
+
+In the src folder:
+  $ python benchmarks/serializers.py --cards 100 --transactions 20
+"""
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+import argparse
+import json
+import timeit
+
+from flask import Flask, json as flask_json
+
+from src import strings
+from src.models.CardModel import CardModel, CardSchema
+from src.models.MerchantModel import MerchantModel, MerchantSchema
+from src.models.TransactionModel import TransactionModel, TransactionSchema
+from src.serializers import dump, to_json
+
+def sample_transactions(count, card_id, merchant_id):
+  transactions = []
+  for i in range(count):
+    transaction = TransactionModel.generate_transaction(card_id, merchant_id if i % 3 else None,
+                                                        -1.5 * i if i % 3 else 100.0, i % 5 == 0)
+    transaction.id = card_id * count + i
+    transactions.append(transaction)
+  return transactions
+
+def sample_cards(count, transactions):
+  cards = []
+  for i in range(count):
+    card = CardModel({strings.NAME_KEY: 'Bench user %d' % i, strings.CARD_NBR_KEY: '%016d' % i})
+    card.id = i + 1
+    card.available = 100.5 * i
+    card.blocked = 3.25 * i
+    card.transactions = sample_transactions(transactions, card.id, 1)
+    cards.append(card)
+  return cards
+
+def sample_merchants(count, transactions):
+  merchants = []
+  for i in range(count):
+    merchant = MerchantModel({strings.NAME_KEY: 'Bench merchant é %d' % i})
+    merchant.id = i + 1
+    merchant.transactions = sample_transactions(transactions, i + 1, merchant.id)
+    merchants.append(merchant)
+  return merchants
+
+def measure(schema, objs, repeat):
+  """
+  Best time per call of both serialization paths for a list of objs
+  """
+  baseline = lambda: flask_json.dumps(schema.dump(objs, many=True).data)
+  fast = lambda: to_json(dump(schema, objs, many=True))
+  if baseline() != fast():
+    raise AssertionError('compiled output differs for %s' % type(schema).__name__)
+  baseline_seconds = min(timeit.repeat(baseline, number=1, repeat=repeat))
+  fast_seconds = min(timeit.repeat(fast, number=1, repeat=repeat))
+  return {
+    'objects': len(objs),
+    'baseline_ms': 1000 * baseline_seconds,
+    'compiled_ms': 1000 * fast_seconds,
+    'speedup': baseline_seconds / fast_seconds if fast_seconds else 0,
+  }
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Serialization micro-benchmark')
+  parser.add_argument('--cards', type=int, default=100, help='objects per dump')
+  parser.add_argument('--transactions', type=int, default=20, help='nested transactions per card or merchant')
+  parser.add_argument('-r', '--repeat', type=int, default=20)
+  args = parser.parse_args(argv)
+
+  app = Flask(__name__)
+  with app.app_context():
+    cards = sample_cards(args.cards, args.transactions)
+    report = {
+      'CardSchema': measure(CardSchema(), cards, args.repeat),
+      'CardSchema(exclude=transactions)': measure(CardSchema(exclude=(strings.TRANSACTIONS_KEY,)),
+                                                  cards, args.repeat),
+      'MerchantSchema': measure(MerchantSchema(), sample_merchants(args.cards, args.transactions), args.repeat),
+      'TransactionSchema': measure(TransactionSchema(), [x for card in cards for x in card.transactions],
+                                   args.repeat),
+    }
+  print(json.dumps(report, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+from src.metrics import registry
+
+class LRUCache():
+  """
+  Bounded, thread safe LRU cache with an optional TTL and hit/miss
+  counters. A max_size of 0 disables it. None values are not cached
+  """
+  def __init__(self, name, max_size=0, ttl=None):
+    self.name = name
+    self.lock = threading.Lock()
+    self.configure(max_size, ttl)
+
+  def configure(self, max_size, ttl=None):
+    with self.lock:
+      self.max_size = max_size
+      self.ttl = ttl
+      self.entries = OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+  def get(self, key):
+    if not self.max_size:
+      return None
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None or (self.ttl and entry[1] < time.monotonic()):
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def set(self, key, value):
+    if not self.max_size or value is None:
+      return
+    expires = time.monotonic() + self.ttl if self.ttl else None
+    with self.lock:
+      self.entries[key] = (value, expires)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+  def delete(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      return {'size': len(self.entries), 'max_size': self.max_size,
+              'hits': self.hits, 'misses': self.misses}
+
+# card_nbr -> card id and merchant id -> True, for the auth and refund
+# lookups. Other worker processes only see a delete when the entry expires
+card_ids = LRUCache('card_ids')
+merchants = LRUCache('merchants')
+LOOKUP_CACHES = (card_ids, merchants)
+
+CACHE_HITS = registry.counter('lookup_cache_hits_total', 'Lookup cache hits by cache')
+CACHE_MISSES = registry.counter('lookup_cache_misses_total', 'Lookup cache misses by cache')
+CACHE_SIZE = registry.gauge('lookup_cache_entries', 'Lookup cache entries by cache')
+
+def _collect():
+  for cache in LOOKUP_CACHES:
+    stats = cache.stats()
+    labels = (('cache', cache.name),)
+    CACHE_HITS.set(labels, stats['hits'])
+    CACHE_MISSES.set(labels, stats['misses'])
+    CACHE_SIZE.set(labels, stats['size'])
+
+registry.add_collector(_collect)
+
+def init_app(app):
+  """
+  Size the lookup caches from the app config, this also empties them
+  """
+  max_size = app.config.get('LOOKUP_CACHE_SIZE', 0) if app.config.get('LOOKUP_CACHE_ENABLED') else 0
+  for cache in LOOKUP_CACHES:
+    cache.configure(max_size, app.config.get('LOOKUP_CACHE_TTL'))
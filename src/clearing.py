@@ -0,0 +1,106 @@
+import time
+from sqlalchemy.exc import SQLAlchemyError
+from src import ledger, strings
+from src.batch_files import read_chunks, read_records
+from src.models import unit_of_work
+from src.models.CardModel import CardModel
+from src.models.TransactionModel import TransactionModel
+
+CLEARING_CHUNK_SIZE = 500
+
+def _parse_clearing_csv_row(row):
+  item = {strings.OPERATION_KEY: row[strings.OPERATION_KEY],
+          strings.AMOUNT_KEY: float(row[strings.AMOUNT_KEY])}
+  if row.get(strings.TRANSACTIONS_ID_KEY):
+    item[strings.TRANSACTIONS_ID_KEY] = int(row[strings.TRANSACTIONS_ID_KEY])
+  if row.get(strings.CARD_NBR_KEY):
+    item[strings.CARD_NBR_KEY] = row[strings.CARD_NBR_KEY]
+  return item
+
+def check_clearing_line(item):
+  """
+  Validate the operation and the fields of a line before anything reads
+  the db, returns (error, status code) or None
+  """
+  operation = item.get(strings.OPERATION_KEY)
+  if operation in (strings.CAPTURE_OPERATION, strings.REVERSE_OPERATION):
+    return ledger.check_transaction_fields(item)
+  if operation == strings.REFUND_OPERATION:
+    return ledger.check_card_request(item)
+  return {'error': 'type must be one of capture, reverse or refund'}, 400
+
+def apply_clearing_line(merchant, item, cards):
+  """
+  Apply one capture, reverse or refund line with the same rules as the
+  merchant endpoints, cards maps the chunk's card numbers to cards
+  """
+  operation = item.get(strings.OPERATION_KEY)
+  if operation == strings.CAPTURE_OPERATION:
+    return ledger.capture(merchant.id, item)
+  if operation == strings.REVERSE_OPERATION:
+    return ledger.reverse(merchant.id, item)
+  if operation == strings.REFUND_OPERATION:
+    error = ledger.check_card_request(item)
+    if error:
+      return error
+    card = cards.get(item[strings.CARD_NBR_KEY])
+    if not card:
+      return {'error': 'card number was not found'}, 404
+    return ledger.refund(merchant.id, card.id, item[strings.AMOUNT_KEY])
+  return {'error': 'type must be one of capture, reverse or refund'}, 400
+
+def apply_clearing_chunk(merchant, chunk):
+  """
+  Apply a chunk of (line number, item or parse error) in one db transaction,
+  returns one (response, status code) per line. Invalid lines are answered
+  400 on their own, if the db fails the whole chunk is rolled back and
+  reported as failed
+  """
+  errors = [({'error': item}, 400) if not isinstance(item, dict) else check_clearing_line(item)
+            for line_num, item in chunk]
+  items = [item for (line_num, item), error in zip(chunk, errors) if not error]
+  # load the chunk's holds and cards up front, the per line lookups then
+  # hit the session instead of the database
+  transaction_ids = set([x[strings.TRANSACTIONS_ID_KEY] for x in items
+                         if x[strings.OPERATION_KEY] != strings.REFUND_OPERATION])
+  card_nbrs = set([x[strings.CARD_NBR_KEY] for x in items
+                   if x[strings.OPERATION_KEY] == strings.REFUND_OPERATION])
+  try:
+    with unit_of_work():
+      if transaction_ids:
+        TransactionModel.get_transactions(transaction_ids)
+      cards = {}
+      if card_nbrs:
+        cards = dict([(card.card_nbr, card) for card in CardModel.get_cards_by_card_nbrs(card_nbrs)])
+
+      results = []
+      for (line_num, item), error in zip(chunk, errors):
+        results.append(error or apply_clearing_line(merchant, item, cards))
+  except (SQLAlchemyError, TypeError, ValueError):
+    results = [({'error': 'the chunk could not be applied and was rolled back'}, 500) for x in chunk]
+  return results
+
+def process_clearing_file(merchant, stream, file_format, chunk_size=CLEARING_CHUNK_SIZE, on_result=None):
+  """
+  Apply a clearing file of capture, reverse and refund lines for a
+  merchant chunk by chunk. on_result(line number, response, status code)
+  is called for every line. Returns a stats dict
+  """
+  stats = {'lines': 0, 'applied': 0, 'failed': 0}
+  start = time.time()
+
+  records = read_records(stream, file_format, _parse_clearing_csv_row)
+  for chunk in read_chunks(records, chunk_size):
+    results = apply_clearing_chunk(merchant, chunk)
+    for (line_num, item), (res, status_code) in zip(chunk, results):
+      stats['lines'] += 1
+      if status_code < 300:
+        stats['applied'] += 1
+      else:
+        stats['failed'] += 1
+      if on_result:
+        on_result(line_num, res, status_code)
+
+  stats['seconds'] = time.time() - start
+  stats['rows_per_second'] = stats['lines'] / stats['seconds'] if stats['seconds'] else 0
+  return stats
@@ -0,0 +1,33 @@
+import hashlib
+from flask import request, Response
+from werkzeug.http import quote_etag
+from src.response_cache import responses
+from src.serializers import to_json
+
+# Conditional GETs of cards and merchants. The strong ETag is made of the
+# entity's version, a tuple of counters that changes with every write to the
+# entity, and of the query string since it selects the representation. The
+# version also keys the response cache, so a match or a cached body is
+# answered without loading the transactions
+
+def entity_etag(version):
+  args = sorted(request.args.items(multi=True))
+  digest = hashlib.sha1(repr(args).encode()).hexdigest()[:16]
+  return '%s-%s' % ('.'.join([str(x) for x in version]), digest)
+
+def entity_response(kind, entity, version, render):
+  """
+  Response of a loaded card or merchant at version: 304 when If-None-Match
+  has its current ETag, else the body cached for its version or
+  render(entity). The version is read before render so the body is never
+  older than its ETag
+  """
+  etag = entity_etag(version)
+  headers = {'ETag': quote_etag(etag)}
+  if request.if_none_match.contains_weak(etag):
+    return Response(status=304, headers=headers)
+  body = responses.get(kind, entity.id, version, etag)
+  if body is None:
+    body = to_json(render(entity)).encode()
+    responses.set(kind, entity.id, version, etag, body)
+  return Response(body, status=200, mimetype='application/json', headers=headers)
@@ -2,21 +2,52 @@
 
 import os
 
-class Development():
+class Config():
   """
-  Development environment configuration
+  Configuration shared by the environments, read from the environment
   """
-  DEBUG = True
   TESTING = False
   SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
+  SQLALCHEMY_BINDS = {'replica': os.getenv('REPLICA_DATABASE_URL')} if os.getenv('REPLICA_DATABASE_URL') else {}
+  READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', 5))
+  METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true') == 'true'
+  LOOKUP_CACHE_ENABLED = os.getenv('LOOKUP_CACHE_ENABLED', 'true') == 'true'
+  LOOKUP_CACHE_SIZE = int(os.getenv('LOOKUP_CACHE_SIZE', 10000))
+  LOOKUP_CACHE_TTL = float(os.getenv('LOOKUP_CACHE_TTL', 60))
+  RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+  RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64*1024*1024))
+  RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 300))
+  HOLD_TTL = float(os.getenv('HOLD_TTL', 7*24*3600))
+  HOLD_EXPIRY_CHUNK_SIZE = int(os.getenv('HOLD_EXPIRY_CHUNK_SIZE', 1000))
+  HOLD_SWEEP_INTERVAL = float(os.getenv('HOLD_SWEEP_INTERVAL', 0))
+  IDEMPOTENCY_STORE = os.getenv('IDEMPOTENCY_STORE', 'memory')
+  IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 24*3600))
+  IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 10))
+  IDEMPOTENCY_LEASE = float(os.getenv('IDEMPOTENCY_LEASE', 300))
+  DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+  DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 5))
+  DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+  DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+  DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true') == 'true'
+  DB_POOL_WARM = int(os.getenv('DB_POOL_WARM', 0))
+  DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', 5))
+  DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'false') == 'true'
 
-class Production():
+class Development(Config):
+  """
+  Development environment configuration
+  """
+  DEBUG = True
+  DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+  DB_LOCK_TIMEOUT = int(os.getenv('DB_LOCK_TIMEOUT', 0))
+
+class Production(Config):
   """
   Production environment configurations
   """
   DEBUG = False
-  TESTING = False
-  SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
+  DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 30000))
+  DB_LOCK_TIMEOUT = int(os.getenv('DB_LOCK_TIMEOUT', 2000))
 
 app_config = {
     'development': Development,
@@ -0,0 +1,40 @@
+from functools import lru_cache
+from marshmallow import fields
+from src import strings
+
+# Sparse fieldsets: ?fields=id,amount limits a response to some attributes
+# and ?include=transactions adds the nested relationships. Without either
+# the view's default fields are dumped. The views load a relationship only
+# when it is part of the fieldset
+
+def _split(value):
+  return [x.strip() for x in value.split(',') if x.strip()]
+
+def get_fieldset(args, schema_class, default_includes=()):
+  """
+  Read ?fields= and ?include= for a schema, returns (only, error) where
+  only is the sorted tuple of the fields to dump
+  """
+  declared = schema_class._declared_fields
+  relations = [name for name, field in declared.items() if isinstance(field, fields.Nested)]
+  attributes = [name for name in declared if name not in relations]
+
+  includes = _split(args.get(strings.INCLUDE_KEY, ''))
+  unknown = [x for x in includes if x not in relations]
+  if unknown:
+    return None, {'error': '"include" can only name %s' % ', '.join(sorted(relations))}
+  requested = _split(args.get(strings.FIELDS_KEY, ''))
+  unknown = [x for x in requested if x not in declared]
+  if unknown:
+    return None, {'error': 'unknown fields: %s' % ', '.join(unknown)}
+
+  if not requested and strings.INCLUDE_KEY not in args:
+    return tuple(sorted(attributes + list(default_includes))), None
+  return tuple(sorted(set((requested or attributes) + includes))), None
+
+@lru_cache(maxsize=256)
+def fieldset_schema(schema_class, only):
+  """
+  The schema instance of a fieldset, shared so its dump is compiled once
+  """
+  return schema_class(only=only)
@@ -0,0 +1,105 @@
+import math
+import time
+from src import strings
+from src.batch_files import read_chunks, read_records
+from src.models import db
+from src.models.CardModel import CardModel
+from src.models.TransactionModel import TransactionModel
+
+FUNDING_CHUNK_SIZE = 1000
+MAX_TOPUP_BATCH_SIZE = 10000
+
+def top_up_message(card_id, card_nbr, amount):
+  return 'Card with id: %s and number: %s has been topped up with %s' % (card_id, card_nbr, amount)
+
+def _validate_top_up(item):
+  """
+  Validate a card_nbr/amount top up, returns (error, status code) or None
+  """
+  if not isinstance(item, dict) or strings.CARD_NBR_KEY not in item:
+    return {'error': 'Missing attribute "card_nbr"'}, 400
+  if not isinstance(item[strings.CARD_NBR_KEY], str):
+    return {'error': 'card_nbr must be a string'}, 400
+  if strings.AMOUNT_KEY not in item:
+    return {'error': 'Missing attribute "amount"'}, 400
+  amount = item[strings.AMOUNT_KEY]
+  # json and float() both read nan and infinity
+  if not isinstance(amount, (int, float)) or isinstance(amount, bool) or not math.isfinite(amount):
+    return {'error': 'amount must be a number'}, 400
+  if item[strings.AMOUNT_KEY] <= 0:
+    return {'error': 'You cannot topup negative values'}, 403
+  return None
+
+def top_up_chunk(items):
+  """
+  Top up a chunk of {card_nbr, amount} in one db transaction: the cards are
+  resolved with one query, the transactions written with one executemany
+  and each card balance updated once. Returns one (response, status code)
+  per item
+  """
+  errors = [_validate_top_up(x) for x in items]
+  card_nbrs = set([x[strings.CARD_NBR_KEY] for x, error in zip(items, errors) if not error])
+  cards = {}
+  if card_nbrs:
+    cards = dict([(card.card_nbr, card) for card in CardModel.get_cards_by_card_nbrs(card_nbrs)])
+
+  results = []
+  rows = []
+  totals = {}
+  for item, error in zip(items, errors):
+    if error:
+      results.append(error)
+      continue
+    card = cards.get(item[strings.CARD_NBR_KEY])
+    if not card:
+      results.append(({'error': 'card not found'}, 404))
+      continue
+    amount = item[strings.AMOUNT_KEY]
+    rows.append(TransactionModel.generate_transaction_row(card.id, None, amount, False))
+    totals[card.id] = totals.get(card.id, 0) + amount
+    results.append(({'message': top_up_message(card.id, card.card_nbr, amount)}, 201))
+
+  # in id order so concurrent chunks sharing cards cannot deadlock
+  for card_id, amount in sorted(totals.items()):
+    CardModel.update_balance(card_id, amount)
+  TransactionModel.insert_many(rows)
+  db.session.commit()
+  return results
+
+def _parse_funding_csv_row(row):
+  return {strings.CARD_NBR_KEY: row[strings.CARD_NBR_KEY],
+          strings.AMOUNT_KEY: float(row[strings.AMOUNT_KEY])}
+
+def process_funding_file(stream, file_format, chunk_size=FUNDING_CHUNK_SIZE, on_failure=None):
+  """
+  Apply a funding file chunk by chunk, on_failure(line number, error) is
+  called for each line that was not applied. Returns a stats dict
+  """
+  stats = {'lines': 0, 'applied': 0, 'failed': 0}
+  start = time.time()
+
+  def fail(line_num, error):
+    stats['failed'] += 1
+    if on_failure:
+      on_failure(line_num, error)
+
+  def flush(chunk):
+    results = iter(top_up_chunk([item for line_num, item in chunk if isinstance(item, dict)]))
+    for line_num, item in chunk:
+      if not isinstance(item, dict):
+        fail(line_num, item)
+        continue
+      res, status_code = next(results)
+      if status_code == 201:
+        stats['applied'] += 1
+      else:
+        fail(line_num, res['error'])
+
+  records = read_records(stream, file_format, _parse_funding_csv_row)
+  for chunk in read_chunks(records, chunk_size):
+    stats['lines'] += len(chunk)
+    flush(chunk)
+
+  stats['seconds'] = time.time() - start
+  stats['rows_per_second'] = stats['lines'] / stats['seconds'] if stats['seconds'] else 0
+  return stats
@@ -0,0 +1,93 @@
+import datetime
+import random
+import threading
+import time
+from sqlalchemy.exc import OperationalError
+from src import ledger
+from src.metrics import registry
+from src.models import db
+from src.models.TransactionModel import TransactionModel
+
+HOLD_EXPIRY_CHUNK_SIZE = 1000
+SWEEP_MAX_ATTEMPTS = 5
+SWEEP_RETRY_DELAY = 0.05
+
+HOLDS_EXPIRED = registry.counter('holds_expired_total', 'Expired holds released by the sweeper')
+SWEEP_SECONDS = registry.counter('hold_sweep_seconds_total', 'Time spent releasing expired holds')
+
+def _release_chunk(cutoff, chunk_size):
+  """
+  Release up to chunk_size holds created before cutoff, oldest first, in one
+  short db transaction. Holds locked by a running capture or reverse are
+  skipped. Returns (holds selected, holds released)
+  """
+  ids = [x[0] for x in db.session.query(TransactionModel.id)
+         .filter(TransactionModel.blocked == True, TransactionModel.created_at < cutoff)
+         .order_by(TransactionModel.created_at).limit(chunk_size)
+         .with_for_update(skip_locked=True)]
+  if not ids:
+    db.session.rollback()
+    return 0, 0
+  released = ledger.release_holds(TransactionModel.id.in_(ids))
+  db.session.commit()
+  return len(ids), released
+
+def release_expired_holds(ttl, chunk_size=HOLD_EXPIRY_CHUNK_SIZE, now=None, progress=None):
+  """
+  Release the holds older than ttl seconds chunk_size at a time, one db
+  transaction per chunk so a hot card is only locked for one chunk.
+  progress(released, seconds) is called after each chunk. Returns stats
+  """
+  start = time.time()
+  cutoff = (now or datetime.datetime.utcnow()) - datetime.timedelta(seconds=ttl)
+  released = 0
+  batches = 0
+  while True:
+    for attempt in range(1, SWEEP_MAX_ATTEMPTS + 1):
+      try:
+        selected, chunk_released = _release_chunk(cutoff, chunk_size)
+        break
+      except OperationalError:
+        db.session.rollback()
+        if attempt == SWEEP_MAX_ATTEMPTS:
+          raise
+        time.sleep(random.uniform(0, SWEEP_RETRY_DELAY * attempt))
+    if not selected:
+      break
+    batches += 1
+    released += chunk_released
+    HOLDS_EXPIRED.inc((), chunk_released)
+    if progress:
+      progress(released, time.time() - start)
+
+  seconds = time.time() - start
+  SWEEP_SECONDS.inc((), seconds)
+  return {'released': released, 'batches': batches, 'seconds': seconds,
+          'rows_per_second': released / seconds if seconds else 0}
+
+def _sweep_forever(app, interval):
+  while True:
+    time.sleep(interval)
+    with app.app_context():
+      try:
+        stats = release_expired_holds(app.config['HOLD_TTL'], app.config['HOLD_EXPIRY_CHUNK_SIZE'])
+        if stats['released']:
+          app.logger.info('Released %(released)d expired holds in %(seconds).2fs '
+                          '(%(rows_per_second).0f rows/s)', stats)
+      except Exception:
+        db.session.rollback()
+        app.logger.exception('Hold expiry sweep failed')
+      finally:
+        db.session.remove()
+
+def init_app(app):
+  """
+  Start the in-process sweeper when HOLD_SWEEP_INTERVAL is set
+  """
+  interval = app.config.get('HOLD_SWEEP_INTERVAL')
+  if not interval:
+    return None
+  thread = threading.Thread(target=_sweep_forever, args=(app, interval), name='hold-expiry')
+  thread.daemon = True
+  thread.start()
+  return thread
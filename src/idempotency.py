@@ -0,0 +1,253 @@
+import datetime
+import hashlib
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from flask import current_app, request, Response
+from sqlalchemy.exc import IntegrityError
+from src import strings
+from src.metrics import registry
+from src.models import db
+from src.models.IdempotencyKeyModel import IdempotencyKeyModel
+from src.serializers import custom_response
+
+# Replay of mutating requests retried with the same Idempotency-Key header.
+# The first request reserves the key and its response is stored, repeats
+# get the stored response and concurrent duplicates wait for it instead of
+# doing the work again. 5xx responses and exceptions free the key. A key
+# in progress for longer than the lease is taken over, its worker is deemed
+# dead and can no longer complete it
+
+MAX_KEY_LENGTH = 255
+DB_POLL_INTERVAL = 0.05
+MEMORY_STORE_MAX_SIZE = 100000
+# bodies up to this size are hashed in memory, larger ones are spooled to disk
+BODY_SPOOL_SIZE = 1024*1024
+BODY_READ_SIZE = 64*1024
+
+NEW = 'new'
+REPLAY = 'replay'
+IN_PROGRESS = 'in_progress'
+MISMATCH = 'mismatch'
+
+StoredResponse = namedtuple('StoredResponse', ['status_code', 'body', 'content_type'])
+
+REPLAYS = registry.counter('idempotent_replays_total', 'Responses replayed for a repeated Idempotency-Key')
+
+class MemoryStore():
+  """
+  Keys of the worker process, bounded in size and age
+  """
+  def __init__(self, ttl, lease, max_size=MEMORY_STORE_MAX_SIZE):
+    self.ttl = ttl
+    self.lease = lease
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.condition = threading.Condition()
+
+  def _is_stale(self, entry, now):
+    return entry['response'] is None and entry['created'] < now - self.lease
+
+  def _purge(self):
+    # entries in progress are kept until their lease ends
+    now = time.monotonic()
+    cutoff = now - self.ttl
+    victims = []
+    for key, entry in self.entries.items():
+      if entry['created'] >= cutoff and len(self.entries) - len(victims) <= self.max_size:
+        break
+      if entry['response'] is not None or self._is_stale(entry, now):
+        victims.append(key)
+    for key in victims:
+      del self.entries[key]
+
+  def begin(self, key, fingerprint, wait):
+    deadline = time.monotonic() + wait
+    with self.condition:
+      self._purge()
+      entry = self.entries.get(key)
+      while entry and entry['fingerprint'] == fingerprint and entry['response'] is None \
+          and not self._is_stale(entry, time.monotonic()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          return IN_PROGRESS, None
+        self.condition.wait(remaining)
+        entry = self.entries.get(key)
+      if not entry or self._is_stale(entry, time.monotonic()):
+        reservation = time.monotonic()
+        self.entries.pop(key, None)
+        self.entries[key] = {'fingerprint': fingerprint, 'created': reservation, 'response': None}
+        return NEW, reservation
+      if entry['fingerprint'] != fingerprint:
+        return MISMATCH, None
+      return REPLAY, entry['response']
+
+  def _reserved(self, key, reservation):
+    entry = self.entries.get(key)
+    return entry is not None and entry['created'] == reservation and entry['response'] is None
+
+  def complete(self, key, reservation, response):
+    with self.condition:
+      if self._reserved(key, reservation):
+        self.entries[key]['response'] = response
+      self.condition.notify_all()
+
+  def abandon(self, key, reservation):
+    with self.condition:
+      if self._reserved(key, reservation):
+        del self.entries[key]
+      self.condition.notify_all()
+
+  def purge_expired(self):
+    with self.condition:
+      size = len(self.entries)
+      self._purge()
+      return size - len(self.entries)
+
+class DatabaseStore():
+  """
+  Keys shared by every worker in the idempotency_keys table. A key is
+  reserved by a committed insert, duplicates poll for the response. The
+  reservation time, created_at, identifies the reservation
+  """
+  def __init__(self, ttl, lease):
+    self.ttl = ttl
+    self.lease = lease
+    self.table = IdempotencyKeyModel.__table__
+
+  def _reserve(self, key, fingerprint):
+    """
+    Insert the key, over an expired one or a reservation older than the
+    lease. Returns the reservation time or None if the key is taken
+    """
+    now = datetime.datetime.utcnow()
+    expired = self.table.c.created_at < now - datetime.timedelta(seconds=self.ttl)
+    stale = db.and_(self.table.c.completed_at.is_(None),
+                    self.table.c.created_at < now - datetime.timedelta(seconds=self.lease))
+    try:
+      with db.engine.begin() as connection:
+        connection.execute(self.table.delete().where(db.and_(self.table.c.key == key, db.or_(expired, stale))))
+        connection.execute(self.table.insert().values(key=key, fingerprint=fingerprint, created_at=now))
+      return now
+    except IntegrityError:
+      return None
+
+  def begin(self, key, fingerprint, wait):
+    deadline = time.monotonic() + wait
+    while True:
+      reservation = self._reserve(key, fingerprint)
+      if reservation:
+        return NEW, reservation
+      row = db.engine.execute(self.table.select().where(self.table.c.key == key)).first()
+      if row is None:
+        continue
+      if row.fingerprint != fingerprint:
+        return MISMATCH, None
+      if row.completed_at:
+        return REPLAY, StoredResponse(row.status_code, row.body, row.content_type)
+      if time.monotonic() >= deadline:
+        return IN_PROGRESS, None
+      time.sleep(DB_POLL_INTERVAL)
+
+  def _reserved(self, key, reservation):
+    return db.and_(self.table.c.key == key, self.table.c.created_at == reservation,
+                   self.table.c.completed_at.is_(None))
+
+  def complete(self, key, reservation, response):
+    db.engine.execute(self.table.update().where(self._reserved(key, reservation)).values(
+      status_code=response.status_code, body=response.body, content_type=response.content_type,
+      completed_at=datetime.datetime.utcnow()))
+
+  def abandon(self, key, reservation):
+    db.engine.execute(self.table.delete().where(self._reserved(key, reservation)))
+
+  def purge_expired(self):
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
+    return db.engine.execute(self.table.delete().where(self.table.c.created_at < cutoff)).rowcount
+
+STORES = {
+  'memory': MemoryStore,
+  'database': DatabaseStore,
+}
+
+def _spool_body(digest):
+  """
+  Hash the body of an upload as it is read into a spooled file, which then
+  replaces the request stream for the view. Returns the file
+  """
+  spool = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE)
+  for chunk in iter(lambda: request.stream.read(BODY_READ_SIZE), b''):
+    digest.update(chunk)
+    spool.write(chunk)
+  spool.seek(0)
+  # werkzeug parses the form and files from the stream attribute
+  request.__dict__['stream'] = spool
+  return spool
+
+def _fingerprint():
+  """
+  Hash of what makes two requests the same operation, with (fingerprint,
+  spooled body or None). Uploads are hashed without being read into memory
+  """
+  digest = hashlib.sha256()
+  digest.update(('%s %s?%s\n' % (request.method, request.path, request.query_string.decode())).encode())
+  spool = None
+  if request.is_json:
+    digest.update(request.get_data())
+  else:
+    spool = _spool_body(digest)
+  return digest.hexdigest(), spool
+
+def _replay(stored):
+  REPLAYS.inc()
+  return Response(stored.body, status=stored.status_code, content_type=stored.content_type,
+                  headers={strings.IDEMPOTENT_REPLAY_HEADER: 'true'})
+
+def idempotent(view):
+  """
+  Make a view replay its response for a repeated Idempotency-Key
+  """
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    key = request.headers.get(strings.IDEMPOTENCY_KEY_HEADER)
+    store = current_app.extensions.get('idempotency_store')
+    if not key or store is None:
+      return view(*args, **kwargs)
+    if len(key) > MAX_KEY_LENGTH:
+      return custom_response({'error': 'Idempotency-Key can have at most %d characters' % MAX_KEY_LENGTH}, 400)
+
+    fingerprint, spool = _fingerprint()
+    try:
+      state, stored = store.begin(key, fingerprint, current_app.config['IDEMPOTENCY_WAIT'])
+      if state == MISMATCH:
+        return custom_response({'error': 'Idempotency-Key was already used for another request'}, 422)
+      if state == IN_PROGRESS:
+        return custom_response({'error': 'A request with this Idempotency-Key is in progress'}, 409)
+      if state == REPLAY:
+        return _replay(stored)
+
+      # stored is the reservation of a new key
+      try:
+        response = view(*args, **kwargs)
+      except Exception:
+        store.abandon(key, stored)
+        raise
+      if response.status_code >= 500 or response.is_streamed:
+        store.abandon(key, stored)
+      else:
+        store.complete(key, stored, StoredResponse(response.status_code, response.get_data(), response.content_type))
+      return response
+    finally:
+      if spool:
+        spool.close()
+  return wrapper
+
+def init_app(app):
+  """
+  Create the store named by IDEMPOTENCY_STORE, none disables the replay
+  """
+  store = STORES.get(app.config.get('IDEMPOTENCY_STORE'))
+  app.extensions['idempotency_store'] = store(app.config['IDEMPOTENCY_TTL'], app.config['IDEMPOTENCY_LEASE']) \
+    if store else None
@@ -0,0 +1,87 @@
+import datetime
+import threading
+import uuid
+from src.models import db
+
+# Background jobs of the worker process, kept in memory so their progress
+# can be polled. A job only lives as long as the process that runs it
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+MAX_FINISHED_JOBS = 1000
+
+class Job():
+  """
+  A unit of background work with a done/total progress
+  """
+  def __init__(self, kind, target_id):
+    self.id = uuid.uuid4().hex
+    self.kind = kind
+    self.target_id = target_id
+    self.status = PENDING
+    self.done = 0
+    self.total = None
+    self.error = None
+    self.created_at = datetime.datetime.utcnow()
+    self.finished_at = None
+
+  def progress(self, done, total=None):
+    self.done = done
+    if total is not None:
+      self.total = total
+
+  def to_dict(self):
+    return {
+      'id': self.id,
+      'type': self.kind,
+      'target_id': self.target_id,
+      'status': self.status,
+      'done': self.done,
+      'total': self.total,
+      'error': self.error,
+      'created_at': self.created_at.isoformat(),
+      'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+    }
+
+_jobs = {}
+_lock = threading.Lock()
+
+def _forget_finished_jobs():
+  finished = [x for x in _jobs.values() if x.finished_at]
+  finished.sort(key=lambda x: x.finished_at)
+  for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+    del _jobs[job.id]
+
+def _run(app, job, operation):
+  with app.app_context():
+    job.status = RUNNING
+    try:
+      operation(job)
+      job.status = DONE
+    except Exception as e:
+      db.session.rollback()
+      app.logger.exception('Job %s %s failed', job.kind, job.id)
+      job.error = str(e)
+      job.status = FAILED
+    finally:
+      job.finished_at = datetime.datetime.utcnow()
+      db.session.remove()
+
+def start_job(app, kind, target_id, operation):
+  """
+  Run operation(job) in a background thread with an app context
+  """
+  job = Job(kind, target_id)
+  with _lock:
+    _forget_finished_jobs()
+    _jobs[job.id] = job
+  thread = threading.Thread(target=_run, args=(app, job, operation), name='job-%s' % job.id)
+  thread.daemon = True
+  thread.start()
+  return job
+
+def get_job(job_id):
+  with _lock:
+    return _jobs.get(job_id)
@@ -0,0 +1,142 @@
+import math
+from src import strings
+from src.models import db
+from src.serializers import dump
+from src.models.CardModel import CardModel
+from src.models.TransactionModel import TransactionModel, TransactionSchema
+
+# Business rules of the merchant operations on existing holds and sales.
+# They work in the current db transaction and leave the commit to the
+# caller's unit of work, so a view can commit one operation and a clearing
+# file a whole chunk. Each returns a (response dict, status code) pair.
+# The balance updates bump the card versions. A hold is changed with a
+# statement conditional on its state as read, before its card, so a
+# concurrent capture, reverse or release applies only once.
+
+transaction_schema = TransactionSchema()
+
+def _is_number(value):
+  # json and float() both read nan and infinity
+  return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def check_card_request(req_data):
+  """
+  Validate a card_nbr/amount request, returns (error, status code) or None
+  """
+  if not isinstance(req_data, dict) or strings.CARD_NBR_KEY not in req_data:
+    return {'error': 'Missing card_nbr attribute'}, 400
+  if not isinstance(req_data[strings.CARD_NBR_KEY], str):
+    return {'error': 'card_nbr must be a string'}, 400
+  if strings.AMOUNT_KEY not in req_data:
+    return {'error': 'Missing amount attribute'}, 400
+  if not _is_number(req_data[strings.AMOUNT_KEY]):
+    return {'error': 'amount must be a number'}, 400
+  if req_data[strings.AMOUNT_KEY] <= 0:
+    return {'error': 'amount is value is incorrect'}, 400
+  return None
+
+def check_transaction_fields(req_data):
+  """
+  Validate the fields of a transactions_id/amount request without reading
+  the db, returns (error, status code) or None
+  """
+  if not isinstance(req_data, dict) or strings.TRANSACTIONS_ID_KEY not in req_data:
+    return {'error': 'Missing transaction attribute'}, 400
+  transaction_id = req_data[strings.TRANSACTIONS_ID_KEY]
+  if not isinstance(transaction_id, int) or isinstance(transaction_id, bool):
+    return {'error': 'transaction_id must be an integer'}, 400
+  if strings.AMOUNT_KEY not in req_data:
+    return {'error': 'Missing amount attribute'}, 400
+  if not _is_number(req_data[strings.AMOUNT_KEY]):
+    return {'error': 'amount must be a number'}, 400
+  if req_data[strings.AMOUNT_KEY] < 0:
+    return {'error': 'amount is value is incorrect'}, 400
+  return None
+
+def check_transaction_request(req_data, merchant_id):
+  """
+  Validate a transactions_id/amount request and get the merchant's hold,
+  returns (transaction, None) or (None, (error, status code))
+  """
+  error = check_transaction_fields(req_data)
+  if error:
+    return None, error
+
+  transaction = TransactionModel.get_one_transaction(req_data[strings.TRANSACTIONS_ID_KEY])
+  if not transaction or transaction.merchant_id != merchant_id or not transaction.blocked:
+    return None, _hold_not_found()
+  return transaction, None
+
+def _hold_not_found():
+  return {'error': 'The transaction_id is not correct for this Merchant'}, 404
+
+def capture(merchant_id, req_data):
+  transaction, error = check_transaction_request(req_data, merchant_id)
+  if error:
+    return error
+
+  amount = req_data[strings.AMOUNT_KEY]
+  if transaction.amount + amount > 0:
+    return {'error': 'The request amount is more than the existing amount in the transaction'}, 403
+  if transaction.amount + amount != 0:
+    if not transaction.update_hold({'amount': transaction.amount + amount}):
+      return _hold_not_found()
+    CardModel.update_balance(transaction.card_id, 0, -1*amount)
+    transaction_blocked = TransactionModel.generate_transaction(transaction.card_id, merchant_id, -1*amount, False)
+    transaction_blocked.created_at = transaction.created_at
+    db.session.add(transaction_blocked)
+  else:
+    if not transaction.update_hold({'blocked': False}):
+      return _hold_not_found()
+    CardModel.update_balance(transaction.card_id, 0, transaction.amount)
+  db.session.flush()
+  return {'Transaction': dump(transaction_schema, transaction)}, 200
+
+def reverse(merchant_id, req_data):
+  transaction, error = check_transaction_request(req_data, merchant_id)
+  if error:
+    return error
+
+  amount = req_data[strings.AMOUNT_KEY]
+  if transaction.amount + amount > 0:
+    return {'error': 'Cannot reverse more than was authorized'}, 400
+  elif transaction.amount + amount < 0:
+    if not transaction.update_hold({'amount': transaction.amount + amount}):
+      return _hold_not_found()
+    CardModel.update_balance(transaction.card_id, amount, -1*amount)
+  else:
+    held = transaction.amount
+    if not transaction.delete_hold():
+      return _hold_not_found()
+    CardModel.update_balance(transaction.card_id, -1*held, held)
+  db.session.flush()
+  return {'Reverse': "Ok"}, 201
+
+def refund(merchant_id, card_id, amount):
+  # autoflush makes the sales written earlier in the same db transaction count
+  available_refund = TransactionModel.get_refundable_amount(merchant_id, card_id)
+  if amount + available_refund > 0:
+    return {'error': 'trying to refund more than is refundable'}, 403
+  CardModel.update_balance(card_id, amount)
+  transaction = TransactionModel.generate_transaction(card_id, merchant_id, amount, False)
+  db.session.add(transaction)
+  db.session.flush()
+  return {'Transaction': dump(transaction_schema, transaction)}, 201
+
+def release_holds(*criteria):
+  """
+  Release the holds matching criteria with set based statements, the held
+  amounts go back to their cards and the holds are deleted. Returns the
+  number of holds released
+  """
+  criteria = (TransactionModel.blocked.is_(True),) + criteria
+  held = db.session.query(db.func.sum(TransactionModel.amount)) \
+    .filter(TransactionModel.card_id == CardModel.id, *criteria) \
+    .correlate(CardModel).as_scalar()
+  card_ids = db.session.query(TransactionModel.card_id).filter(*criteria)
+  CardModel.query.filter(CardModel.id.in_(card_ids.subquery())).update({
+    CardModel.available: CardModel.available - held,
+    CardModel.blocked: CardModel.blocked + held,
+    CardModel.version: CardModel.version + 1,
+  }, synchronize_session=False)
+  return TransactionModel.query.filter(*criteria).delete(synchronize_session=False)
@@ -0,0 +1,60 @@
+from src import cache, ledger
+from src.response_cache import responses, MERCHANT
+from src.jobs import start_job
+from src.models import db
+from src.models.CardModel import CardModel
+from src.models.MerchantModel import MerchantModel
+from src.models.TransactionModel import TransactionModel
+
+DELETION_CHUNK_SIZE = 5000
+MERCHANT_DELETION_JOB = 'merchant_deletion'
+
+def delete_merchant(merchant_id):
+  """
+  Delete a merchant in one db transaction: its holds are released and its
+  settled transactions are kept without the merchant. Returns the number
+  of holds released
+  """
+  # every card of the merchant changes, release_holds only bumps those with holds
+  CardModel.touch(db.session.query(TransactionModel.card_id).filter_by(merchant_id=merchant_id).subquery())
+  released = ledger.release_holds(TransactionModel.merchant_id == merchant_id)
+  TransactionModel.query.filter_by(merchant_id=merchant_id) \
+    .update({TransactionModel.merchant_id: None}, synchronize_session=False)
+  MerchantModel.query.filter_by(id=merchant_id).delete(synchronize_session=False)
+  db.session.commit()
+  cache.merchants.delete(merchant_id)
+  responses.invalidate(MERCHANT, merchant_id)
+  return released
+
+def delete_merchant_in_chunks(merchant_id, chunk_size=DELETION_CHUNK_SIZE, progress=None):
+  """
+  Release the merchant's holds chunk_size at a time, one db transaction per
+  chunk, then delete it. progress(done, total) is called after each chunk
+  """
+  total = TransactionModel.query.filter_by(merchant_id=merchant_id, blocked=True).count()
+  done = 0
+  if progress:
+    progress(done, total)
+  while True:
+    ids = [x[0] for x in db.session.query(TransactionModel.id)
+           .filter_by(merchant_id=merchant_id, blocked=True)
+           .order_by(TransactionModel.id).limit(chunk_size)]
+    if not ids:
+      break
+    done += ledger.release_holds(TransactionModel.id.in_(ids))
+    db.session.commit()
+    if progress:
+      progress(done, max(total, done))
+  # holds authorized while the job ran are released with the delete
+  done += delete_merchant(merchant_id)
+  if progress:
+    progress(done, max(total, done))
+  return done
+
+def start_merchant_deletion(app, merchant_id, chunk_size=DELETION_CHUNK_SIZE):
+  """
+  Delete a merchant in a background job, returns the job
+  """
+  def operation(job):
+    delete_merchant_in_chunks(merchant_id, chunk_size, job.progress)
+  return start_job(app, MERCHANT_DELETION_JOB, merchant_id, operation)
@@ -0,0 +1,214 @@
+import threading
+import time
+from flask import g, request, Response, has_request_context
+from marshmallow import Schema
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Prometheus style instrumentation kept in process memory. Every worker
+# process exposes its own counters on /metrics, the scraper sums them.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                            for k, v in labels])
+
+class Counter():
+  def __init__(self, name, help_text, kind='counter'):
+    self.name = name
+    self.help_text = help_text
+    self.kind = kind
+    self.lock = threading.Lock()
+    self.values = {}
+
+  def inc(self, labels=(), value=1):
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + value
+
+  def set(self, labels=(), value=0):
+    with self.lock:
+      self.values[labels] = value
+
+  def samples(self):
+    with self.lock:
+      return [(self.name, labels, value) for labels, value in sorted(self.values.items())]
+
+class Histogram():
+  def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.help_text = help_text
+    self.kind = 'histogram'
+    self.buckets = buckets
+    self.lock = threading.Lock()
+    self.values = {}
+
+  def observe(self, labels, value):
+    with self.lock:
+      counts = self.values.get(labels)
+      if counts is None:
+        # one slot per bucket, then +Inf and the sum
+        counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+          break
+      else:
+        counts[len(self.buckets)] += 1
+      counts[-1] += value
+
+  def samples(self):
+    samples = []
+    with self.lock:
+      for labels, counts in sorted(self.values.items()):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+          cumulative += count
+          samples.append((self.name + '_bucket', labels + (('le', bound),), cumulative))
+        samples.append((self.name + '_count', labels, cumulative))
+        samples.append((self.name + '_sum', labels, counts[-1]))
+    return samples
+
+class Registry():
+  def __init__(self):
+    self.metrics = []
+    self.collectors = []
+
+  def counter(self, name, help_text):
+    return self._add(Counter(name, help_text))
+
+  def gauge(self, name, help_text):
+    return self._add(Counter(name, help_text, 'gauge'))
+
+  def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+    return self._add(Histogram(name, help_text, buckets))
+
+  def add_collector(self, collector):
+    """
+    collector() is called before each scrape, to refresh gauges
+    """
+    self.collectors.append(collector)
+
+  def _add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def exposition(self):
+    """
+    The metrics in the Prometheus text format
+    """
+    for collector in self.collectors:
+      collector()
+    lines = []
+    for metric in self.metrics:
+      lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+      lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+      for name, labels, value in metric.samples():
+        lines.append('%s%s %s' % (name, _format_labels(labels), repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+REQUESTS = registry.counter('http_requests_total', 'Requests by endpoint, method and status')
+REQUEST_DURATION = registry.histogram('http_request_duration_seconds', 'Request latency by endpoint')
+SQL_STATEMENTS = registry.counter('db_statements_total', 'SQL statements by endpoint')
+SQL_DURATION = registry.counter('db_statement_duration_seconds_total', 'Time spent in SQL statements by endpoint')
+SQL_PER_REQUEST = registry.histogram('db_statements_per_request', 'SQL statements per request by endpoint',
+                                     buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 100))
+SERIALIZATION_DURATION = registry.histogram('serialization_duration_seconds',
+                                            'Time spent in schema dumps and JSON encoding per request by endpoint')
+
+_local = threading.local()
+
+def _request_metrics():
+  """
+  The per request accumulators, None outside of an instrumented request
+  """
+  if not has_request_context():
+    return None
+  return g.get('_metrics')
+
+def record_serialization(seconds):
+  state = _request_metrics()
+  if state is not None:
+    state['serialization'] += seconds
+
+class serialization_timer():
+  """
+  Context manager adding the time of its block to the request's
+  serialization time, nested timers are only counted once
+  """
+  def __enter__(self):
+    self.outermost = not getattr(_local, 'serializing', False)
+    if self.outermost:
+      _local.serializing = True
+      self.start = time.perf_counter()
+
+  def __exit__(self, *exc):
+    if self.outermost:
+      _local.serializing = False
+      record_serialization(time.perf_counter() - self.start)
+
+class TimedSchema(Schema):
+  """
+  Schema whose dumps count as serialization time of the current request
+  """
+  def dump(self, obj, *args, **kwargs):
+    with serialization_timer():
+      return super(TimedSchema, self).dump(obj, *args, **kwargs)
+
+# the start time is kept on the statement's execution context, failed
+# statements never reach after_cursor_execute and leave nothing behind
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  context._metrics_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  seconds = time.perf_counter() - context._metrics_start
+  state = _request_metrics()
+  if state is not None:
+    state['sql_count'] += 1
+    state['sql_seconds'] += seconds
+
+def _start_request():
+  g._metrics = {'start': time.perf_counter(), 'sql_count': 0, 'sql_seconds': 0.0, 'serialization': 0.0}
+
+def _finish_request(status_code):
+  state = g.pop('_metrics', None)
+  if state is None:
+    return
+  endpoint = request.endpoint or 'unmatched'
+  labels = (('endpoint', endpoint),)
+  REQUESTS.inc(labels + (('method', request.method), ('status', status_code)))
+  REQUEST_DURATION.observe(labels, time.perf_counter() - state['start'])
+  SQL_STATEMENTS.inc(labels, state['sql_count'])
+  SQL_DURATION.inc(labels, state['sql_seconds'])
+  SQL_PER_REQUEST.observe(labels, state['sql_count'])
+  SERIALIZATION_DURATION.observe(labels, state['serialization'])
+
+def init_app(app):
+  """
+  Instrument the app's requests and expose the metrics on /metrics
+  """
+  @app.before_request
+  def start_request():
+    if request.endpoint != 'metrics':
+      _start_request()
+
+  @app.after_request
+  def finish_request(response):
+    _finish_request(response.status_code)
+    return response
+
+  @app.teardown_request
+  def finish_failed_request(exception):
+    # after_request is skipped when the view raised
+    if exception is not None:
+      _finish_request(500)
+
+  @app.route('/metrics', endpoint='metrics')
+  def metrics():
+    return Response(registry.exposition(), mimetype='text/plain; version=0.0.4')
@@ -1,6 +1,9 @@
-from marshmallow import fields, Schema
-from src import strings
-from . import db
+from marshmallow import fields
+from sqlalchemy.orm import selectinload
+from src import cache, strings
+from src.response_cache import responses, CARD
+from src.metrics import TimedSchema
+from . import after_commit, commit, db
 from .TransactionModel import TransactionSchema
 
 CARDS_TABLE_NAME = 'cards'
@@ -14,7 +17,13 @@ class CardModel(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String(128), nullable=False)
   card_nbr = db.Column(db.String(16), unique=True, nullable=False)
-  transactions = db.relationship('TransactionModel', backref=CARDS_TABLE_NAME, lazy=True)
+  # materialized balances, kept in step with the transactions table
+  available = db.Column(db.Float, nullable=False, default=0, server_default='0')
+  blocked = db.Column(db.Float, nullable=False, default=0, server_default='0')
+  # bumped by every write that changes the card or its transactions
+  version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+  transactions = db.relationship('TransactionModel', backref=CARDS_TABLE_NAME, lazy=True,
+                                 order_by='TransactionModel.id')
 
   # class constructor
   def __init__(self, data):
@@ -23,36 +32,135 @@ class CardModel(db.Model):
     """
     self.name = data.get(strings.NAME_KEY)
     self.card_nbr = data.get(strings.CARD_NBR_KEY)
+    self.available = 0
+    self.blocked = 0
 
   def save(self):
     db.session.add(self)
-    db.session.commit()
+    commit()
 
   def update(self, data):
+    # invalidated once committed, before that a concurrent lookup could
+    # cache the old row again
+    card_nbr = self.card_nbr
+    after_commit(lambda: cache.card_ids.delete(card_nbr))
     for key, item in data.items():
       setattr(self, key, item)
-    db.session.commit()
+    # in SQL, a concurrent balance update may bump it before the commit
+    self.version = CardModel.version + 1
+    responses.invalidate(CARD, self.id)
+    commit()
 
   def delete(self):
+    card_nbr = self.card_nbr
+    after_commit(lambda: cache.card_ids.delete(card_nbr))
+    responses.invalidate(CARD, self.id)
     db.session.delete(self)
-    db.session.commit()
+    commit()
+
+  @staticmethod
+  def update_balance(id, available_delta, blocked_delta=0):
+    """
+    Apply a balance change in the current db transaction, the caller commits
+    """
+    CardModel.query.filter_by(id=id).update({
+      CardModel.available: CardModel.available + available_delta,
+      CardModel.blocked: CardModel.blocked + blocked_delta,
+      CardModel.version: CardModel.version + 1,
+    }, synchronize_session=False)
+    responses.invalidate(CARD, id)
+
+  @staticmethod
+  def hold_funds(id, amount):
+    """
+    Block amount on the card if it is available. The check and the update
+    are a single conditional statement so concurrent holds cannot overspend.
+    Returns False if the card does not have enough amount
+    """
+    updated = CardModel.query.filter(
+      CardModel.id == id, CardModel.available >= amount
+    ).update({
+      CardModel.available: CardModel.available - amount,
+      CardModel.blocked: CardModel.blocked + amount,
+      CardModel.version: CardModel.version + 1,
+    }, synchronize_session=False)
+    responses.invalidate(CARD, id)
+    return updated == 1
+
+  @staticmethod
+  def touch(ids):
+    """
+    Bump the version of the cards with ids, a list or a subquery, in the
+    current db transaction. Call it before the merchant updates of the
+    transaction
+    """
+    CardModel.query.filter(CardModel.id.in_(ids)) \
+      .update({CardModel.version: CardModel.version + 1}, synchronize_session=False)
 
   @staticmethod
   def get_all_cards():
     return CardModel.query.all()
 
+  @staticmethod
+  def get_cards_page(after, limit, with_transactions=True):
+    query = CardModel.query
+    if with_transactions:
+      query = query.options(selectinload(CardModel.transactions))
+    return query.filter(CardModel.id > after).order_by(CardModel.id).limit(limit).all()
+
+  @staticmethod
+  def iter_cards(after, chunk_size, with_transactions=True):
+    """
+    Iterate over cards with a server side cursor, chunk_size rows at a time,
+    the transactions of each chunk are loaded with one extra query
+    """
+    query = CardModel.query
+    if with_transactions:
+      query = query.options(selectinload(CardModel.transactions))
+    return query.filter(CardModel.id > after).order_by(CardModel.id) \
+      .execution_options(stream_results=True).yield_per(chunk_size)
+
   @staticmethod
   def get_card_by_card_nbr(card_nbr):
     return CardModel.query.filter_by(card_nbr=card_nbr).first()
 
+  @staticmethod
+  def get_cards_by_card_nbrs(card_nbrs, for_update=False):
+    """
+    Resolve many card numbers in one query, for_update locks the rows in id
+    order until the end of the db transaction
+    """
+    query = CardModel.query.filter(CardModel.card_nbr.in_(card_nbrs)).order_by(CardModel.id)
+    if for_update:
+      query = query.with_for_update()
+    return query.all()
+
+  @staticmethod
+  def get_card_id_by_card_nbr(card_nbr):
+    """
+    Card id of a card number, served from the lookup cache when possible
+    """
+    card_id = cache.card_ids.get(card_nbr)
+    if card_id is None:
+      row = db.session.query(CardModel.id).filter_by(card_nbr=card_nbr).first()
+      if not row:
+        return None
+      card_id = row[0]
+      cache.card_ids.set(card_nbr, card_id)
+    return card_id
+
   @staticmethod
   def get_card(id):
     return CardModel.query.get(id)
 
+  @staticmethod
+  def card_exists(id):
+    return db.session.query(CardModel.id).filter_by(id=id).first() is not None
+
   def __repr(self):
     return '<id {}>'.format(self.id)
 
-class CardSchema(Schema):
+class CardSchema(TimedSchema):
   """
   Card Schema
   """
@@ -64,10 +172,10 @@ class CardSchema(Schema):
   blocked = fields.Method('get_blocked_amount')
 
   def get_avaible_amount(self, card):
-    return self.get_total_amount(card) + -1*self.get_blocked_amount(card)
+    return card.available
 
   def get_total_amount(self, card):
-    return sum([x.amount for x in card.transactions if not x.blocked])
+    return card.available + card.blocked
 
   def get_blocked_amount(self, card):
-    return -1*sum([x.amount for x in card.transactions if x.blocked])
+    return card.blocked
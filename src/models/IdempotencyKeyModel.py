@@ -0,0 +1,20 @@
+from . import db
+
+IDEMPOTENCY_KEYS_TABLE_NAME = 'idempotency_keys'
+
+class IdempotencyKeyModel(db.Model):
+  """
+  Idempotency Key Model, the stored response of a mutating request
+  """
+  __tablename__ = IDEMPOTENCY_KEYS_TABLE_NAME
+
+  key = db.Column(db.String(255), primary_key=True)
+  fingerprint = db.Column(db.String(64), nullable=False)
+  status_code = db.Column(db.Integer)
+  body = db.Column(db.LargeBinary)
+  content_type = db.Column(db.String(128))
+  created_at = db.Column(db.DateTime, nullable=False, index=True)
+  completed_at = db.Column(db.DateTime)
+
+  def __repr__(self):
+    return '<key {}>'.format(self.key)
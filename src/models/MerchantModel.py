@@ -1,10 +1,16 @@
-from marshmallow import fields, Schema
-from src import strings
-from . import db
-from .TransactionModel import TransactionSchema
+from collections import namedtuple
+from marshmallow import fields
+from sqlalchemy.orm import selectinload
+from src import cache, strings
+from src.response_cache import responses, MERCHANT
+from src.metrics import TimedSchema
+from . import after_commit, commit, db
+from .TransactionModel import TransactionModel, TransactionSchema
 
 MERCHANTS_TABLE_NAME = 'merchants'
 
+MerchantSummary = namedtuple('MerchantSummary', ['id', 'name', 'transactions_count', 'holds_count', 'held', 'settled'])
+
 class MerchantModel(db.Model):
   """
   Merchant Model
@@ -13,7 +19,12 @@ class MerchantModel(db.Model):
 
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String(128), nullable=False, unique=True)
-  transactions = db.relationship('TransactionModel', backref=MERCHANTS_TABLE_NAME, lazy=True)
+  # bumped by every update of the merchant row. The writes of transactions
+  # leave it alone so they do not lock the merchant row, the representations
+  # that embed transactions are therefore not versioned
+  version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+  transactions = db.relationship('TransactionModel', backref=MERCHANTS_TABLE_NAME, lazy=True,
+                                 order_by='TransactionModel.id')
 
   # class constructor
   def __init__(self, data):
@@ -24,25 +35,80 @@ class MerchantModel(db.Model):
 
   def save(self):
     db.session.add(self)
-    db.session.commit()
+    commit()
 
   def update(self, data):
     for key, item in data.items():
       setattr(self, key, item)
-    db.session.commit()
+    # in SQL, a concurrent write may bump it before the commit
+    self.version = MerchantModel.version + 1
+    responses.invalidate(MERCHANT, self.id)
+    commit()
 
   def delete(self):
+    id = self.id
+    after_commit(lambda: cache.merchants.delete(id))
+    responses.invalidate(MERCHANT, self.id)
     db.session.delete(self)
-    db.session.commit()
+    commit()
 
   @staticmethod
   def get_all_merchants():
     return MerchantModel.query.all()
 
+  @staticmethod
+  def get_merchants_page(after, limit, with_transactions=True):
+    query = MerchantModel.query
+    if with_transactions:
+      query = query.options(selectinload(MerchantModel.transactions))
+    return query.filter(MerchantModel.id > after).order_by(MerchantModel.id).limit(limit).all()
+
+  @staticmethod
+  def iter_merchants(after, chunk_size, with_transactions=True):
+    """
+    Iterate over merchants with a server side cursor, chunk_size rows at a time,
+    the transactions of each chunk are loaded with one extra query
+    """
+    query = MerchantModel.query
+    if with_transactions:
+      query = query.options(selectinload(MerchantModel.transactions))
+    return query.filter(MerchantModel.id > after).order_by(MerchantModel.id) \
+      .execution_options(stream_results=True).yield_per(chunk_size)
+
   @staticmethod
   def get_one_merchant(id):
     return MerchantModel.query.get(id)
 
+  @staticmethod
+  def merchant_exists(id):
+    """
+    Whether the merchant exists, served from the lookup cache when possible
+    """
+    if cache.merchants.get(id):
+      return True
+    exists = db.session.query(MerchantModel.id).filter_by(id=id).first() is not None
+    if exists:
+      cache.merchants.set(id, True)
+    return exists
+
+  @staticmethod
+  def get_merchant_summaries(merchants):
+    """
+    Summaries of merchants with the count and totals of their transactions,
+    from one aggregate query instead of loading the transactions
+    """
+    ids = [x.id for x in merchants]
+    totals = {}
+    if ids:
+      held = db.case([(TransactionModel.blocked == True, -TransactionModel.amount)], else_=0)
+      settled = db.case([(TransactionModel.blocked == False, -TransactionModel.amount)], else_=0)
+      holds = db.case([(TransactionModel.blocked == True, 1)], else_=0)
+      rows = db.session.query(TransactionModel.merchant_id, db.func.count(TransactionModel.id),
+                              db.func.sum(holds), db.func.sum(held), db.func.sum(settled)) \
+        .filter(TransactionModel.merchant_id.in_(ids)).group_by(TransactionModel.merchant_id)
+      totals = dict([(row[0], row[1:]) for row in rows])
+    return [MerchantSummary(x.id, x.name, *totals.get(x.id, (0, 0, 0, 0))) for x in merchants]
+
   @staticmethod
   def get_merchant_by_name(name):
     return MerchantModel.query.filter_by(name=name).first()
@@ -51,10 +117,23 @@ class MerchantModel(db.Model):
     return '<id {}>'.format(self.id)
 
 
-class MerchantSchema(Schema):
+class MerchantSchema(TimedSchema):
   """
   Merchant Schema
   """
   id = fields.Int(dump_only=True)
   name = fields.Str(required=True)
   transactions = fields.Nested(TransactionSchema, many=True)
+
+
+class MerchantSummarySchema(TimedSchema):
+  """
+  Merchant Summary Schema, the transactions are counted and summed instead
+  of nested
+  """
+  id = fields.Int(dump_only=True)
+  name = fields.Str()
+  transactions_count = fields.Int()
+  holds_count = fields.Int()
+  held = fields.Float()
+  settled = fields.Float()
@@ -1,7 +1,9 @@
 import datetime
-from marshmallow import fields, Schema
+from marshmallow import fields
+from sqlalchemy.orm.attributes import set_committed_value
 from src import strings
-from . import db
+from src.metrics import TimedSchema
+from . import commit, db, bulk_insert
 
 TRANSACTIONS_TABLE_NAME = 'transactions'
 
@@ -18,6 +20,18 @@ class TransactionModel(db.Model):
   blocked = db.Column(db.Boolean, nullable=False)
   created_at = db.Column(db.DateTime)
 
+  __table_args__ = (
+    # card history and balance, in id or time order
+    db.Index('ix_transactions_card_id_id', card_id, id),
+    db.Index('ix_transactions_card_id_created_at', card_id, created_at),
+    # merchant history and the refund limit of a merchant/card pair
+    db.Index('ix_transactions_merchant_id_id', merchant_id, id),
+    db.Index('ix_transactions_merchant_id_card_id', merchant_id, card_id),
+    # outstanding holds by age, only the holds are indexed
+    db.Index('ix_transactions_holds_created_at', created_at,
+             postgresql_where=(blocked == True), sqlite_where=(blocked == True)),
+  )
+
   def __init__(self, data):
     self.card_id = data.get(strings.CARD_ID_KEY)
     self.merchant_id = data.get(strings.MERCHANT_ID_KEY)
@@ -27,16 +41,41 @@ class TransactionModel(db.Model):
 
   def save(self):
     db.session.add(self)
-    db.session.commit()
+    commit()
 
   def update(self, data):
     for key, item in data.items():
       setattr(self, key, item)
-    db.session.commit()
+    commit()
 
   def delete(self):
     db.session.delete(self)
-    db.session.commit()
+    commit()
+
+  def update_hold(self, values):
+    """
+    Apply values to the hold if it is still the hold that was read, in one
+    conditional statement so concurrent captures and reverses of it cannot
+    both apply. Returns False if it was changed or released meanwhile
+    """
+    updated = self._hold_query().update(values, synchronize_session=False)
+    if updated == 1:
+      for key, value in values.items():
+        set_committed_value(self, key, value)
+    return updated == 1
+
+  def delete_hold(self):
+    """
+    Delete the hold if it is still the hold that was read, see update_hold
+    """
+    deleted = self._hold_query().delete(synchronize_session=False)
+    if deleted == 1:
+      db.session.expunge(self)
+    return deleted == 1
+
+  def _hold_query(self):
+    return TransactionModel.query.filter(TransactionModel.id == self.id, TransactionModel.blocked.is_(True),
+                                         TransactionModel.amount == self.amount)
 
   @staticmethod
   def get_all_transactions():
@@ -46,6 +85,81 @@ class TransactionModel(db.Model):
   def get_one_transaction(id):
     return TransactionModel.query.get(id)
 
+  @staticmethod
+  def get_transactions(ids):
+    return TransactionModel.query.filter(TransactionModel.id.in_(ids)).all()
+
+  @staticmethod
+  def history_query(after, created_from=None, created_to=None, blocked=None, **owner):
+    """
+    Transactions of a card_id or merchant_id after the id cursor in id order,
+    created in [created_from, created_to), the indexes of both owners serve it
+    """
+    query = TransactionModel.query.filter_by(**owner).filter(TransactionModel.id > after)
+    if created_from:
+      query = query.filter(TransactionModel.created_at >= created_from)
+    if created_to:
+      query = query.filter(TransactionModel.created_at < created_to)
+    if blocked is not None:
+      query = query.filter(TransactionModel.blocked == blocked)
+    return query.order_by(TransactionModel.id)
+
+  @staticmethod
+  def get_card_transactions_page(card_id, after, limit, created_from=None, created_to=None, blocked=None):
+    return TransactionModel.history_query(after, created_from, created_to, blocked, card_id=card_id) \
+      .limit(limit).all()
+
+  @staticmethod
+  def iter_card_transactions(card_id, after, chunk_size, created_from=None, created_to=None, blocked=None):
+    """
+    Iterate over a card's history with a server side cursor
+    """
+    return TransactionModel.history_query(after, created_from, created_to, blocked, card_id=card_id) \
+      .execution_options(stream_results=True).yield_per(chunk_size)
+
+  @staticmethod
+  def get_refundable_amount(merchant_id, card_id):
+    """
+    Net settled amount between a merchant and a card, negative for sales.
+    One indexed aggregate, independent of the merchant's history size
+    """
+    total = db.session.query(db.func.sum(TransactionModel.amount)).filter(
+      TransactionModel.merchant_id == merchant_id,
+      TransactionModel.card_id == card_id,
+      TransactionModel.blocked.is_(False)).scalar()
+    return total or 0
+
+  @staticmethod
+  def get_merchant_transactions_page(merchant_id, after, limit, created_from=None, created_to=None, blocked=None):
+    return TransactionModel.history_query(after, created_from, created_to, blocked, merchant_id=merchant_id) \
+      .limit(limit).all()
+
+  @staticmethod
+  def iter_merchant_transactions(merchant_id, after, chunk_size, created_from=None, created_to=None, blocked=None):
+    """
+    Iterate over a merchant's history with a server side cursor
+    """
+    return TransactionModel.history_query(after, created_from, created_to, blocked, merchant_id=merchant_id) \
+      .execution_options(stream_results=True).yield_per(chunk_size)
+
+  @staticmethod
+  def insert_many(rows):
+    """
+    Insert transaction dicts in bulk in the current db transaction, skips
+    the ORM unit of work. The caller commits
+    """
+    bulk_insert(TransactionModel.__table__, rows)
+
+  @staticmethod
+  def generate_transaction_row(card_id, merchant_id, amount, blocked=True, created_at=None):
+    return {
+      strings.CARD_ID_KEY: card_id,
+      strings.MERCHANT_ID_KEY: merchant_id,
+      strings.AMOUNT_KEY: amount,
+      strings.BLOCKED_KEY: blocked,
+      strings.CREATED_AT_KEY: created_at or datetime.datetime.utcnow(),
+    }
+
   @staticmethod
   def generate_transaction(card_id, merchant_id, amount, blocked=True):
     data = {}
@@ -58,7 +172,7 @@ class TransactionModel(db.Model):
   def __repr__(self):
     return '<id {}>'.format(self.id)
 
-class TransactionSchema(Schema):
+class TransactionSchema(TimedSchema):
   """
   Transaction Schema
   """
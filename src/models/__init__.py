@@ -1,3 +1,211 @@
-from flask_sqlalchemy import SQLAlchemy
+import datetime
+import io
+from contextlib import contextmanager
+from functools import wraps
+from flask import has_app_context
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
+from src.metrics import registry
+
+def postgresql_engine_options(config):
+  """
+  Engine options from the DB_* settings. With DB_PGBOUNCER the pooling is
+  left to PgBouncer, which in transaction mode keeps neither the startup
+  options nor SET, so the timeouts are set again in every transaction
+  """
+  timeouts = [(name, config.get(key)) for name, key in
+              (('statement_timeout', 'DB_STATEMENT_TIMEOUT'), ('lock_timeout', 'DB_LOCK_TIMEOUT'))
+              if config.get(key)]
+  options = {'connect_args': {'connect_timeout': config.get('DB_CONNECT_TIMEOUT', 10)}}
+  if config.get('DB_PGBOUNCER'):
+    options['poolclass'] = NullPool
+    options['execution_options'] = {'transaction_settings': timeouts}
+    return options
+
+  options.update({
+    'pool_size': config.get('DB_POOL_SIZE', 5),
+    'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+    'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+    'pool_recycle': config.get('DB_POOL_RECYCLE', -1),
+    'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+  })
+  if timeouts:
+    options['connect_args']['options'] = ' '.join(['-c %s=%d' % x for x in timeouts])
+  return options
+
+REPLICA_BIND = 'replica'
+USE_REPLICA_KEY = 'use_replica'
+
+class RoutingSession(SignallingSession):
+  """
+  Session that reads from the replica bind once a read only view has set
+  USE_REPLICA_KEY in its info, flushes always go to the primary
+  """
+  def __init__(self, db, **options):
+    self.db = db
+    super(RoutingSession, self).__init__(db, **options)
+
+  def get_bind(self, mapper=None, clause=None):
+    if self.info.get(USE_REPLICA_KEY) and not self._flushing:
+      return self.db.get_engine(self.app, bind=REPLICA_BIND)
+    return super(RoutingSession, self).get_bind(mapper, clause)
+
+class SQLAlchemy(BaseSQLAlchemy):
+  """
+  Flask-SQLAlchemy with the pool and timeout settings of the config and
+  the replica routing session
+  """
+  def apply_driver_hacks(self, app, info, options):
+    super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+    if info.drivername.startswith('postgresql'):
+      options.update(postgresql_engine_options(app.config))
+
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
 
 db = SQLAlchemy()
+
+AFTER_COMMIT_KEY = 'after_commit'
+
+def after_commit(callback):
+  """
+  Call callback once the session's db transaction commits, a rollback
+  drops it
+  """
+  db.session().info.setdefault(AFTER_COMMIT_KEY, []).append(callback)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _run_after_commit(session):
+  for callback in session.info.pop(AFTER_COMMIT_KEY, []):
+    callback()
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _drop_after_commit(session):
+  session.info.pop(AFTER_COMMIT_KEY, None)
+
+@event.listens_for(Engine, 'begin')
+def _set_transaction_settings(conn):
+  for name, value in conn.get_execution_options().get('transaction_settings', ()):
+    conn.execute('SET LOCAL %s = %d' % (name, value))
+
+def warm_pool(app):
+  """
+  Open DB_POOL_WARM connections up front so that the first requests after
+  a restart do not all connect at once. Returns the connections opened
+  """
+  with app.app_context():
+    engine = db.get_engine()
+    if not isinstance(engine.pool, QueuePool):
+      return 0
+    connections = [engine.connect() for i in range(min(app.config.get('DB_POOL_WARM', 0), engine.pool.size()))]
+    for connection in connections:
+      connection.close()
+    return len(connections)
+
+POOL_CONNECTIONS = registry.gauge('db_pool_connections', 'Connections of the worker pool by state')
+
+def _collect_pool():
+  if not has_app_context():
+    return
+  pool = db.get_engine().pool
+  if isinstance(pool, QueuePool):
+    POOL_CONNECTIONS.set((('state', 'checked_out'),), pool.checkedout())
+    POOL_CONNECTIONS.set((('state', 'idle'),), pool.checkedin())
+    POOL_CONNECTIONS.set((('state', 'overflow'),), max(0, pool.overflow()))
+
+registry.add_collector(_collect_pool)
+
+UNIT_OF_WORK_KEY = 'unit_of_work'
+
+class UnitOfWork():
+  """
+  The business operation in progress, discard() makes it roll back
+  instead of committing when it ends
+  """
+  def __init__(self):
+    self.discarded = False
+
+  def discard(self):
+    self.discarded = True
+
+@contextmanager
+def unit_of_work():
+  """
+  Group the changes of a business operation in one db transaction: inside it
+  the models' save, update and delete only flush, it commits once when the
+  block ends and rolls back on an exception. Nested units join the outer one
+  """
+  session = db.session()
+  outer = session.info.get(UNIT_OF_WORK_KEY)
+  if outer:
+    yield outer
+    return
+
+  uow = session.info[UNIT_OF_WORK_KEY] = UnitOfWork()
+  try:
+    yield uow
+    if uow.discarded:
+      session.rollback()
+    else:
+      session.commit()
+  except Exception:
+    session.rollback()
+    raise
+  finally:
+    del session.info[UNIT_OF_WORK_KEY]
+
+def transactional(view):
+  """
+  Run a view in a unit of work, error responses roll it back
+  """
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    with unit_of_work() as uow:
+      response = view(*args, **kwargs)
+      if response.status_code >= 400:
+        uow.discard()
+      return response
+  return wrapper
+
+def commit():
+  """
+  Commit the session, or only flush it inside a unit of work
+  """
+  session = db.session()
+  if session.info.get(UNIT_OF_WORK_KEY):
+    session.flush()
+  else:
+    session.commit()
+
+def _copy_value(value):
+  if value is None:
+    return '\\N'
+  if isinstance(value, bool):
+    return 't' if value else 'f'
+  if isinstance(value, datetime.datetime):
+    return value.isoformat()
+  return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def bulk_insert(table, rows):
+  """
+  Insert a list of row dicts in the session's db transaction, with COPY on
+  postgresql and a single executemany on other databases. The caller commits
+  """
+  if not rows:
+    return
+  connection = db.session.connection()
+  if connection.dialect.name != 'postgresql':
+    connection.execute(table.insert(), rows)
+    return
+
+  columns = list(rows[0].keys())
+  buf = io.StringIO()
+  for row in rows:
+    buf.write('\t'.join([_copy_value(row[column]) for column in columns]))
+    buf.write('\n')
+  buf.seek(0)
+  with connection.connection.cursor() as cursor:
+    cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table.name, ', '.join(columns)), buf)
@@ -0,0 +1,123 @@
+import datetime
+import re
+from urllib.parse import urlencode
+from flask import request, Response, stream_with_context
+from src import strings
+from src.batch_files import NDJSON_FORMAT
+from src.serializers import to_json
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+STREAM_CHUNK_SIZE = 500
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d')
+# a '+' left unescaped in the query string is read as a space
+UTC_OFFSET = re.compile(r'(Z|[+\- ]\d{2}:?\d{2})$')
+
+def get_page_args(args):
+  """
+  Read the keyset pagination parameters, returns ((after, limit), error)
+  """
+  try:
+    after = int(args.get(strings.AFTER_KEY, 0))
+    limit = int(args.get(strings.LIMIT_KEY, DEFAULT_PAGE_LIMIT))
+  except ValueError:
+    return None, {'error': '"after" and "limit" must be integers'}
+  if after < 0:
+    return None, {'error': '"after" must be a positive id'}
+  if limit <= 0 or limit > MAX_PAGE_LIMIT:
+    return None, {'error': '"limit" must be between 1 and %d' % MAX_PAGE_LIMIT}
+  return (after, limit), None
+
+def _parse_datetime(value):
+  """
+  Naive UTC datetime of an ISO 8601 date or datetime, with or without a UTC
+  offset. Parsed here since the marshmallow parser drops the offset when
+  python-dateutil is not installed
+  """
+  offset = UTC_OFFSET.search(value) if 'T' in value else None
+  if offset:
+    value = value[:offset.start()]
+  for format in DATETIME_FORMATS:
+    try:
+      parsed = datetime.datetime.strptime(value, format)
+      break
+    except ValueError:
+      continue
+  else:
+    raise ValueError('not an ISO 8601 date or datetime: %s' % value)
+  if offset and offset.group(1) != 'Z':
+    digits = offset.group(1)[1:].replace(':', '')
+    delta = datetime.timedelta(hours=int(digits[:2]), minutes=int(digits[2:]))
+    parsed = parsed + delta if offset.group(1)[0] == '-' else parsed - delta
+  return parsed
+
+def get_history_filters(args):
+  """
+  Read the from/to created_at range and the blocked filter of a transaction
+  history, returns ((created_from, created_to, blocked), error)
+  """
+  try:
+    created_from = _parse_datetime(args[strings.FROM_KEY]) if args.get(strings.FROM_KEY) else None
+    created_to = _parse_datetime(args[strings.TO_KEY]) if args.get(strings.TO_KEY) else None
+  except ValueError:
+    return None, {'error': '"from" and "to" must be ISO 8601 dates or datetimes'}
+  blocked = args.get(strings.BLOCKED_KEY, '').lower()
+  if blocked not in ('', 'true', 'false'):
+    return None, {'error': '"blocked" must be true or false'}
+  return (created_from, created_to, {'': None, 'true': True, 'false': False}[blocked]), None
+
+def is_stream_requested(args):
+  return args.get(strings.STREAM_KEY, '').lower() in ('1', 'true', 'yes')
+
+def is_summary_requested(args):
+  return args.get(strings.SUMMARY_KEY, '').lower() in ('1', 'true', 'yes')
+
+def is_ndjson_requested(args):
+  return args.get(strings.FORMAT_KEY, '').lower() == NDJSON_FORMAT
+
+def next_page_headers(rows, limit):
+  """
+  Cursor headers for a page, only set when there may be more rows
+  """
+  if len(rows) < limit:
+    return {}
+  cursor = rows[-1].id
+  # the next page keeps the request's filters
+  args = request.args.to_dict()
+  args[strings.AFTER_KEY] = cursor
+  args[strings.LIMIT_KEY] = limit
+  link = '<%s?%s>; rel="next"' % (request.base_url, urlencode(sorted(args.items())))
+  return {strings.NEXT_CURSOR_HEADER: str(cursor), 'Link': link}
+
+def stream_json_array(rows, dump):
+  """
+  Yield a JSON array one serialized row at a time
+  """
+  yield '['
+  first = True
+  for row in rows:
+    if not first:
+      yield ','
+    first = False
+    yield to_json(dump(row))
+  yield ']'
+
+def stream_ndjson(rows, dump):
+  """
+  Yield one serialized row per line
+  """
+  for row in rows:
+    yield to_json(dump(row)) + '\n'
+
+def stream_response(rows, dump, ndjson=False):
+  """
+  Streaming JSON array or NDJSON response, rows are serialized as they
+  are fetched
+  """
+  if ndjson:
+    return Response(stream_with_context(stream_ndjson(rows, dump)), mimetype="application/x-ndjson", status=200)
+  return Response(
+      stream_with_context(stream_json_array(rows, dump)),
+      mimetype="application/json",
+      status=200
+  )
@@ -0,0 +1,44 @@
+import time
+from functools import wraps
+from flask import current_app, request
+from src import strings
+from src.models import db, REPLICA_BIND, USE_REPLICA_KEY
+
+# Routing of the read only views to the replica. A client that wrote less
+# than READ_YOUR_WRITES_WINDOW seconds ago carries a cookie with the time of
+# its write and keeps reading from the primary until the replica caught up
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+def replica_configured():
+  return bool((current_app.config.get('SQLALCHEMY_BINDS') or {}).get(REPLICA_BIND))
+
+def _wrote_recently():
+  try:
+    last_write = float(request.cookies.get(strings.LAST_WRITE_COOKIE, 0))
+  except ValueError:
+    return False
+  return time.time() - last_write < current_app.config.get('READ_YOUR_WRITES_WINDOW', 0)
+
+def read_only(view):
+  """
+  Serve a view from the replica when there is one
+  """
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    if replica_configured() and not _wrote_recently():
+      # kept until the session is removed, streamed responses read after the view returned
+      db.session().info[USE_REPLICA_KEY] = True
+    return view(*args, **kwargs)
+  return wrapper
+
+def init_app(app):
+  """
+  Mark the clients of successful writes for the read your writes window
+  """
+  @app.after_request
+  def mark_write(response):
+    window = app.config.get('READ_YOUR_WRITES_WINDOW')
+    if request.method not in SAFE_METHODS and response.status_code < 400 and window and replica_configured():
+      response.set_cookie(strings.LAST_WRITE_COOKIE, repr(time.time()), max_age=int(window) + 1, httponly=True)
+    return response
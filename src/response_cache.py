@@ -0,0 +1,204 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from src.metrics import registry
+
+# Serialized card and merchant details by entity. An entry holds the bodies
+# of one version of the entity, one per representation (query string), so a
+# write that bumps the version makes its old bodies unreachable. The write
+# paths also invalidate the entities they change to free the memory at once.
+# Only versioned bodies are cached: a merchant's version does not follow its
+# transactions, so the merchant bodies made of them never get here
+
+CARD = 'card'
+MERCHANT = 'merchant'
+MAX_REPRESENTATIONS = 16
+SHARED_KEY_PREFIX = 'responses:'
+
+def _entry_size(entry):
+  return sum([len(x) for x in entry[1].values()])
+
+class MemoryBackend():
+  """
+  Entries of the worker process in LRU order, bounded by the size of the
+  bodies they hold
+  """
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.entries.move_to_end(key)
+      return entry
+
+  def set(self, key, entry):
+    size = _entry_size(entry)
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.bytes -= _entry_size(old)
+      if size > self.max_bytes:
+        return
+      self.entries[key] = entry
+      self.bytes += size
+      while self.bytes > self.max_bytes:
+        key, old = self.entries.popitem(last=False)
+        self.bytes -= _entry_size(old)
+
+  def delete(self, key):
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.bytes -= _entry_size(old)
+
+  def stats(self):
+    with self.lock:
+      return {'entries': len(self.entries), 'bytes': self.bytes}
+
+class LocalClient():
+  """
+  In-process stand-in for the client of a shared key/value store such as
+  redis: bytes values, set(key, value, ex=seconds) and delete(key)
+  """
+  def __init__(self):
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      item = self.values.get(key)
+      if item is None or (item[1] and item[1] < time.monotonic()):
+        return None
+      return item[0]
+
+  def set(self, key, value, ex=None):
+    with self.lock:
+      self.values[key] = (value, time.monotonic() + ex if ex else None)
+
+  def delete(self, key):
+    with self.lock:
+      self.values.pop(key, None)
+
+  def stats(self):
+    with self.lock:
+      return {'entries': len(self.values), 'bytes': sum([len(x[0]) for x in self.values.values()])}
+
+class SharedBackend():
+  """
+  Entries in a shared key/value store, so every worker sees the bodies and
+  the invalidations of the others. They expire after ttl seconds
+  """
+  def __init__(self, client, ttl):
+    self.client = client
+    self.ttl = ttl
+
+  def get(self, key):
+    raw = self.client.get(SHARED_KEY_PREFIX + key)
+    if raw is None:
+      return None
+    version, bodies = json.loads(raw.decode())
+    return tuple(version), dict([(k, v.encode()) for k, v in bodies.items()])
+
+  def set(self, key, entry):
+    version, bodies = entry
+    raw = json.dumps([version, dict([(k, v.decode()) for k, v in bodies.items()])])
+    self.client.set(SHARED_KEY_PREFIX + key, raw.encode(), ex=self.ttl)
+
+  def delete(self, key):
+    self.client.delete(SHARED_KEY_PREFIX + key)
+
+  def stats(self):
+    # only the stand-in can tell the size of the store
+    stats = getattr(self.client, 'stats', None)
+    return stats() if stats else {}
+
+class ResponseCache():
+  """
+  Response bodies by entity and version over a backend, None disables it
+  """
+  def __init__(self):
+    self.configure(None)
+
+  def configure(self, backend):
+    self.backend = backend
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  @property
+  def enabled(self):
+    return self.backend is not None
+
+  def get(self, kind, id, version, representation):
+    if not self.backend:
+      return None
+    entry = self.backend.get('%s:%d' % (kind, id))
+    body = entry[1].get(representation) if entry and entry[0] == version else None
+    with self.lock:
+      if body is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+    return body
+
+  def set(self, kind, id, version, representation, body):
+    if not self.backend:
+      return
+    key = '%s:%d' % (kind, id)
+    entry = self.backend.get(key)
+    if entry and entry[0] > version:
+      return
+    bodies = dict(entry[1]) if entry and entry[0] == version and len(entry[1]) < MAX_REPRESENTATIONS else {}
+    bodies[representation] = body
+    self.backend.set(key, (version, bodies))
+
+  def invalidate(self, kind, id):
+    if self.backend:
+      self.backend.delete('%s:%d' % (kind, id))
+
+  def stats(self):
+    with self.lock:
+      stats = {'hits': self.hits, 'misses': self.misses}
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0.0
+    if self.backend:
+      stats.update(self.backend.stats())
+    return stats
+
+responses = ResponseCache()
+
+RESPONSE_CACHE_HITS = registry.counter('response_cache_hits_total', 'Card and merchant details served from the cache')
+RESPONSE_CACHE_MISSES = registry.counter('response_cache_misses_total', 'Card and merchant details serialized')
+RESPONSE_CACHE_HIT_RATIO = registry.gauge('response_cache_hit_ratio', 'Share of the lookups served from the cache')
+RESPONSE_CACHE_ENTRIES = registry.gauge('response_cache_entries', 'Entities in the response cache')
+RESPONSE_CACHE_BYTES = registry.gauge('response_cache_bytes', 'Size of the cached response bodies')
+
+def _collect():
+  stats = responses.stats()
+  RESPONSE_CACHE_HITS.set((), stats['hits'])
+  RESPONSE_CACHE_MISSES.set((), stats['misses'])
+  RESPONSE_CACHE_HIT_RATIO.set((), stats['hit_ratio'])
+  if 'bytes' in stats:
+    RESPONSE_CACHE_ENTRIES.set((), stats['entries'])
+    RESPONSE_CACHE_BYTES.set((), stats['bytes'])
+
+registry.add_collector(_collect)
+
+def init_app(app):
+  """
+  Create the backend named by RESPONSE_CACHE_BACKEND, none disables the
+  cache. The shared backend uses RESPONSE_CACHE_CLIENT or the local stand-in
+  """
+  name = app.config.get('RESPONSE_CACHE_BACKEND')
+  backend = None
+  if name == 'memory':
+    backend = MemoryBackend(app.config['RESPONSE_CACHE_MAX_BYTES'])
+  elif name == 'shared':
+    backend = SharedBackend(app.config.get('RESPONSE_CACHE_CLIENT') or LocalClient(), app.config['RESPONSE_CACHE_TTL'])
+  responses.configure(backend)
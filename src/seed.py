@@ -0,0 +1,123 @@
+import bisect
+import datetime
+import itertools
+import random
+import time
+from sqlalchemy import bindparam
+from src import strings
+from src.models import db, bulk_insert
+from src.models.CardModel import CardModel
+from src.models.MerchantModel import MerchantModel
+from src.models.TransactionModel import TransactionModel
+
+SEED_CHUNK_SIZE = 50000
+# card numbers are the run prefix and the card's index
+RUN_PREFIX_DIGITS = 9
+
+def power_law_weights(count, alpha):
+  """
+  Cumulative weights of a zipf like distribution: the item of rank r gets a
+  share proportional to 1 / r**alpha
+  """
+  return list(itertools.accumulate([1.0 / (rank ** alpha) for rank in range(1, count + 1)]))
+
+def _insert_entities(model, key, prefix, values, chunk_size):
+  """
+  Bulk insert cards or merchants whose key starts with prefix and return
+  their ids in insertion order
+  """
+  for start in range(0, len(values), chunk_size):
+    bulk_insert(model.__table__, values[start:start + chunk_size])
+    db.session.commit()
+  column = getattr(model, key)
+  ids = dict(db.session.query(column, model.id).filter(column.like(prefix + '%')).all())
+  return [ids[x[key]] for x in values]
+
+def _new_run_prefix(rng):
+  """
+  Random prefix of the card numbers and merchant names of a run, drawn again
+  while rows of an earlier run use it so reseeding with the same random seed
+  does not collide
+  """
+  while True:
+    run = '9%0*d' % (RUN_PREFIX_DIGITS - 1, rng.randrange(10**(RUN_PREFIX_DIGITS - 1)))
+    if not db.session.query(CardModel.id).filter(CardModel.card_nbr.like(run + '%')).first() and \
+       not db.session.query(MerchantModel.id).filter(
+         MerchantModel.name.like('Seed merchant %s-%%' % run)).first():
+      return run
+
+def seed(cards, merchants, transactions, alpha=1.1, hold_share=0.05, topup_share=0.15,
+         days=365, chunk_size=SEED_CHUNK_SIZE, random_seed=None, progress=None):
+  """
+  Generate cards, merchants and a transaction history. Cards and merchants
+  get transactions following a power law (a few hot cards and merchants, a
+  long tail), hold_share of the merchant transactions are outstanding holds
+  and cards are topped up whenever a payment needs more than their balance.
+  Rows are written with bulk inserts, chunk_size per db transaction, and the
+  card balances are set at the end. Returns a stats dict
+  """
+  index_digits = CardModel.card_nbr.type.length - RUN_PREFIX_DIGITS
+  if cards > 10**index_digits:
+    raise ValueError('at most %d cards fit in a card number' % 10**index_digits)
+  rng = random.Random(random_seed)
+  start = time.time()
+  # card numbers and merchant names of a run share a random prefix
+  run = _new_run_prefix(rng)
+
+  merchant_prefix = 'Seed merchant %s-' % run
+  merchant_ids = _insert_entities(MerchantModel, strings.NAME_KEY, merchant_prefix, [
+    {strings.NAME_KEY: '%s%d' % (merchant_prefix, i)} for i in range(merchants)], chunk_size)
+  card_ids = _insert_entities(CardModel, strings.CARD_NBR_KEY, run, [
+    {strings.NAME_KEY: 'Seed user %d' % i, strings.CARD_NBR_KEY: '%s%0*d' % (run, index_digits, i),
+     'available': 0, 'blocked': 0} for i in range(cards)], chunk_size)
+  # hot entities are spread over the id range
+  rng.shuffle(card_ids)
+  rng.shuffle(merchant_ids)
+  card_weights = power_law_weights(len(card_ids), alpha)
+  merchant_weights = power_law_weights(len(merchant_ids), alpha)
+
+  available = dict([(card_id, 0.0) for card_id in card_ids])
+  blocked = dict([(card_id, 0.0) for card_id in card_ids])
+  created_at = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+  step = datetime.timedelta(seconds=days * 86400.0 / max(transactions, 1))
+  written = 0
+
+  while written < transactions:
+    count = min(chunk_size, transactions - written)
+    chunk_cards = rng.choices(card_ids, cum_weights=card_weights, k=count)
+    rows = []
+    for card_id in chunk_cards:
+      created_at += step
+      amount = round(rng.lognormvariate(3, 1), 2)
+      if merchant_ids and rng.random() >= topup_share:
+        if available[card_id] < amount:
+          top_up = round(amount + rng.lognormvariate(5, 1), 2)
+          rows.append(TransactionModel.generate_transaction_row(card_id, None, top_up, False, created_at))
+          available[card_id] += top_up
+        merchant_id = merchant_ids[bisect.bisect(merchant_weights, rng.random() * merchant_weights[-1])]
+        hold = rng.random() < hold_share
+        rows.append(TransactionModel.generate_transaction_row(card_id, merchant_id, -1*amount, hold, created_at))
+        available[card_id] -= amount
+        if hold:
+          blocked[card_id] += amount
+      else:
+        rows.append(TransactionModel.generate_transaction_row(card_id, None, amount, False, created_at))
+        available[card_id] += amount
+    TransactionModel.insert_many(rows)
+    db.session.commit()
+    written += len(rows)
+    if progress:
+      progress(written, transactions, time.time() - start)
+
+  update = CardModel.__table__.update() \
+    .where(CardModel.__table__.c.id == bindparam('card_id')) \
+    .values(available=bindparam('card_available'), blocked=bindparam('card_blocked'))
+  balances = [{'card_id': card_id, 'card_available': round(available[card_id], 2),
+               'card_blocked': round(blocked[card_id], 2)} for card_id in card_ids]
+  for chunk_start in range(0, len(balances), chunk_size):
+    db.session.execute(update, balances[chunk_start:chunk_start + chunk_size])
+    db.session.commit()
+
+  seconds = time.time() - start
+  return {'cards': cards, 'merchants': merchants, 'transactions': written,
+          'seconds': seconds, 'rows_per_second': written / seconds if seconds else 0}
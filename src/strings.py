@@ -12,3 +12,24 @@ TRANSACTIONS_KEY = "transactions"
 TRANSACTIONS_ID_KEY = "transactions_id"
 
 NAME_KEY = "name"
+CREATED_AT_KEY = "created_at"
+
+LIMIT_KEY = "limit"
+AFTER_KEY = "after"
+STREAM_KEY = "stream"
+SUMMARY_KEY = "summary"
+FIELDS_KEY = "fields"
+INCLUDE_KEY = "include"
+ASYNC_KEY = "async"
+FORMAT_KEY = "format"
+FROM_KEY = "from"
+TO_KEY = "to"
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENT_REPLAY_HEADER = "Idempotent-Replayed"
+LAST_WRITE_COOKIE = "last_write"
+
+OPERATION_KEY = "type"
+CAPTURE_OPERATION = "capture"
+REVERSE_OPERATION = "reverse"
+REFUND_OPERATION = "refund"
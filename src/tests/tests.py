@@ -4,9 +4,30 @@ import sys
 sys.path.insert(0, os.path.abspath('../'))
 import unittest
 import json
-from src.models import db
+from flask import json as flask_json
+import threading
+import time
+import io
+import tempfile
+import datetime
+from contextlib import contextmanager, redirect_stderr
+from sqlalchemy import event
+from src.models import db, postgresql_engine_options, REPLICA_BIND, unit_of_work, warm_pool
+from sqlalchemy.pool import NullPool, QueuePool
+from src.models.CardModel import CardModel
+from src.models.TransactionModel import TransactionModel
 from src.app import create_app
-from src import strings
+from src.funding import process_funding_file
+from src.hold_expiry import release_expired_holds
+from src.merchant_deletion import delete_merchant_in_chunks
+from src.seed import seed
+from src.serializers import dump, to_json
+from src.models.CardModel import CardSchema
+from src.models.MerchantModel import MerchantModel, MerchantSchema, MerchantSummarySchema
+from src.models.TransactionModel import TransactionSchema
+from src.benchmarks import load_test
+from src import cache, idempotency, response_cache, strings
+from src.models.IdempotencyKeyModel import IdempotencyKeyModel
 
 TEST_DB = os.getenv('TEST_DATABASE_URL')
 
@@ -28,6 +49,23 @@ class BasicTests(unittest.TestCase):
     def tearDown(self):
       pass
 
+    @contextmanager
+    def assert_query_budget(self, budget):
+      """
+      Fail if the requests made in the block issue more than budget SQL statements
+      """
+      statements = []
+      def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+      with self.app.application.app_context():
+        engine = db.get_engine()
+      event.listen(engine, 'before_cursor_execute', count)
+      try:
+        yield statements
+      finally:
+        event.remove(engine, 'before_cursor_execute', count)
+      self.assertLessEqual(len(statements), budget, '\n'.join(statements))
+
     def get_cards(self):
       rv = self.app.get(strings.CARD_ENDPOINT, follow_redirects=True)
       self.assertEqual(rv.status_code, 200)
@@ -83,6 +121,11 @@ class BasicTests(unittest.TestCase):
       self.assertEqual(rv.status_code, expected_response_code)
       return rv
 
+    def create_auth_requests_batch(self, merchant_id, items, expected_response_code):
+      rv = self.app.post(strings.MERCHANT_ENDPOINT+str(merchant_id)+"/auth_requests/batch", json=items)
+      self.assertEqual(rv.status_code, expected_response_code)
+      return rv
+
     def refund(self, merchant_id, card_nbr, amount, expected_response_code):
       rv = self.app.post(strings.MERCHANT_ENDPOINT+str(merchant_id)+"/refund",
       json={strings.CARD_NBR_KEY: card_nbr, strings.AMOUNT_KEY: amount})
@@ -510,5 +553,1076 @@ class BasicTests(unittest.TestCase):
       #Refudn non existing card
       response = self.refund(1, card_nbr, 3, 404)
 
+    def create_merchant_history(self, merchant_name):
+      response = self.create_merchant(merchant_name, 201)
+      for i in range(3):
+        card_nbr = "12345%d" % i
+        response = self.create_card("Test user %d" % i, card_nbr, 201)
+        response = self.top_up_card(i + 1, 10, 201)
+        response = self.create_auth_request(1, card_nbr, 2, 201)
+        response = self.create_auth_request(1, card_nbr, 3, 201)
+      #One sale that stays in the card history
+      response = self.capture(1, 2, 2, 200)
+
+    def check_merchant_deleted(self):
+      response = self.delete_merchant(1, 404)
+      with self.app.application.app_context():
+        self.assertEqual(TransactionModel.query.filter_by(blocked=True).count(), 0)
+        self.assertEqual(TransactionModel.query.filter_by(blocked=False).count(), 4)
+        self.assertEqual(CardModel.get_card(1).available, 8)
+        self.assertEqual(CardModel.get_card(2).available, 10)
+      for card_id in range(1, 4):
+        self.check_balances_match_ledger(card_id)
+
+    def test_delete_merchant_releases_holds(self):
+      self.create_merchant_history("CoffeMaker")
+      with self.assert_query_budget(6):
+        response = self.delete_merchant(1, 204)
+      self.check_merchant_deleted()
+
+    def test_delete_merchant_async(self):
+      self.create_merchant_history("CoffeMaker")
+      rv = self.app.delete(strings.MERCHANT_ENDPOINT + "1?async=true")
+      self.assertEqual(rv.status_code, 202)
+      job = json.loads(rv.get_data().decode())['Job']
+      location = rv.headers['Location']
+      self.assertTrue(location.endswith('/jobs/' + job['id']))
+      for i in range(100):
+        rv = self.app.get(location)
+        self.assertEqual(rv.status_code, 200)
+        job = json.loads(rv.get_data().decode())['Job']
+        if job['status'] in ('done', 'failed'):
+          break
+        time.sleep(0.05)
+      self.assertEqual(job['status'], 'done')
+      self.assertEqual(job['done'], 5)
+      self.assertEqual(job['total'], 5)
+      self.check_merchant_deleted()
+      rv = self.app.get(strings.MERCHANT_ENDPOINT + "jobs/unknown")
+      self.assertEqual(rv.status_code, 404)
+
+    def test_delete_merchant_in_chunks(self):
+      self.create_merchant_history("CoffeMaker")
+      progress = []
+      with self.app.application.app_context():
+        released = delete_merchant_in_chunks(1, 2, lambda done, total: progress.append((done, total)))
+      self.assertEqual(released, 5)
+      self.assertEqual(progress, [(0, 5), (2, 5), (4, 5), (5, 5), (5, 5)])
+      self.check_merchant_deleted()
+
+    def test_unit_of_work(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 10, 201)
+      response = self.create_auth_request(1, "123456", 5, 201)
+
+      #A partial capture is one commit
+      commits = []
+      def count(session):
+        commits.append(session)
+      event.listen(db.session, 'after_commit', count)
+      try:
+        response = self.capture(1, 2, 3, 200)
+        response = self.capture(1, 2, 3, 403)
+      finally:
+        event.remove(db.session, 'after_commit', count)
+      self.assertEqual(len(commits), 1)
+
+      #An error in the block rolls every change back
+      with self.app.application.app_context():
+        with self.assertRaises(ValueError):
+          with unit_of_work():
+            CardModel.update_balance(1, 100)
+            TransactionModel.generate_transaction(1, None, 100, False).save()
+            raise ValueError()
+        self.assertEqual(TransactionModel.query.count(), 3)
+      self.check_balances_match_ledger(1)
+      self.check_first_card("Test user", "123456", 5, 2)
+
+    def test_expire_holds(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 10, 201)
+      for amount in [1, 2, 3]:
+        response = self.create_auth_request(1, "123456", amount, 201)
+      response = self.capture(1, 2, 1, 200)
+
+      with self.app.application.app_context():
+        old = datetime.datetime.utcnow() - datetime.timedelta(days=8)
+        TransactionModel.query.update({TransactionModel.created_at: old})
+        TransactionModel.query.filter_by(id=4).update({TransactionModel.created_at: datetime.datetime.utcnow()})
+        db.session.commit()
+        progress = []
+        stats = release_expired_holds(7*24*3600, 1, progress=lambda released, seconds: progress.append(released))
+        self.assertEqual(stats['released'], 1)
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(progress, [1])
+        self.assertEqual([x.id for x in TransactionModel.query.filter_by(blocked=True)], [4])
+        #The capture is settled, the young hold is kept
+        self.assertEqual(TransactionModel.query.count(), 3)
+      self.check_balances_match_ledger(1)
+      self.check_first_card("Test user", "123456", 6, 3)
+
+    def check_idempotent_requests(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      headers = {strings.IDEMPOTENCY_KEY_HEADER: 'topup-1'}
+      url = strings.CARD_ENDPOINT + "1/topup"
+      first = self.app.post(url, json={strings.AMOUNT_KEY: 10}, headers=headers)
+      again = self.app.post(url, json={strings.AMOUNT_KEY: 10}, headers=headers)
+      self.assertEqual(first.status_code, 201)
+      self.assertEqual(again.status_code, 201)
+      self.assertEqual(again.get_data(), first.get_data())
+      self.assertEqual(again.headers.get(strings.IDEMPOTENT_REPLAY_HEADER), 'true')
+      #Same key for another request
+      rv = self.app.post(url, json={strings.AMOUNT_KEY: 11}, headers=headers)
+      self.assertEqual(rv.status_code, 422)
+      self.check_first_card("Test user", "123456", 10, 0)
+
+      #Concurrent duplicates are collapsed into one hold
+      status_codes = []
+      bodies = []
+      def auth():
+        client = self.app.application.test_client()
+        rv = client.post(strings.MERCHANT_ENDPOINT + "1/auth_request",
+                         json={strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: 1},
+                         headers={strings.IDEMPOTENCY_KEY_HEADER: 'auth-1'})
+        status_codes.append(rv.status_code)
+        bodies.append(rv.get_data())
+      workers = [threading.Thread(target=auth) for i in range(4)]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+      self.assertEqual(status_codes, [201] * 4)
+      self.assertEqual(len(set(bodies)), 1)
+      self.check_first_card("Test user", "123456", 9, 1)
+      self.check_balances_match_ledger(1)
+
+      #Error responses are replayed too, requests without a key are not
+      rv = self.refund(1, "123456", 5, 403)
+      for i in range(2):
+        rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/refund", headers={strings.IDEMPOTENCY_KEY_HEADER: 'refund-1'},
+                           json={strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: 5})
+        self.assertEqual(rv.status_code, 403)
+      self.assertEqual(rv.headers.get(strings.IDEMPOTENT_REPLAY_HEADER), 'true')
+
+      #Uploads of the same size are told apart by their content
+      headers = {strings.IDEMPOTENCY_KEY_HEADER: 'clearing-1'}
+      url = strings.MERCHANT_ENDPOINT + "1/clearing?format=csv"
+      clearing = "type,transactions_id,card_nbr,amount\nrefund,,123456,%d\n"
+      first = self.app.post(url, data=clearing % 1, headers=headers)
+      again = self.app.post(url, data=clearing % 1, headers=headers)
+      self.assertEqual(first.status_code, 200)
+      self.assertEqual(again.get_data(), first.get_data())
+      self.assertEqual(again.headers.get(strings.IDEMPOTENT_REPLAY_HEADER), 'true')
+      rv = self.app.post(url, data=clearing % 2, headers=headers)
+      self.assertEqual(rv.status_code, 422)
+
+      #A key left in progress by a lost worker is taken over after the lease
+      app = self.app.application
+      store = app.extensions['idempotency_store']
+      headers = {strings.IDEMPOTENCY_KEY_HEADER: 'topup-2'}
+      url = strings.CARD_ENDPOINT + "1/topup"
+      with app.app_context():
+        state, reservation = store.begin('topup-2', 'lost', 0)
+      self.assertEqual(state, 'new')
+      app.config['IDEMPOTENCY_WAIT'] = 0
+      rv = self.app.post(url, json={strings.AMOUNT_KEY: 2}, headers=headers)
+      self.assertEqual(rv.status_code, 422)
+      store.lease = 0
+      rv = self.app.post(url, json={strings.AMOUNT_KEY: 2}, headers=headers)
+      self.assertEqual(rv.status_code, 201)
+      with app.app_context():
+        store.complete('topup-2', reservation, idempotency.StoredResponse(500, b'', 'text/plain'))
+      store.lease = app.config['IDEMPOTENCY_LEASE']
+      again = self.app.post(url, json={strings.AMOUNT_KEY: 2}, headers=headers)
+      self.assertEqual(again.get_data(), rv.get_data())
+      self.check_first_card("Test user", "123456", 11, 1)
+
+    def test_idempotency_keys(self):
+      self.check_idempotent_requests()
+
+      #Eviction keeps the keys in progress until their lease ends
+      store = idempotency.MemoryStore(ttl=60, lease=60, max_size=1)
+      state, running = store.begin('running', 'a', 0)
+      state, done = store.begin('done', 'b', 0)
+      store.complete('done', done, idempotency.StoredResponse(200, b'', 'text/plain'))
+      self.assertEqual(store.begin('next', 'c', 0)[0], 'new')
+      self.assertEqual(list(store.entries), ['running', 'next'])
+      self.assertEqual(store.begin('running', 'a', 0), ('in_progress', None))
+
+    def test_idempotency_keys_database_store(self):
+      app = self.app.application
+      app.config['IDEMPOTENCY_STORE'] = 'database'
+      idempotency.init_app(app)
+      self.check_idempotent_requests()
+      with app.app_context():
+        self.assertEqual(IdempotencyKeyModel.query.count(), 5)
+        app.config['IDEMPOTENCY_TTL'] = 0
+        idempotency.init_app(app)
+        self.assertEqual(app.extensions['idempotency_store'].purge_expired(), 5)
+
+    def test_postgresql_engine_options(self):
+      app = create_app('production')
+      app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://127.0.0.1/card_api_db'
+      app.config['DB_POOL_SIZE'] = 3
+      with app.app_context():
+        engine = db.get_engine()
+      #The engine is configured without connecting
+      self.assertIsInstance(engine.pool, QueuePool)
+      self.assertEqual(engine.pool.size(), 3)
+      options = postgresql_engine_options(app.config)
+      self.assertEqual(options['connect_args']['options'], '-c statement_timeout=30000 -c lock_timeout=2000')
+      self.assertTrue(options['pool_pre_ping'])
+
+      app.config['DB_PGBOUNCER'] = True
+      options = postgresql_engine_options(app.config)
+      self.assertIs(options['poolclass'], NullPool)
+      self.assertNotIn('options', options['connect_args'])
+      self.assertEqual(options['execution_options']['transaction_settings'],
+                       [('statement_timeout', 30000), ('lock_timeout', 2000)])
+      #Behind PgBouncer there is no pool to warm, nothing is opened
+      app = create_app('production')
+      app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://127.0.0.1/card_api_db'
+      app.config['DB_PGBOUNCER'] = True
+      app.config['DB_POOL_WARM'] = 2
+      with app.app_context():
+        self.assertIsInstance(db.get_engine().pool, NullPool)
+      self.assertEqual(warm_pool(app), 0)
+
+    def test_replica_routing(self):
+      app = self.app.application
+      replica_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+      replica_db.close()
+      app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: 'sqlite:///' + replica_db.name}
+      try:
+        with app.app_context():
+          db.Model.metadata.create_all(db.get_engine(app, bind=REPLICA_BIND))
+        response = self.create_card("Test user", "123456", 201)
+
+        #The writer reads its own write from the primary
+        self.assertEqual(len(json.loads(self.get_cards().get_data().decode())), 1)
+        self.assertEqual(self.app.get(strings.CARD_ENDPOINT + "1").status_code, 200)
+
+        #Other clients read from the replica, which does not replicate here
+        other = app.test_client()
+        rv = other.get(strings.CARD_ENDPOINT)
+        self.assertEqual(json.loads(rv.get_data().decode()), [])
+        rv = other.get(strings.CARD_ENDPOINT + "?stream=true")
+        self.assertEqual(json.loads(rv.get_data().decode()), [])
+        self.assertEqual(other.get(strings.CARD_ENDPOINT + "1").status_code, 404)
+        #Writes go to the primary
+        rv = other.post(strings.CARD_ENDPOINT + "1/topup", json={strings.AMOUNT_KEY: 5})
+        self.assertEqual(rv.status_code, 201)
+
+        #Once the window is over the writer reads from the replica too
+        app.config['READ_YOUR_WRITES_WINDOW'] = 0
+        self.assertEqual(json.loads(self.get_cards().get_data().decode()), [])
+        app.config['SQLALCHEMY_BINDS'] = {}
+        self.check_first_card("Test user", "123456", 5, 0)
+      finally:
+        os.unlink(replica_db.name)
+
+    def test_refund_limit_is_per_card(self):
+      response = self.create_merchant("CoffeMaker", 201)
+      for i in range(5):
+        card_nbr = "12345%d" % i
+        response = self.create_card("Test user %d" % i, card_nbr, 201)
+        response = self.top_up_card(i + 1, 10, 201)
+        response = self.create_auth_request(1, card_nbr, 5, 201)
+        response = self.capture(1, 2*(i + 1), 5, 200)
+
+      #Other cards' sales with the merchant do not count
+      response = self.refund(1, "123450", 6, 403)
+      #The limit is one aggregate, not a walk over the merchant's history
+      with self.assert_query_budget(6):
+        response = self.refund(1, "123450", 4, 201)
+      response = self.refund(1, "123450", 1, 201)
+      response = self.refund(1, "123450", 1, 403)
+      self.check_balances_match_ledger(1)
+
+    def check_balances_match_ledger(self, card_id):
+      with self.app.application.app_context():
+        card = CardModel.get_card(card_id)
+        transactions = TransactionModel.query.filter_by(card_id=card_id).all()
+        self.assertAlmostEqual(card.available, sum([x.amount for x in transactions]))
+        self.assertAlmostEqual(card.blocked, -1*sum([x.amount for x in transactions if x.blocked]))
+
+    def test_balances_match_ledger(self):
+      #Create card and merchant
+      card_nbr = "123456"
+      response = self.create_card("Test user", card_nbr, 201)
+      response = self.create_merchant("CoffeMaker", 201)
+
+      #Run every kind of operation against the card
+      response = self.top_up_card(1, 20, 201)
+      self.check_balances_match_ledger(1)
+      response = self.create_auth_request(1, card_nbr, 10, 201)
+      response = self.create_auth_request(1, card_nbr, 4, 201)
+      self.check_balances_match_ledger(1)
+      response = self.capture(1, 2, 3, 200)
+      self.check_balances_match_ledger(1)
+      response = self.capture(1, 2, 7, 200)
+      self.check_balances_match_ledger(1)
+      response = self.reverse(1, 3, 1, 201)
+      self.check_balances_match_ledger(1)
+      response = self.refund(1, card_nbr, 5, 201)
+      self.check_balances_match_ledger(1)
+      response = self.reverse(1, 3, 3, 201)
+      self.check_balances_match_ledger(1)
+
+      #A new hold is released when the merchant is deleted
+      response = self.create_auth_request(1, card_nbr, 2, 201)
+      self.delete_merchant(1, 204)
+      self.check_first_card("Test user", card_nbr, 15, 0)
+
+    def test_concurrent_auth_requests_do_not_overspend(self):
+      card_nbr = "123456"
+      amount = 100
+      threads = 8
+      requests_per_thread = 25
+      response = self.create_card("Test user", card_nbr, 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, amount, 201)
+
+      status_codes = []
+      def hammer():
+        client = self.app.application.test_client()
+        for i in range(requests_per_thread):
+          rv = client.post(strings.MERCHANT_ENDPOINT+"1/auth_request",
+                           json={strings.CARD_NBR_KEY: card_nbr, strings.AMOUNT_KEY: 1})
+          status_codes.append(rv.status_code)
+
+      workers = [threading.Thread(target=hammer) for i in range(threads)]
+      for worker in workers:
+        worker.start()
+      for worker in workers:
+        worker.join()
+
+      #Every request got an answer, exactly the funded amount was authorized.
+      #This checks correctness only, throughput is measured by the load test
+      self.assertEqual(len(status_codes), threads * requests_per_thread)
+      self.assertEqual(status_codes.count(201), amount)
+      self.assertEqual(status_codes.count(400), len(status_codes) - amount)
+      self.check_first_card("Test user", card_nbr, 0, amount)
+      self.check_balances_match_ledger(1)
+
+    def test_concurrent_duplicate_captures_and_reverses(self):
+      card_nbr = "123456"
+      rounds = 10
+      response = self.create_card("Test user", card_nbr, 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 1000, 201)
+
+      def race(operation, amount):
+        status_codes = []
+        barrier = threading.Barrier(2)
+        def post():
+          client = self.app.application.test_client()
+          barrier.wait()
+          rv = client.post(strings.MERCHANT_ENDPOINT + "1/" + operation,
+                           json={strings.TRANSACTIONS_ID_KEY: hold_id, strings.AMOUNT_KEY: amount})
+          status_codes.append(rv.status_code)
+        workers = [threading.Thread(target=post) for i in range(2)]
+        for worker in workers:
+          worker.start()
+        for worker in workers:
+          worker.join()
+        return sorted(status_codes)
+
+      #Only one of two identical requests changes the hold
+      for i in range(rounds):
+        hold_id = json.loads(self.create_auth_request(1, card_nbr, 10, 201).get_data().decode())['Transaction']['id']
+        self.assertEqual(race("reverse", 10), [201, 404])
+        hold_id = json.loads(self.create_auth_request(1, card_nbr, 10, 201).get_data().decode())['Transaction']['id']
+        self.assertEqual(race("capture", 10), [200, 404])
+        hold_id = json.loads(self.create_auth_request(1, card_nbr, 10, 201).get_data().decode())['Transaction']['id']
+        self.assertIn(race("capture", 4), [[200, 200], [200, 404]])
+      self.check_balances_match_ledger(1)
+
+    def test_cards_keyset_pagination(self):
+      for i in range(3):
+        response = self.create_card("Test user %d" % i, "12345%d" % i, 201)
+
+      #First page has a cursor to the next one
+      rv = self.app.get(strings.CARD_ENDPOINT + "?limit=2")
+      self.assertEqual(rv.status_code, 200)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([x[strings.CARD_NBR_KEY] for x in data], ["123450", "123451"])
+      cursor = rv.headers[strings.NEXT_CURSOR_HEADER]
+
+      #Last page has no cursor
+      rv = self.app.get(strings.CARD_ENDPOINT + "?limit=2&after=" + cursor)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([x[strings.CARD_NBR_KEY] for x in data], ["123452"])
+      self.assertNotIn(strings.NEXT_CURSOR_HEADER, rv.headers)
+
+      #Invalid parameters
+      rv = self.app.get(strings.CARD_ENDPOINT + "?limit=0")
+      self.assertEqual(rv.status_code, 400)
+      rv = self.app.get(strings.CARD_ENDPOINT + "?after=abc")
+      self.assertEqual(rv.status_code, 400)
+
+    def test_card_transactions_history(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 10, 201)
+      for amount in [1, 2, 3]:
+        response = self.create_auth_request(1, "123456", amount, 201)
+      response = self.capture(1, 2, 1, 200)
+      with self.app.application.app_context():
+        TransactionModel.query.filter_by(id=1).update(
+          {TransactionModel.created_at: datetime.datetime(2026, 1, 1, 12, 0)})
+        db.session.commit()
+      url = strings.CARD_ENDPOINT + "1/transactions"
+
+      def ids(rv):
+        self.assertEqual(rv.status_code, 200)
+        return [x['id'] for x in json.loads(rv.get_data().decode())]
+      self.assertEqual(ids(self.app.get(url + "?blocked=true")), [3, 4])
+      self.assertEqual(ids(self.app.get(url + "?blocked=false")), [1, 2])
+      self.assertEqual(ids(self.app.get(url + "?to=2026-01-02")), [1])
+      self.assertEqual(ids(self.app.get(url + "?from=2026-01-01T13:00:00Z&blocked=false")), [2])
+      #The UTC offset is applied, escaped or not
+      self.assertEqual(ids(self.app.get(url + "?to=2026-01-01T13:30:00%2B02:00")), [])
+      self.assertEqual(ids(self.app.get(url + "?to=2026-01-01T14:30:00+02:00")), [1])
+      self.assertEqual(ids(self.app.get(url + "?to=2026-01-01T08:00:00-0430")), [1])
+      self.assertEqual(ids(self.app.get(url + "?to=2026-01-01T07:00:00-04:30")), [])
+
+      #The next page keeps the filters
+      rv = self.app.get(url + "?blocked=true&limit=1")
+      self.assertEqual(ids(rv), [3])
+      self.assertIn('blocked=true', rv.headers['Link'])
+      rv = self.app.get(url + "?blocked=true&limit=1&after=" + rv.headers[strings.NEXT_CURSOR_HEADER])
+      self.assertEqual(ids(rv), [4])
+
+      rv = self.app.get(url + "?format=ndjson&after=1&blocked=true")
+      self.assertEqual(rv.mimetype, 'application/x-ndjson')
+      lines = rv.get_data().decode().splitlines()
+      self.assertEqual([json.loads(x)['id'] for x in lines], [3, 4])
+
+      for query in ["?from=yesterday", "?from=2026-01-01T10:00:00+2", "?to=2026-13-01", "?blocked=maybe", "?limit=-1"]:
+        self.assertEqual(self.app.get(url + query).status_code, 400)
+      self.assertEqual(self.app.get(strings.CARD_ENDPOINT + "2/transactions").status_code, 404)
+
+    def test_merchant_transactions_and_summaries(self):
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.create_merchant("TeaMaker", 201)
+      for i in range(3):
+        card_nbr = "12345%d" % i
+        response = self.create_card("Test user %d" % i, card_nbr, 201)
+        response = self.top_up_card(i + 1, 10, 201)
+        response = self.create_auth_request(1, card_nbr, 2, 201)
+      response = self.capture(1, 2, 2, 200)
+      response = self.refund(1, "123450", 0.5, 201)
+      url = strings.MERCHANT_ENDPOINT + "1/transactions"
+
+      def ids(rv):
+        self.assertEqual(rv.status_code, 200)
+        return [x['id'] for x in json.loads(rv.get_data().decode())]
+      self.assertEqual(ids(self.app.get(url)), [2, 4, 6, 7])
+      self.assertEqual(ids(self.app.get(url + "?blocked=false")), [2, 7])
+      rv = self.app.get(url + "?blocked=true&limit=1&after=2")
+      self.assertEqual(ids(rv), [4])
+      self.assertEqual(rv.headers[strings.NEXT_CURSOR_HEADER], "4")
+      rv = self.app.get(url + "?format=ndjson&from=2000-01-01")
+      self.assertEqual([json.loads(x)['id'] for x in rv.get_data().decode().splitlines()], [2, 4, 6, 7])
+      self.assertEqual(self.app.get(url + "?to=never").status_code, 400)
+      self.assertEqual(self.app.get(strings.MERCHANT_ENDPOINT + "3/transactions").status_code, 404)
+
+      #Summaries count and sum the transactions without loading them
+      with self.assert_query_budget(2):
+        rv = self.app.get(strings.MERCHANT_ENDPOINT + "?summary=true")
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual(data[0], {'id': 1, 'name': "CoffeMaker", 'transactions_count': 4,
+                                 'holds_count': 2, 'held': 4.0, 'settled': 1.5})
+      self.assertEqual(data[1], {'id': 2, 'name': "TeaMaker", 'transactions_count': 0,
+                                 'holds_count': 0, 'held': 0.0, 'settled': 0.0})
+      with self.assert_query_budget(2):
+        rv = self.app.get(strings.MERCHANT_ENDPOINT + "1?summary=true")
+      self.assertEqual(json.loads(rv.get_data().decode()), data[0])
+      rv = self.app.get(strings.MERCHANT_ENDPOINT + "?summary=true&stream=true")
+      self.assertEqual(rv.status_code, 400)
+
+    def test_stream_cards_and_merchants(self):
+      for i in range(3):
+        response = self.create_card("Test user %d" % i, "12345%d" % i, 201)
+        response = self.create_merchant("CoffeMaker %d" % i, 201)
+      response = self.top_up_card(2, 10, 201)
+
+      rv = self.app.get(strings.CARD_ENDPOINT + "?stream=true&after=1")
+      self.assertEqual(rv.status_code, 200)
+      self.assertTrue(rv.is_streamed)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([x[strings.CARD_NBR_KEY] for x in data], ["123451", "123452"])
+      self.assertEqual(data[0][strings.AMOUNT_KEY], 10)
+      self.assertEqual(len(data[0][strings.TRANSACTIONS_KEY]), 1)
+
+      rv = self.app.get(strings.MERCHANT_ENDPOINT + "?stream=true")
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual(len(data), 3)
+
+      rv = self.app.get(strings.MERCHANT_ENDPOINT + "?stream=true&after=3")
+      self.assertEqual(json.loads(rv.get_data().decode()), [])
+
+    def test_sparse_fieldsets(self):
+      response = self.create_merchant("CoffeMaker", 201)
+      for i in range(3):
+        card_nbr = "12345%d" % i
+        response = self.create_card("Test user %d" % i, card_nbr, 201)
+        response = self.top_up_card(i + 1, 10, 201)
+        response = self.create_auth_request(1, card_nbr, 2, 201)
+
+      def get(url):
+        rv = self.app.get(url)
+        self.assertEqual(rv.status_code, 200)
+        return json.loads(rv.get_data().decode())
+
+      #Unrequested relationships are not loaded
+      with self.assert_query_budget(1):
+        data = get(strings.CARD_ENDPOINT + "?fields=id,amount")
+      self.assertEqual(data[0], {'id': 1, 'amount': 8})
+      with self.assert_query_budget(1):
+        data = get(strings.MERCHANT_ENDPOINT + "?include=")
+      self.assertEqual(data, [{'id': 1, 'name': "CoffeMaker"}])
+      with self.assert_query_budget(1):
+        data = get(strings.MERCHANT_ENDPOINT + "1?fields=name")
+      self.assertEqual(data, {'name': "CoffeMaker"})
+      with self.assert_query_budget(2):
+        data = get(strings.CARD_ENDPOINT + "?stream=true&fields=card_nbr")
+      self.assertEqual(data[2], {'card_nbr': "123452"})
+
+      #Included relationships come with the requested fields
+      with self.assert_query_budget(2):
+        data = get(strings.CARD_ENDPOINT + "?fields=id&include=transactions")
+      self.assertEqual([len(x[strings.TRANSACTIONS_KEY]) for x in data], [2, 2, 2])
+      self.assertEqual(sorted(data[0].keys()), ['id', strings.TRANSACTIONS_KEY])
+      data = get(strings.CARD_ENDPOINT + "1?include=transactions")
+      self.assertEqual(len(data[strings.TRANSACTIONS_KEY]), 2)
+      self.assertEqual(data[strings.NAME_KEY], "Test user 0")
+      self.assertNotIn(strings.TRANSACTIONS_KEY, get(strings.CARD_ENDPOINT + "1"))
+
+      self.assertEqual(self.app.get(strings.CARD_ENDPOINT + "?fields=id,pin").status_code, 400)
+      self.assertEqual(self.app.get(strings.MERCHANT_ENDPOINT + "1?include=name").status_code, 400)
+
+    def test_conditional_get(self):
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.create_card("Test user", "123456", 201)
+      card_url = strings.CARD_ENDPOINT + "1"
+      merchant_url = strings.MERCHANT_ENDPOINT + "1?fields=id,name"
+
+      def etag(url):
+        rv = self.app.get(url)
+        self.assertEqual(rv.status_code, 200)
+        return rv.headers['ETag']
+
+      def assert_not_modified(url, tag):
+        with self.assert_query_budget(1):
+          rv = self.app.get(url, headers={'If-None-Match': tag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertIn(rv.headers['ETag'], tag)
+        self.assertEqual(rv.get_data(), b"")
+
+      def assert_modified(url, tag):
+        rv = self.app.get(url, headers={'If-None-Match': tag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], tag)
+
+      #Unchanged entities are answered from their version alone
+      card_tag = etag(card_url)
+      merchant_tag = etag(merchant_url)
+      assert_not_modified(card_url, card_tag)
+      assert_not_modified(merchant_url, merchant_tag)
+      assert_not_modified(card_url, '"other", ' + card_tag)
+      assert_modified(card_url + "?include=transactions", card_tag)
+
+      #Every write to the card changes its ETag, the merchant's only changes
+      #with the merchant row
+      tags = set([card_tag])
+      response = self.top_up_card(1, 10, 201)
+      assert_modified(card_url, card_tag)
+      for write in (lambda: self.create_auth_request(1, "123456", 4, 201),
+                    lambda: self.capture(1, 2, 1, 200),
+                    lambda: self.reverse(1, 2, 1, 201),
+                    lambda: self.refund(1, "123456", 1, 201)):
+        card_tag = etag(card_url)
+        tags.add(card_tag)
+        write()
+        assert_modified(card_url, card_tag)
+        assert_not_modified(merchant_url, merchant_tag)
+      tags.add(etag(card_url))
+      self.assertEqual(len(tags), 6)
+      with self.app.application.app_context():
+        self.assertEqual(release_expired_holds(0)['released'], 1)
+        MerchantModel.get_one_merchant(1).update({strings.NAME_KEY: "TeaMaker"})
+      assert_modified(merchant_url, merchant_tag)
+
+      #The merchant representations made of transactions are not versioned
+      for query in ["", "?include=transactions", "?summary=true"]:
+        rv = self.app.get(strings.MERCHANT_ENDPOINT + "1" + query, headers={'If-None-Match': '*'})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotIn('ETag', rv.headers)
+
+      #Updates bump the version in SQL, after the balance updates of the transaction
+      card_tag = etag(card_url)
+      with self.app.application.app_context():
+        with unit_of_work():
+          card = CardModel.get_card(1)
+          CardModel.update_balance(1, 1)
+          card.update({strings.NAME_KEY: "Other user"})
+        self.assertEqual(CardModel.get_card(1).version, 9)
+      assert_modified(card_url, card_tag)
+      self.assertEqual(self.app.get(strings.CARD_ENDPOINT + "9", headers={'If-None-Match': '*'}).status_code, 404)
+
+    def test_read_endpoints_query_budget(self):
+      response = self.create_merchant("CoffeMaker", 201)
+      for i in range(5):
+        card_nbr = "12345%d" % i
+        response = self.create_card("Test user %d" % i, card_nbr, 201)
+        response = self.top_up_card(i + 1, 10, 201)
+        response = self.create_auth_request(1, card_nbr, 5, 201)
+
+      #Lists load the page and its transactions, whatever the page size
+      with self.assert_query_budget(2):
+        self.get_cards()
+      with self.assert_query_budget(2):
+        self.get_merchants()
+      with self.assert_query_budget(3):
+        self.app.get(strings.CARD_ENDPOINT + "?stream=true").get_data()
+
+      #Details never go through the card's transactions more than once
+      with self.assert_query_budget(1):
+        self.app.get(strings.CARD_ENDPOINT + "1")
+      with self.assert_query_budget(2):
+        rv = self.app.get(strings.CARD_ENDPOINT + "1/transactions")
+      self.assertEqual(len(json.loads(rv.get_data().decode())), 2)
+      with self.assert_query_budget(2):
+        self.app.get(strings.MERCHANT_ENDPOINT + "1")
+
+      #The auth path does not read the card's history nor lock the merchant
+      with self.assert_query_budget(5) as statements:
+        response = self.create_auth_request(1, "123450", 1, 201)
+      with self.assert_query_budget(10) as batch_statements:
+        response = self.create_auth_requests_batch(1, [{strings.CARD_NBR_KEY: "123451", strings.AMOUNT_KEY: 1}], 200)
+      self.assertFalse([x for x in statements + batch_statements if 'merchants' in x and not x.startswith('SELECT')])
+
+    def test_auth_requests_batch(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_card("Other user", "654321", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 10, 201)
+      response = self.top_up_card(2, 3, 201)
+
+      items = [
+        {strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: 4},
+        {strings.CARD_NBR_KEY: "654321", strings.AMOUNT_KEY: 5},
+        {strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: 4},
+        {strings.CARD_NBR_KEY: "000000", strings.AMOUNT_KEY: 1},
+        {strings.AMOUNT_KEY: 1},
+        {strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: 4},
+        {strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: -1},
+        {strings.CARD_NBR_KEY: ["123456"], strings.AMOUNT_KEY: 1},
+        {strings.CARD_NBR_KEY: {"123456": 1}, strings.AMOUNT_KEY: 1},
+      ]
+      rv = self.create_auth_requests_batch(1, items, 200)
+      results = json.loads(rv.get_data().decode())['Results']
+      self.assertEqual([x['status'] for x in results], [201, 400, 201, 404, 400, 400, 400, 400, 400])
+      self.assertEqual(results[0]['Transaction'][strings.AMOUNT_KEY], -4)
+      self.assertEqual(results[1]['error'], 'Not enough card amount')
+
+      #Holds are applied in order against the card balance
+      self.check_first_card("Test user", "123456", 2, 8)
+      self.check_balances_match_ledger(1)
+      self.check_balances_match_ledger(2)
+
+      #The holds can be captured like single auth requests
+      response = self.capture(1, results[2]['Transaction']['id'], 4, 200)
+
+      #Errors for the whole batch
+      rv = self.create_auth_requests_batch(2, items, 404)
+      rv = self.create_auth_requests_batch(1, items[0], 400)
+
+    def test_top_up_batch(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_card("Other user", "654321", 201)
+
+      items = [
+        {strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: 4},
+        {strings.CARD_NBR_KEY: "654321", strings.AMOUNT_KEY: 5},
+        {strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: 1.5},
+        {strings.CARD_NBR_KEY: "000000", strings.AMOUNT_KEY: 1},
+        {strings.CARD_NBR_KEY: "123456", strings.AMOUNT_KEY: -1},
+        {strings.CARD_NBR_KEY: "123456"},
+        {strings.CARD_NBR_KEY: ["123456"], strings.AMOUNT_KEY: 1},
+        {strings.CARD_NBR_KEY: {"123456": 1}, strings.AMOUNT_KEY: 1},
+      ]
+      rv = self.app.post(strings.CARD_ENDPOINT + "topup/batch", json=items)
+      self.assertEqual(rv.status_code, 200)
+      results = json.loads(rv.get_data().decode())['Results']
+      self.assertEqual([x['status'] for x in results], [201, 201, 201, 404, 403, 400, 400, 400])
+      self.check_first_card("Test user", "123456", 5.5, 0)
+      self.check_balances_match_ledger(1)
+      self.check_balances_match_ledger(2)
+
+      rv = self.app.post(strings.CARD_ENDPOINT + "topup/batch", json=items[0])
+      self.assertEqual(rv.status_code, 400)
+
+    def test_funding_file(self):
+      response = self.create_card("Test user", "123456", 201)
+      csv_file = io.StringIO("card_nbr,amount\n123456,10\n000000,1\n123456,abc\n123456,2.5\n123456,nan\n123456,inf\n")
+      ndjson_file = io.StringIO('{"card_nbr": "123456", "amount": 1}\nnot json\n\n[]\n')
+
+      failures = []
+      with self.app.application.app_context():
+        stats = process_funding_file(csv_file, 'csv', chunk_size=2,
+                                     on_failure=lambda *x: failures.append(x))
+        self.assertEqual((stats['lines'], stats['applied'], stats['failed']), (6, 2, 4))
+        stats = process_funding_file(ndjson_file, 'ndjson',
+                                     on_failure=lambda *x: failures.append(x))
+        self.assertEqual((stats['lines'], stats['applied'], stats['failed']), (3, 1, 2))
+      self.assertEqual([x[0] for x in failures], [3, 4, 6, 7, 2, 4])
+      self.check_first_card("Test user", "123456", 13.5, 0)
+      self.check_balances_match_ledger(1)
+
+    def test_clearing_file(self):
+      card_nbr = "123456"
+      response = self.create_card("Test user", card_nbr, 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 20, 201)
+      response = self.create_auth_request(1, card_nbr, 10, 201)
+      response = self.create_auth_request(1, card_nbr, 5, 201)
+
+      clearing = "\n".join([
+        '{"type": "capture", "transactions_id": 2, "amount": 4}',
+        '{"type": "refund", "card_nbr": "123456", "amount": 3}',
+        '{"type": "refund", "card_nbr": "123456", "amount": 2}',
+        '{"type": "capture", "transactions_id": 2, "amount": 6}',
+        '{"type": "reverse", "transactions_id": 3, "amount": 6}',
+        '{"type": "reverse", "transactions_id": 3, "amount": 5}',
+        '{"type": "chargeback", "transactions_id": 3, "amount": 5}',
+        'not json',
+      ])
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/clearing",
+                         data={'file': (io.BytesIO(clearing.encode()), 'clearing.ndjson')})
+      self.assertEqual(rv.status_code, 200)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([x['status'] for x in data['Results']], [200, 201, 403, 200, 400, 201, 400, 400])
+      self.assertEqual([x['line'] for x in data['Results']], list(range(1, 9)))
+      self.assertEqual((data['applied'], data['failed']), (4, 4))
+      self.check_first_card("Test user", card_nbr, 13, 0)
+      self.check_balances_match_ledger(1)
+
+      #Raw csv body
+      clearing = "type,transactions_id,card_nbr,amount\nrefund,,123456,7\nrefund,,123456,1\n"
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/clearing?format=csv", data=clearing)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([x['status'] for x in data['Results']], [201, 403])
+      self.check_first_card("Test user", card_nbr, 20, 0)
+
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "2/clearing", data=clearing)
+      self.assertEqual(rv.status_code, 404)
+
+      #Badly typed lines fail on their own, the valid lines of the chunk apply
+      response = self.create_auth_request(1, card_nbr, 2, 201)
+      hold_id = json.loads(response.get_data().decode())['Transaction']['id']
+      clearing = "\n".join([
+        '{"type": "refund", "card_nbr": "123456", "amount": "5"}',
+        '{"type": "capture", "transactions_id": [2], "amount": 1}',
+        '{"type": "reverse", "transactions_id": "abc", "amount": 1}',
+        '{"type": "refund", "card_nbr": ["123456"], "amount": 1}',
+        '{"type": "capture", "transactions_id": 2, "amount": true}',
+        '{"type": "capture", "transactions_id": %d, "amount": 2}' % hold_id,
+      ])
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/clearing?format=ndjson", data=clearing)
+      self.assertEqual(rv.status_code, 200)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([x['status'] for x in data['Results']], [400, 400, 400, 400, 400, 200])
+
+      #Amounts that are not finite are rejected, in csv and ndjson lines
+      clearing = "type,transactions_id,card_nbr,amount\nrefund,,123456,nan\nrefund,,123456,inf\n"
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/clearing?format=csv", data=clearing)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([x['status'] for x in data['Results']], [400, 400])
+      clearing = '{"type": "capture", "transactions_id": %d, "amount": NaN}' % hold_id
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/clearing?format=ndjson", data=clearing)
+      self.assertEqual([x['status'] for x in json.loads(rv.get_data().decode())['Results']], [400])
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/refund",
+                         data='{"card_nbr": "123456", "amount": Infinity}', content_type='application/json')
+      self.assertEqual(rv.status_code, 400)
+      self.check_balances_match_ledger(1)
+
+      #Lines that are not utf-8 fail on their own
+      clearing = b"type,transactions_id,card_nbr,amount\nrefund,,\xff\xfe,1\nrefund,,123456,1\n"
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/clearing?format=csv", data=clearing)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([(x['line'], x['status']) for x in data['Results']], [(2, 400), (3, 201)])
+      clearing = b'\xff\xfe\n{"type": "refund", "card_nbr": "123456", "amount": 1}\n'
+      rv = self.app.post(strings.MERCHANT_ENDPOINT + "1/clearing?format=ndjson", data=clearing)
+      data = json.loads(rv.get_data().decode())
+      self.assertEqual([(x['line'], x['status']) for x in data['Results']], [(1, 400), (2, 201)])
+      self.assertEqual(data['Results'][0]['error'], 'line is not valid utf-8')
+
+    def test_load_test_report(self):
+      args = load_test.parse_args(['-c', '2', '-n', '20', '-d', '30', '--cards', '3', '--merchants', '2',
+                                   '--hot-cards', '1'])
+      report = load_test.run(args, lambda: load_test.TestClient(self.app.application))
+      self.assertEqual(report['total']['requests'], 40)
+      self.assertEqual(report['total']['errors'], 0)
+      for name, endpoint in report['endpoints'].items():
+        self.assertIn(name, load_test.DEFAULT_MIX)
+        self.assertLessEqual(endpoint['p50_ms'], endpoint['p99_ms'])
+      self.assertTrue(load_test.compare(report, report))
+      #Another run against the same server sets up its own cards
+      report = load_test.run(args, lambda: load_test.TestClient(self.app.application))
+      self.assertEqual(report['total']['errors'], 0)
+      args = load_test.parse_args(['--mix', 'auth_request=20', 'refund=0'])
+      self.assertEqual(args.mix, [('auth_request', 20), ('refund', 0)])
+      for mix in ['refunds=1', 'refund=x']:
+        with redirect_stderr(io.StringIO()):
+          self.assertRaises(SystemExit, load_test.parse_args, ['--mix', mix])
+
+    def test_seed(self):
+      with self.app.application.app_context():
+        stats = seed(20, 5, 2000, chunk_size=300, random_seed=1)
+        self.assertGreaterEqual(stats['transactions'], 2000)
+        self.assertEqual(TransactionModel.query.count(), stats['transactions'])
+        counts = sorted([len(x.transactions) for x in CardModel.get_all_cards()])
+        holds = TransactionModel.query.filter_by(blocked=True).count()
+      #Power law: the busiest card has far more transactions than the median one
+      self.assertGreater(counts[-1], 5 * counts[len(counts) // 2])
+      self.assertGreater(holds, 0)
+      for card_id in range(1, 21):
+        self.check_balances_match_ledger(card_id)
+
+      #Seeding again with the same random seed picks another run prefix
+      with self.app.application.app_context():
+        stats = seed(20, 5, 100, random_seed=1)
+        self.assertEqual(CardModel.query.count(), 40)
+        self.assertEqual(len(set([x.card_nbr[:9] for x in CardModel.get_all_cards()])), 2)
+        self.assertTrue(all([len(x.card_nbr) == 16 for x in CardModel.get_all_cards()]))
+        self.assertRaises(ValueError, seed, 10**7 + 1, 5, 100)
+
+    def explain(self, query):
+      """
+      Query plan of a query as text, EXPLAIN QUERY PLAN on sqlite
+      """
+      connection = db.session.connection()
+      compiled = query.statement.compile(dialect=connection.dialect)
+      params = compiled.params
+      if compiled.positional:
+        params = tuple([params[x] for x in compiled.positiontup])
+      if connection.dialect.name == 'sqlite':
+        rows = connection.execute('EXPLAIN QUERY PLAN ' + str(compiled), params).fetchall()
+        return '\n'.join([row[-1] for row in rows])
+      rows = connection.execute('EXPLAIN ' + str(compiled), params).fetchall()
+      return '\n'.join([row[0] for row in rows])
+
+    def assert_no_table_scan(self, name, query):
+      plan = self.explain(query)
+      if db.session.connection().dialect.name == 'sqlite':
+        self.assertNotRegex(plan, r'SCAN (TABLE )?transactions(?! USING)', '%s:\n%s' % (name, plan))
+      else:
+        self.assertNotIn('Seq Scan on transactions', plan, '%s:\n%s' % (name, plan))
+
+    def test_transactions_query_plans(self):
+      with self.app.application.app_context():
+        seed(50, 5, 5000, chunk_size=1000, random_seed=1)
+        db.session.execute('ANALYZE')
+        if db.session.connection().dialect.name == 'postgresql':
+          # on a test sized table a scan is always cheapest, only a missing
+          # index makes the planner fall back to one
+          db.session.execute('SET LOCAL enable_seqscan = off')
+        created_at = db.session.query(db.func.max(TransactionModel.created_at)).scalar()
+        since = created_at - datetime.timedelta(days=30)
+        queries = {
+          'card history': TransactionModel.history_query(0, card_id=1),
+          'card history page': TransactionModel.history_query(
+            100, since, created_at, True, card_id=1).limit(100),
+          'card balance': db.session.query(db.func.sum(TransactionModel.amount)).filter_by(card_id=1),
+          'card history by time': TransactionModel.query.filter(
+            TransactionModel.card_id == 1, TransactionModel.created_at >= since,
+            TransactionModel.created_at < created_at).order_by(TransactionModel.created_at),
+          'merchant history': TransactionModel.query.filter_by(merchant_id=1).order_by(TransactionModel.id),
+          'refund limit': db.session.query(db.func.sum(TransactionModel.amount)).filter(
+            TransactionModel.merchant_id == 1, TransactionModel.card_id == 1,
+            TransactionModel.blocked.is_(False)),
+          'holds by age': TransactionModel.query.filter(
+            TransactionModel.blocked == True, TransactionModel.created_at < since) \
+            .order_by(TransactionModel.created_at),
+        }
+        for name, query in queries.items():
+          self.assert_no_table_scan(name, query)
+        db.session.rollback()
+
+    def get_metrics(self):
+      rv = self.app.get('/metrics')
+      self.assertEqual(rv.status_code, 200)
+      samples = {}
+      for line in rv.get_data().decode().splitlines():
+        if not line.startswith('#'):
+          name, value = line.rsplit(' ', 1)
+          samples[name] = float(value)
+      return samples
+
+    def test_metrics(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 10, 201)
+      before = self.get_metrics()
+      response = self.create_auth_request(1, "123456", 5, 201)
+      response = self.get_cards()
+      response = self.get_cards()
+      after = self.get_metrics()
+
+      def delta(sample):
+        return after.get(sample, 0) - before.get(sample, 0)
+      self.assertEqual(delta('http_requests_total{endpoint="cards.get_all",method="GET",status="200"}'), 2)
+      self.assertEqual(delta('http_request_duration_seconds_count{endpoint="merchants.create_auth_request"}'), 1)
+      self.assertEqual(delta('db_statements_total{endpoint="cards.get_all"}'), 4)
+      self.assertEqual(delta('db_statements_per_request_count{endpoint="merchants.create_auth_request"}'), 1)
+      self.assertGreater(delta('db_statement_duration_seconds_total{endpoint="cards.get_all"}'), 0)
+      self.assertGreater(delta('serialization_duration_seconds_sum{endpoint="cards.get_all"}'), 0)
+      self.assertFalse([x for x in after if 'endpoint="metrics"' in x])
+
+      #Failed statements leave no timing behind on the pooled connection
+      with self.app.application.app_context():
+        with db.engine.connect() as connection:
+          self.assertRaises(Exception, connection.execute, 'SELECT * FROM missing_table')
+          connection.execute('SELECT 1')
+          self.assertFalse(connection.info.get('_metrics_start'))
+
+    def test_lookup_cache(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_card("Other user", "654321", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      before = self.get_metrics()
+      response = self.create_auth_request(1, "123456", 5, 400)
+      response = self.create_auth_request(1, "123456", 5, 400)
+      after = self.get_metrics()
+      self.assertEqual(after['lookup_cache_misses_total{cache="card_ids"}']
+                       - before.get('lookup_cache_misses_total{cache="card_ids"}', 0), 1)
+      self.assertEqual(after['lookup_cache_hits_total{cache="card_ids"}']
+                       - before.get('lookup_cache_hits_total{cache="card_ids"}', 0), 1)
+      self.assertEqual(after['lookup_cache_hits_total{cache="merchants"}']
+                       - before.get('lookup_cache_hits_total{cache="merchants"}', 0), 1)
+
+      #A deleted card number must not resolve to the old card id
+      response = self.delete_card(1, 204)
+      response = self.create_card("Test user", "123456", 201)
+      response = self.top_up_card(3, 10, 201)
+      response = self.create_auth_request(1, "123456", 5, 201)
+      data = json.loads(response.get_data().decode())
+      self.assertEqual(data['Transaction'][strings.CARD_ID_KEY], 3)
+
+      #Another worker still caching a deleted card answers 404
+      response = self.create_merchant("TeaMaker", 201)
+      response = self.delete_card(2, 204)
+      cache.card_ids.set("654321", 2)
+      response = self.create_auth_request(2, "654321", 5, 404)
+      cache.card_ids.set("654321", 2)
+      response = self.refund(2, "654321", 5, 404)
+      self.assertEqual(cache.card_ids.get("654321"), None)
+
+      #Invalidations wait for the commit, a rollback keeps the entry
+      with self.app.application.app_context():
+        with unit_of_work() as uow:
+          CardModel.get_card(3).update({strings.NAME_KEY: "Renamed"})
+          self.assertEqual(cache.card_ids.get("123456"), 3)
+          uow.discard()
+        self.assertEqual(cache.card_ids.get("123456"), 3)
+        CardModel.get_card(3).delete()
+        self.assertEqual(cache.card_ids.get("123456"), None)
+
+      response = self.delete_merchant(1, 204)
+      response = self.create_auth_request(1, "123456", 5, 404)
+
+    def test_response_cache(self):
+      response = self.create_card("Test user", "123456", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 10, 201)
+      response = self.create_auth_request(1, "123456", 4, 201)
+      url = strings.MERCHANT_ENDPOINT + "1"
+      before = self.get_metrics()
+
+      #A cached body is served without loading the transactions
+      first = self.app.get(strings.CARD_ENDPOINT + "1?include=transactions").get_data()
+      with self.assert_query_budget(1):
+        rv = self.app.get(strings.CARD_ENDPOINT + "1?include=transactions")
+      self.assertEqual(rv.get_data(), first)
+      after = self.get_metrics()
+      self.assertEqual(after['response_cache_hits_total'] - before.get('response_cache_hits_total', 0), 1)
+      self.assertEqual(after['response_cache_misses_total'] - before.get('response_cache_misses_total', 0), 1)
+      self.assertGreater(after['response_cache_bytes'], 0)
+      self.assertGreater(after['response_cache_hit_ratio'], 0)
+
+      #Writes invalidate the entities they change
+      for write, merchant_changes in ((lambda: self.capture(1, 2, 1, 200), True),
+                                      (lambda: self.reverse(1, 2, 1, 201), True),
+                                      (lambda: self.refund(1, "123456", 1, 201), True),
+                                      (lambda: self.top_up_card(1, 5, 201), False),
+                                      (lambda: self.create_auth_request(1, "123456", 1, 201), True)):
+        merchant = self.app.get(url).get_data()
+        card = self.app.get(strings.CARD_ENDPOINT + "1").get_data()
+        write()
+        self.assertNotEqual(self.app.get(strings.CARD_ENDPOINT + "1").get_data(), card)
+        self.assertEqual(self.app.get(url).get_data() != merchant, merchant_changes)
+      data = json.loads(self.app.get(strings.CARD_ENDPOINT + "1").get_data().decode())
+      self.assertEqual((data[strings.AMOUNT_KEY], data[strings.BLOCKED_KEY]), (12, 3))
+
+      #Merchant bodies made of transactions are never cached, the others are
+      for query, cached in (("", False), ("?summary=true", False), ("?fields=id,name", True)):
+        hits = self.get_metrics()['response_cache_hits_total']
+        self.app.get(url + query)
+        with self.assert_query_budget(1 if cached else 2):
+          self.app.get(url + query)
+        self.assertEqual(self.get_metrics()['response_cache_hits_total'] - hits, 1 if cached else 0)
+      response = self.delete_merchant(1, 204)
+      self.assertEqual(self.app.get(url).status_code, 404)
+
+    def test_response_cache_backends(self):
+      cache = response_cache.ResponseCache()
+      cache.configure(response_cache.MemoryBackend(10))
+      cache.set(response_cache.CARD, 1, (1,), "a", b"12345")
+      cache.set(response_cache.CARD, 1, (1,), "b", b"123")
+      cache.set(response_cache.CARD, 2, (4,), "a", b"1234")
+      self.assertEqual(cache.get(response_cache.CARD, 1, (1,), "a"), None)
+      self.assertEqual(cache.get(response_cache.CARD, 2, (4,), "a"), b"1234")
+      self.assertEqual(cache.get(response_cache.CARD, 2, (3,), "a"), None)
+      cache.set(response_cache.CARD, 2, (3,), "b", b"12")
+      self.assertEqual(cache.get(response_cache.CARD, 2, (4,), "a"), b"1234")
+      self.assertEqual(cache.stats(), {'hits': 2, 'misses': 2, 'hit_ratio': 0.5, 'entries': 1, 'bytes': 4})
+
+      #Workers sharing a store see each other's bodies and invalidations
+      client = response_cache.LocalClient()
+      workers = [response_cache.ResponseCache() for i in range(2)]
+      for worker in workers:
+        worker.configure(response_cache.SharedBackend(client, 60))
+      workers[0].set(response_cache.MERCHANT, 1, (2, 7), "a", b"{}")
+      self.assertEqual(workers[1].get(response_cache.MERCHANT, 1, (2, 7), "a"), b"{}")
+      workers[1].invalidate(response_cache.MERCHANT, 1)
+      self.assertEqual(workers[0].get(response_cache.MERCHANT, 1, (2, 7), "a"), None)
+      self.assertEqual(workers[0].stats()['entries'], 0)
+
+    def test_compiled_serializers_match_marshmallow(self):
+      response = self.create_card("Test usér", "123456", 201)
+      response = self.create_card("Other user", "654321", 201)
+      response = self.create_merchant("CoffeMaker", 201)
+      response = self.top_up_card(1, 10.5, 201)
+      response = self.create_auth_request(1, "123456", 5, 201)
+      response = self.create_auth_request(1, "123456", 2, 201)
+      response = self.capture(1, 2, 1, 200)
+
+      with self.app.application.app_context():
+        for schema, objs in [
+            (CardSchema(), CardModel.get_all_cards()),
+            (CardSchema(exclude=(strings.TRANSACTIONS_KEY,)), CardModel.get_all_cards()),
+            (MerchantSchema(), MerchantModel.get_all_merchants()),
+            (MerchantSummarySchema(), MerchantModel.get_merchant_summaries(MerchantModel.get_all_merchants())),
+            (TransactionSchema(), TransactionModel.get_all_transactions())]:
+          self.assertEqual(to_json(dump(schema, objs, many=True)),
+                           flask_json.dumps(schema.dump(objs, many=True).data))
+          self.assertEqual(to_json(dump(schema, objs[0])), flask_json.dumps(schema.dump(objs[0]).data))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
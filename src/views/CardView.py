@@ -1,5 +1,15 @@
-from flask import request, json, Response, Blueprint
+from flask import request, Blueprint
 from src import strings
+from src.conditional import entity_response
+from src.fieldsets import fieldset_schema, get_fieldset
+from src.funding import top_up_chunk, top_up_message, MAX_TOPUP_BATCH_SIZE
+from src.idempotency import idempotent
+from src.pagination import get_history_filters, get_page_args, is_ndjson_requested, is_stream_requested, \
+  next_page_headers, stream_response, STREAM_CHUNK_SIZE
+from src.replica import read_only
+from src.response_cache import CARD
+from src.serializers import compile_dump, custom_response, dump
+from src.models import transactional
 from src.models.CardModel import CardModel, CardSchema
 from src.models.TransactionModel import TransactionModel, TransactionSchema
 
@@ -8,12 +18,29 @@ card_schema = CardSchema()
 transaction_schema = TransactionSchema()
 
 @card_api.route('/', methods=['GET'])
+@read_only
 def get_all():
-  cards = CardModel.get_all_cards()
-  ser_cards = card_schema.dump(cards, many=True).data
-  return custom_response(ser_cards, 200)
+  page, error = get_page_args(request.args)
+  if error:
+    return custom_response(error, 400)
+  after, limit = page
+  only, error = get_fieldset(request.args, CardSchema, default_includes=(strings.TRANSACTIONS_KEY,))
+  if error:
+    return custom_response(error, 400)
+  schema = fieldset_schema(CardSchema, only)
+  with_transactions = strings.TRANSACTIONS_KEY in only
+
+  if is_stream_requested(request.args):
+    cards = CardModel.iter_cards(after, STREAM_CHUNK_SIZE, with_transactions)
+    return stream_response(cards, compile_dump(schema))
+
+  cards = CardModel.get_cards_page(after, limit, with_transactions)
+  ser_cards = dump(schema, cards, many=True)
+  return custom_response(ser_cards, 200, next_page_headers(cards, limit))
 
 @card_api.route('/', methods=['POST'])
+@idempotent
+@transactional
 def create():
   """
   Create Card Function
@@ -33,34 +60,42 @@ def create():
   card = CardModel(data)
   card.save()
 
-  ser_data = card_schema.dump(card).data
+  ser_data = dump(card_schema, card)
 
   return custom_response({'Card': ser_data}, 201)
 
 @card_api.route('/<int:card_id>', methods=['GET'])
+@read_only
 def get_a_card(card_id):
   """
-  Get a card
+  Get a card, its transactions only with ?include=transactions. Answers
+  304 to an If-None-Match with its current ETag
   """
+  only, error = get_fieldset(request.args, CardSchema)
+  if error:
+    return custom_response(error, 400)
   card = CardModel.get_card(card_id)
   if not card:
     return custom_response({'error': 'card not found'}, 404)
-  ser_card = card_schema.dump(card).data
-
-  del ser_card[strings.TRANSACTIONS_KEY]
-  return custom_response(ser_card, 200)
+  schema = fieldset_schema(CardSchema, only)
+  return entity_response(CARD, card, (card.version,), lambda x: dump(schema, x))
 
 @card_api.route('/<int:card_id>', methods=['DELETE'])
+@transactional
 def delete(card_id):
   """
   Delete a card
   """
   card = CardModel.get_card(card_id)
+  if not card:
+    return custom_response({'error': 'card not found'}, 404)
   card.delete()
   return custom_response({'message': 'deleted'}, 204)
 
 
 @card_api.route('/<int:card_id>/topup', methods=['POST'])
+@idempotent
+@transactional
 def topUp(card_id):
   """
   TopUp a card
@@ -76,31 +111,54 @@ def topUp(card_id):
     return custom_response({'error': 'card not found'}, 404)
 
 
+  CardModel.update_balance(card_id, req_dict[strings.AMOUNT_KEY])
   transaction = TransactionModel.generate_transaction(card_id, None, req_dict['amount'], False)
   transaction.save()
   return custom_response({'message':
-    'Card with id: %s and number: %s has been topped up with %s' %
-      (card_id, card.card_nbr, req_dict[strings.AMOUNT_KEY])}, 201)
+    top_up_message(card_id, card.card_nbr, req_dict[strings.AMOUNT_KEY])}, 201)
+
+@card_api.route('/topup/batch', methods=['POST'])
+@idempotent
+def top_up_batch():
+  """
+  TopUp a list of {card_nbr, amount} with a single commit
+  """
+  req_data = request.get_json()
+  if not isinstance(req_data, list):
+    return custom_response({'error': 'Expected a list of top ups'}, 400)
+  if len(req_data) > MAX_TOPUP_BATCH_SIZE:
+    return custom_response({'error': 'A batch can have at most %d top ups' % MAX_TOPUP_BATCH_SIZE}, 400)
+
+  ser_results = []
+  for res, status_code in top_up_chunk(req_data):
+    res['status'] = status_code
+    ser_results.append(res)
+  return custom_response({'Results': ser_results}, 200)
 
 
 @card_api.route('/<int:card_id>/transactions', methods=['GET'])
+@read_only
 def get_a_card_transactions(card_id):
   """
-  Get a card
+  Get a page of a card's transactions, optionally created between from and
+  to and blocked or not, or all of them streamed with ?stream=true or as
+  NDJSON with ?format=ndjson
   """
+  page, error = get_page_args(request.args)
+  if not error:
+    filters, error = get_history_filters(request.args)
+  if error:
+    return custom_response(error, 400)
+  after, limit = page
+
   card = CardModel.get_card(card_id)
   if not card:
     return custom_response({'error': 'card not found'}, 404)
 
-  ser_card = card_schema.dump(card).data
-  return custom_response(ser_card[strings.TRANSACTIONS_KEY], 200)
+  if is_stream_requested(request.args) or is_ndjson_requested(request.args):
+    transactions = TransactionModel.iter_card_transactions(card_id, after, STREAM_CHUNK_SIZE, *filters)
+    return stream_response(transactions, compile_dump(transaction_schema), is_ndjson_requested(request.args))
 
-def custom_response(res, status_code):
-  """
-  Custom Response Function
-  """
-  return Response(
-      mimetype="application/json",
-      response=json.dumps(res),
-      status=status_code
-  )
+  transactions = TransactionModel.get_card_transactions_page(card_id, after, limit, *filters)
+  ser_transactions = dump(transaction_schema, transactions, many=True)
+  return custom_response(ser_transactions, 200, next_page_headers(transactions, limit))
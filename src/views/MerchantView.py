@@ -1,51 +1,164 @@
-from flask import request, json, Response, Blueprint
-from src import strings
-from src.models.MerchantModel import MerchantModel, MerchantSchema
+import random
+import time
+from flask import current_app, request, url_for, Blueprint
+from sqlalchemy.exc import OperationalError
+from src import cache, jobs, ledger, strings
+from src.batch_files import guess_file_format, FILE_FORMATS
+from src.clearing import process_clearing_file
+from src.conditional import entity_response
+from src.fieldsets import fieldset_schema, get_fieldset
+from src.idempotency import idempotent
+from src.merchant_deletion import delete_merchant, start_merchant_deletion
+from src.pagination import get_history_filters, get_page_args, is_ndjson_requested, is_stream_requested, \
+  is_summary_requested, next_page_headers, stream_response, STREAM_CHUNK_SIZE
+from src.replica import read_only
+from src.response_cache import MERCHANT
+from src.serializers import compile_dump, custom_response, dump
+from src.models import db, transactional
+from src.models.MerchantModel import MerchantModel, MerchantSchema, MerchantSummarySchema
 from src.models.CardModel import CardModel, CardSchema
 from src.models.TransactionModel import TransactionModel, TransactionSchema
 
 merchant_api = Blueprint('merchants', __name__)
 merchant_schema = MerchantSchema()
+merchant_summary_schema = MerchantSummarySchema()
 card_schema = CardSchema()
 transaction_schema = TransactionSchema()
 
-def _check_request_and_get_transaction(req_data, merchant_id):
-  if strings.TRANSACTIONS_ID_KEY not in req_data:
-    return None, custom_response({'error': 'Missing transaction attribute'}, 400)
-  if strings.AMOUNT_KEY not in req_data:
-    return None, custom_response({'error': 'Missing amount attribute'}, 400)
-  if req_data[strings.AMOUNT_KEY] < 0:
-    return None, custom_response({'error': 'amount is value is incorrect'}, 400)
-
-  transaction = TransactionModel.get_one_transaction(req_data[strings.TRANSACTIONS_ID_KEY])
-  if not transaction or transaction.merchant_id != merchant_id or not transaction.blocked:
-    return None, custom_response({'error': 'The transaction_id is not correct for this Merchant'}, 404)
-  return transaction, None
-
-def _check_request_and_get_merchant_and_card(req_data, merchant_id):
-  if strings.CARD_NBR_KEY not in req_data:
-    return None, None, custom_response({'error': 'Missing card_nbr attribute'}, 400)
-  if strings.AMOUNT_KEY not in req_data:
-    return None, None, custom_response({'error': 'Missing amount attribute'}, 400)
-  if req_data[strings.AMOUNT_KEY] <= 0:
-    return None, None, custom_response({'error': 'amount is value is incorrect'}, 400)
+# attempts for an auth hold that hits a lock timeout, deadlock or
+# serialization failure on a hot card before giving up
+AUTH_MAX_ATTEMPTS = 5
+AUTH_RETRY_DELAY = 0.005
+MAX_BATCH_SIZE = 1000
 
-  merchant = MerchantModel.get_one_merchant(merchant_id)
-  if not merchant:
+def _retry_on_lock_errors(operation):
+  """
+  Run operation, retrying it a bounded number of times when it hits a lock
+  timeout, deadlock or serialization failure. The operation must commit
+  """
+  for attempt in range(1, AUTH_MAX_ATTEMPTS + 1):
+    try:
+      return operation()
+    except OperationalError:
+      db.session.rollback()
+      if attempt == AUTH_MAX_ATTEMPTS:
+        raise
+      time.sleep(random.uniform(0, AUTH_RETRY_DELAY * attempt))
+
+def _hold_and_create_auth_transaction(card_id, merchant_id, amount):
+  """
+  Atomically check and block the amount on the card and write the hold in
+  the same db transaction. Returns None if the card has not enough amount
+  """
+  def hold():
+    if not CardModel.hold_funds(card_id, amount):
+      db.session.rollback()
+      return None
+    transaction = TransactionModel.generate_transaction(card_id, merchant_id, -1*amount)
+    transaction.save()
+    return transaction
+  return _retry_on_lock_errors(hold)
+
+def _hold_batch(merchant_id, items):
+  """
+  Check and hold every item in order, all the holds are written in one db
+  transaction. Returns one (response dict, status code) per item
+  """
+  errors = [ledger.check_card_request(x) for x in items]
+  card_nbrs = set([x[strings.CARD_NBR_KEY] for x, error in zip(items, errors) if not error])
+  cards = {}
+  if card_nbrs:
+    cards = dict([(card.card_nbr, card) for card in CardModel.get_cards_by_card_nbrs(card_nbrs, for_update=True)])
+  available = dict([(card_nbr, card.available) for card_nbr, card in cards.items()])
+
+  results = []
+  holds = {}
+  for item, error in zip(items, errors):
+    if error:
+      results.append(error)
+      continue
+    card = cards.get(item[strings.CARD_NBR_KEY])
+    if not card:
+      results.append(({'error': 'card number was not found'}, 404))
+      continue
+    amount = item[strings.AMOUNT_KEY]
+    if available[card.card_nbr] < amount:
+      results.append(({'error': 'Not enough card amount'}, 400))
+      continue
+    available[card.card_nbr] -= amount
+    transaction = TransactionModel.generate_transaction(card.id, merchant_id, -1*amount)
+    holds.setdefault(card.id, []).append(transaction)
+    results.append(transaction)
+
+  for card_id, transactions in holds.items():
+    held = -1*sum([x.amount for x in transactions])
+    CardModel.update_balance(card_id, -1*held, held)
+  for transactions in holds.values():
+    db.session.add_all(transactions)
+  # flush to get the ids and serialize before the commit expires the rows
+  db.session.flush()
+  results = [x if isinstance(x, tuple) else ({'Transaction': dump(transaction_schema, x)}, 201)
+             for x in results]
+  db.session.commit()
+  return results
+
+def _card_was_deleted(card_nbr, card_id):
+  """
+  Whether the card id cached for a card number is gone, in which case the
+  entry is dropped. Checked when an operation fails, another worker may
+  have deleted the card
+  """
+  if CardModel.card_exists(card_id):
+    return False
+  cache.card_ids.delete(card_nbr)
+  return True
+
+def _check_request_and_get_merchant_and_card_ids(req_data, merchant_id):
+  error = ledger.check_card_request(req_data)
+  if error:
+    return None, None, custom_response(*error)
+
+  if not MerchantModel.merchant_exists(merchant_id):
     return None, None, custom_response({'error': 'merchant not found'}, 404)
 
-  card = CardModel.get_card_by_card_nbr(req_data[strings.CARD_NBR_KEY])
-  if not card:
+  card_id = CardModel.get_card_id_by_card_nbr(req_data[strings.CARD_NBR_KEY])
+  if not card_id:
     return None, None, custom_response({'error': 'card number was not found'}, 404)
-  return merchant, card, None
+  return merchant_id, card_id, None
 
 @merchant_api.route('/', methods=['GET'])
+@read_only
 def get_all():
-  merchants = MerchantModel.get_all_merchants()
-  ser_merchants = merchant_schema.dump(merchants, many=True).data
-  return custom_response(ser_merchants, 200)
+  page, error = get_page_args(request.args)
+  if error:
+    return custom_response(error, 400)
+  after, limit = page
+
+  if is_summary_requested(request.args):
+    if is_stream_requested(request.args):
+      return custom_response({'error': 'summaries are paginated, they cannot be streamed'}, 400)
+    merchants = MerchantModel.get_merchants_page(after, limit, with_transactions=False)
+    summaries = MerchantModel.get_merchant_summaries(merchants)
+    return custom_response(dump(merchant_summary_schema, summaries, many=True), 200,
+                           next_page_headers(merchants, limit))
+
+  only, error = get_fieldset(request.args, MerchantSchema, default_includes=(strings.TRANSACTIONS_KEY,))
+  if error:
+    return custom_response(error, 400)
+  schema = fieldset_schema(MerchantSchema, only)
+  with_transactions = strings.TRANSACTIONS_KEY in only
+
+  if is_stream_requested(request.args):
+    merchants = MerchantModel.iter_merchants(after, STREAM_CHUNK_SIZE, with_transactions)
+    return stream_response(merchants, compile_dump(schema))
+
+  merchants = MerchantModel.get_merchants_page(after, limit, with_transactions)
+  ser_merchants = dump(schema, merchants, many=True)
+  return custom_response(ser_merchants, 200, next_page_headers(merchants, limit))
 
 @merchant_api.route('/', methods=['POST'])
+@idempotent
+@transactional
 def create():
   """
   Create User Function
@@ -65,108 +178,180 @@ def create():
   merchant = MerchantModel(data)
   merchant.save()
 
-  ser_data = merchant_schema.dump(merchant).data
+  ser_data = dump(merchant_schema, merchant)
 
   return custom_response({'Merchant': ser_data}, 201)
 
 @merchant_api.route('/<int:merchant_id>', methods=['DELETE'])
 def delete(merchant_id):
   """
-  Delete a merchant
+  Delete a merchant and release its holds, with ?async=true in a
+  background job whose progress is at the returned Location
   """
-  merchant = MerchantModel.get_one_merchant(merchant_id)
-  for transaction in merchant.transactions:
-    if transaction.blocked:
-      transaction.delete()
-  merchant.delete()
+  if not MerchantModel.merchant_exists(merchant_id):
+    return custom_response({'error': 'merchant not found'}, 404)
+
+  if request.args.get(strings.ASYNC_KEY, '').lower() in ('1', 'true', 'yes'):
+    job = start_merchant_deletion(current_app._get_current_object(), merchant_id)
+    location = url_for('merchants.get_job', job_id=job.id)
+    return custom_response({'Job': job.to_dict()}, 202, {'Location': location})
+
+  delete_merchant(merchant_id)
   return custom_response({'message': 'deleted'}, 204)
 
+@merchant_api.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+  job = jobs.get_job(job_id)
+  if not job:
+    return custom_response({'error': 'job not found'}, 404)
+  return custom_response({'Job': job.to_dict()}, 200)
+
 @merchant_api.route('/<int:merchant_id>', methods=['GET'])
+@read_only
 def get_merchant_info(merchant_id):
+  """
+  Get a merchant, answers 304 to an If-None-Match with its current ETag
+  """
+  only, error = get_fieldset(request.args, MerchantSchema, default_includes=(strings.TRANSACTIONS_KEY,))
+  if error:
+    return custom_response(error, 400)
   merchant = MerchantModel.get_one_merchant(merchant_id)
   if not merchant:
     return custom_response({'error': 'merchant not found'}, 404)
 
-  ser_merchant = merchant_schema.dump(merchant).data
-  return custom_response(ser_merchant, 200)
+  # the version does not follow the transactions, the representations made
+  # of them get no ETag
+  if is_summary_requested(request.args):
+    return custom_response(dump(merchant_summary_schema, MerchantModel.get_merchant_summaries([merchant])[0]), 200)
+  # the transactions are lazy loaded, only when they are in the fieldset
+  schema = fieldset_schema(MerchantSchema, only)
+  if strings.TRANSACTIONS_KEY in only:
+    return custom_response(dump(schema, merchant), 200)
+  return entity_response(MERCHANT, merchant, (merchant.version,), lambda x: dump(schema, x))
+
+@merchant_api.route('/<int:merchant_id>/transactions', methods=['GET'])
+@read_only
+def get_merchant_transactions(merchant_id):
+  """
+  Get a page of a merchant's transactions with the filters and the
+  streaming modes of the card transactions
+  """
+  page, error = get_page_args(request.args)
+  if not error:
+    filters, error = get_history_filters(request.args)
+  if error:
+    return custom_response(error, 400)
+  after, limit = page
+
+  if not MerchantModel.merchant_exists(merchant_id):
+    return custom_response({'error': 'merchant not found'}, 404)
+
+  if is_stream_requested(request.args) or is_ndjson_requested(request.args):
+    transactions = TransactionModel.iter_merchant_transactions(merchant_id, after, STREAM_CHUNK_SIZE, *filters)
+    return stream_response(transactions, compile_dump(transaction_schema), is_ndjson_requested(request.args))
+
+  transactions = TransactionModel.get_merchant_transactions_page(merchant_id, after, limit, *filters)
+  ser_transactions = dump(transaction_schema, transactions, many=True)
+  return custom_response(ser_transactions, 200, next_page_headers(transactions, limit))
 
 @merchant_api.route('/<int:merchant_id>/capture', methods=['POST'])
+@idempotent
+@transactional
 def capture(merchant_id):
   req_data = request.get_json()
-  transaction, error = _check_request_and_get_transaction(req_data, merchant_id)
-  if error:
-    return error
-
-  if transaction.amount + req_data[strings.AMOUNT_KEY] > 0:
-    return custom_response({'error': 'The request amount is more than the existing amount in the transaction'}, 403)
-  if transaction.amount + req_data[strings.AMOUNT_KEY] != 0:
-    transaction.amount = transaction.amount + req_data[strings.AMOUNT_KEY]
-    transaction_blocked = TransactionModel.generate_transaction(transaction.card_id, merchant_id, -1*req_data[strings.AMOUNT_KEY], False)
-    transaction_blocked.created_at = transaction.created_at
-    transaction_blocked.save()
-    transaction.save()
-  else:
-    transaction.blocked = False
-    transaction.save()
-  ser_transaction = transaction_schema.dump(transaction).data
-  return custom_response({'Transaction':  ser_transaction}, 200)
+  res, status_code = ledger.capture(merchant_id, req_data)
+  return custom_response(res, status_code)
 
 @merchant_api.route('/<int:merchant_id>/reverse', methods=['POST'])
+@idempotent
+@transactional
 def reverse(merchant_id):
   req_data = request.get_json()
-  transaction, error = _check_request_and_get_transaction(req_data, merchant_id)
-  if error:
-    return error
-
-  if transaction.amount + req_data[strings.AMOUNT_KEY] > 0:
-    return custom_response({'error': 'Cannot reverse more than was authorized'}, 400)
-  elif transaction.amount + req_data[strings.AMOUNT_KEY] < 0:
-    transaction.amount += req_data[strings.AMOUNT_KEY]
-    transaction.save()
-  else:
-    transaction.delete()
-  return custom_response({'Reverse':  "Ok"}, 201)
+  res, status_code = ledger.reverse(merchant_id, req_data)
+  return custom_response(res, status_code)
 
 @merchant_api.route('/<int:merchant_id>/auth_request', methods=['POST'])
+@idempotent
 def create_auth_request(merchant_id):
   req_data = request.get_json()
-  merchant, card, error = _check_request_and_get_merchant_and_card(req_data, merchant_id)
+  merchant_id, card_id, error = _check_request_and_get_merchant_and_card_ids(req_data, merchant_id)
   if error:
     return error
 
-  ser_card = card_schema.dump(card).data
-  ser_merchant = merchant_schema.dump(merchant).data
-  print(merchant_id)
-  if ser_card[strings.AMOUNT_KEY] < req_data[strings.AMOUNT_KEY]:
+  try:
+    transaction = _hold_and_create_auth_transaction(card_id, merchant_id, req_data[strings.AMOUNT_KEY])
+  except OperationalError:
+    return custom_response({'error': 'card is busy, please retry'}, 503)
+  if not transaction:
+    if _card_was_deleted(req_data[strings.CARD_NBR_KEY], card_id):
+      return custom_response({'error': 'card number was not found'}, 404)
     return custom_response({'error': 'Not enough card amount'}, 400)
 
-  transaction = TransactionModel.generate_transaction(card.id, merchant_id, -1*req_data[strings.AMOUNT_KEY])
-  transaction.save()
-  ser_transaction = transaction_schema.dump(transaction).data
+  ser_transaction = dump(transaction_schema, transaction)
   return custom_response({'Transaction':  ser_transaction}, 201)
 
 
+@merchant_api.route('/<int:merchant_id>/auth_requests/batch', methods=['POST'])
+@idempotent
+def create_auth_requests_batch(merchant_id):
+  """
+  Authorize a list of {card_nbr, amount} in order with a single commit
+  """
+  req_data = request.get_json()
+  if not isinstance(req_data, list):
+    return custom_response({'error': 'Expected a list of auth requests'}, 400)
+  if len(req_data) > MAX_BATCH_SIZE:
+    return custom_response({'error': 'A batch can have at most %d auth requests' % MAX_BATCH_SIZE}, 400)
+
+  if not MerchantModel.merchant_exists(merchant_id):
+    return custom_response({'error': 'merchant not found'}, 404)
+
+  try:
+    results = _retry_on_lock_errors(lambda: _hold_batch(merchant_id, req_data))
+  except OperationalError:
+    return custom_response({'error': 'cards are busy, please retry'}, 503)
+  ser_results = []
+  for res, status_code in results:
+    res['status'] = status_code
+    ser_results.append(res)
+  return custom_response({'Results': ser_results}, 200)
+
+@merchant_api.route('/<int:merchant_id>/clearing', methods=['POST'])
+@idempotent
+def upload_clearing_file(merchant_id):
+  """
+  Apply a clearing file of capture, reverse and refund lines, sent as the
+  "file" field of a multipart form or as the raw request body
+  """
+  merchant = MerchantModel.get_one_merchant(merchant_id)
+  if not merchant:
+    return custom_response({'error': 'merchant not found'}, 404)
+
+  upload = request.files.get('file')
+  stream = upload.stream if upload else request.stream
+  file_format = request.args.get('format') or guess_file_format(upload.filename if upload else None)
+  if file_format not in FILE_FORMATS:
+    return custom_response({'error': 'format must be one of %s' % ', '.join(FILE_FORMATS)}, 400)
+
+  results = []
+  def collect(line_num, res, status_code):
+    res['line'] = line_num
+    res['status'] = status_code
+    results.append(res)
+
+  stats = process_clearing_file(merchant, stream, file_format, on_result=collect)
+  return custom_response({'Results': results, 'applied': stats['applied'], 'failed': stats['failed']}, 200)
+
 @merchant_api.route('/<int:merchant_id>/refund', methods=['POST'])
+@idempotent
+@transactional
 def refund(merchant_id):
   req_data = request.get_json()
-  merchant, card, error = _check_request_and_get_merchant_and_card(req_data, merchant_id)
+  merchant_id, card_id, error = _check_request_and_get_merchant_and_card_ids(req_data, merchant_id)
   if error:
     return error
 
-  available_refund = sum([x.amount for x in merchant.transactions if x.card_id == card.id and not x.blocked])
-  if req_data[strings.AMOUNT_KEY] + available_refund > 0:
-     return custom_response({'error': 'trying to refund more than is refundable'}, 403)
-  transaction = TransactionModel.generate_transaction(card.id, merchant_id, req_data[strings.AMOUNT_KEY], False)
-  transaction.save()
-  ser_transaction = transaction_schema.dump(transaction).data
-  return custom_response({'Transaction':  ser_transaction}, 201)
-
-def custom_response(res, status_code):
-  """
-  Custom Response Function
-  """
-  return Response(
-      mimetype="application/json",
-      response=json.dumps(res),
-      status=status_code
-  )
\ No newline at end of file
+  res, status_code = ledger.refund(merchant_id, card_id, req_data[strings.AMOUNT_KEY])
+  if status_code == 403 and _card_was_deleted(req_data[strings.CARD_NBR_KEY], card_id):
+    return custom_response({'error': 'card number was not found'}, 404)
+  return custom_response(res, status_code)